@@ -3,7 +3,12 @@ import time
 import os
 
 if __name__ == "__main__":
-    node = P2PNode()
+    bootstrap_peers = [peer for peer in os.environ.get("P2P_BOOTSTRAP_PEERS", "").split(",") if peer.strip()]
+    upload_limit = float(os.environ["P2P_UPLOAD_LIMIT"]) if os.environ.get("P2P_UPLOAD_LIMIT") else None
+    download_limit = float(os.environ["P2P_DOWNLOAD_LIMIT"]) if os.environ.get("P2P_DOWNLOAD_LIMIT") else None
+    replication_quota = int(os.environ["P2P_REPLICATION_QUOTA"]) if os.environ.get("P2P_REPLICATION_QUOTA") else None
+    node = P2PNode(discovery_mode=os.environ.get("P2P_DISCOVERY_MODE", "broadcast"), bootstrap_peers=bootstrap_peers,
+                   upload_limit=upload_limit, download_limit=download_limit, replication_quota=replication_quota)
     if not os.path.exists("publicFiles"):
         os.makedirs("publicFiles")
     try:
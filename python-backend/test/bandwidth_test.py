@@ -0,0 +1,113 @@
+import argparse
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.BandwidthScheduler import BURST_SECONDS, MIN_BURST, BandwidthScheduler, DOWNLOAD, PRIORITY_BACKGROUND, PRIORITY_FOREGROUND, UPLOAD
+from utils.FileManager import FileClient
+from harness import exit_status, make_index, start_server, verdict
+
+# Checks the scheduler on its own (global cap, per-peer cap, fair shares between peers, foreground
+# ahead of background, a limit changed mid-transfer) and then a real loopback transfer through
+# FileServer and FileClient with an upload cap.
+
+CHUNK = 64 * 1024
+
+
+def pump(scheduler, direction, peer, priority, stop, counters):
+    while not stop.is_set():
+        scheduler.acquire(direction, peer, CHUNK, priority)
+        counters[(peer, priority)] = counters.get((peer, priority), 0) + CHUNK
+
+
+def run_flows(scheduler, flows, seconds):
+    stop = threading.Event()
+    counters = {}
+    threads = [threading.Thread(target=pump, args=(scheduler, direction, peer, priority, stop, counters), daemon=True)
+               for direction, peer, priority in flows]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join(2)
+    return {key: value / seconds for key, value in counters.items()}
+
+
+def within_cap(measured: float, rate: float, seconds: float, flows: int) -> bool:
+    # A bucket starts full and every flow may hold one chunk in flight, so short runs overshoot a little.
+    return measured <= rate * 1.2 + (max(rate * BURST_SECONDS, MIN_BURST) + CHUNK * flows) / seconds
+
+
+def show(title, rates, ok: Optional[bool] = None):
+    print(title if ok is None else f"{title} {verdict(ok, title.rstrip(':'))}")
+    for (peer, priority), rate in sorted(rates.items()):
+        print(f"  {peer:<10} {priority:<11} {rate / 1e6:6.2f} MB/s")
+    return rates
+
+
+def scheduler_checks(rate: float, seconds: float):
+    scheduler = BandwidthScheduler(upload_rate=rate)
+    rates = run_flows(scheduler, [(UPLOAD, f"peer{i}", PRIORITY_FOREGROUND) for i in range(3)], seconds)
+    show(f"global upload cap {rate / 1e6:.1f} MB/s, three peers:", rates, within_cap(sum(rates.values()), rate, seconds, 3))
+
+    scheduler.set_peer_limit(UPLOAD, "peer0", rate / 10)
+    rates = run_flows(scheduler, [(UPLOAD, f"peer{i}", PRIORITY_FOREGROUND) for i in range(3)], seconds)
+    show(f"same, with peer0 capped at {rate / 10 / 1e6:.1f} MB/s:", rates,
+         within_cap(rates.get(("peer0", PRIORITY_FOREGROUND), 0), rate / 10, seconds, 1))
+    scheduler.set_peer_limit(UPLOAD, "peer0", None)
+
+    rates = run_flows(scheduler, [(UPLOAD, "peer1", PRIORITY_FOREGROUND), (UPLOAD, "peer2", PRIORITY_BACKGROUND)], seconds)
+    show("foreground peer1 against background peer2:", rates,
+         rates.get(("peer1", PRIORITY_FOREGROUND), 0) > rates.get(("peer2", PRIORITY_BACKGROUND), 0))
+
+    scheduler.set_default_peer_limit(UPLOAD, rate / 4)
+    show(f"foreground peer1 and background peer2, each peer capped at {rate / 4 / 1e6:.1f} MB/s:",
+         run_flows(scheduler, [(UPLOAD, "peer1", PRIORITY_FOREGROUND), (UPLOAD, "peer2", PRIORITY_BACKGROUND)], seconds))
+
+    show("download lane has no limits:",
+         run_flows(scheduler, [(DOWNLOAD, "peer1", PRIORITY_FOREGROUND)], 0.2))
+
+
+def loopback_check(rate: float, size: int, port: int):
+    with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as data_directory:
+        data = os.urandom(size)
+        with open(os.path.join(directory, "payload.bin"), "wb") as f:
+            f.write(data)
+        file_hash = hashlib.sha256(data).hexdigest()
+        file_index = make_index(directory, data_directory)
+        scheduler = BandwidthScheduler(upload_rate=rate)
+        server = start_server(file_index, port, scheduler)
+
+        buffer = io.BytesIO()
+        started = time.monotonic()
+        halfway = threading.Timer(1.0, scheduler.set_global_limit, args=(UPLOAD, rate * 2))
+        halfway.start()
+        with FileClient("127.0.0.1", port) as client:
+            client.request_range(file_hash, 0, size, buffer)
+        elapsed = time.monotonic() - started
+        server.stop_server()
+        file_index.stop()
+
+        intact = hashlib.sha256(buffer.getvalue()).hexdigest() == file_hash
+        print(f"loopback: {size / 1e6:.1f} MB in {elapsed:.2f}s ({size / elapsed / 1e6:.2f} MB/s) with the cap raised from "
+              f"{rate / 1e6:.1f} to {rate * 2 / 1e6:.1f} MB/s after 1s, data {verdict(intact, 'loopback transfer')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exercise the bandwidth scheduler and a rate-limited loopback transfer.")
+    parser.add_argument("--rate", type=float, default=8e6, help="global cap in bytes per second")
+    parser.add_argument("--seconds", type=float, default=2.0, help="duration of each scheduler scenario")
+    parser.add_argument("--size", type=int, default=24 * 1024 * 1024, help="bytes sent in the loopback transfer")
+    parser.add_argument("--port", type=int, default=47001)
+    args = parser.parse_args()
+    scheduler_checks(args.rate, args.seconds)
+    loopback_check(args.rate, args.size, args.port)
+    sys.exit(exit_status())
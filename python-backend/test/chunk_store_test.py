@@ -0,0 +1,88 @@
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.BandwidthScheduler import BandwidthScheduler, DOWNLOAD
+from utils.ChunkStore import ChunkStore
+from utils.ManifestManager import CHUNK_SIZE
+from utils.SwarmDownloader import SwarmDownloader
+from harness import exit_status, make_index, start_server, verdict
+
+# A remote FileServer shares version 2 of an artifact. The local node already shares version 1,
+# which differs in a few chunks, and then downloads version 2 under a new name, and finally a
+# second copy of version 2 under yet another name. Only the changed chunks should cross the network.
+
+
+def download(sources, file_hash, destination, chunk_store, bandwidth) -> tuple:
+    before = bandwidth.limits()[DOWNLOAD]["bytes"]["foreground"]
+    started = time.monotonic()
+    ok = SwarmDownloader(sources, file_hash, destination, chunk_store=chunk_store, bandwidth=bandwidth).run()
+    elapsed = time.monotonic() - started
+    fetched = bandwidth.limits()[DOWNLOAD]["bytes"]["foreground"] - before
+    with open(destination, "rb") as f:
+        intact = hashlib.sha256(f.read()).hexdigest() == file_hash
+    return ok and intact, fetched, elapsed
+
+
+def run(chunks: int, changed: int, port: int):
+    root = tempfile.mkdtemp()
+    try:
+        remote_dir, local_dir = os.path.join(root, "remote"), os.path.join(root, "local")
+        os.makedirs(remote_dir)
+        os.makedirs(local_dir)
+        version1 = bytearray(os.urandom(chunks * CHUNK_SIZE + CHUNK_SIZE // 3))
+        version2 = bytearray(version1)
+        for index in random.sample(range(chunks), changed):
+            version2[index * CHUNK_SIZE:(index + 1) * CHUNK_SIZE] = os.urandom(CHUNK_SIZE)
+        with open(os.path.join(local_dir, "artifact-1.0.bin"), "wb") as f:
+            f.write(version1)
+        with open(os.path.join(remote_dir, "artifact-1.1.bin"), "wb") as f:
+            f.write(version2)
+        version2_hash = hashlib.sha256(version2).hexdigest()
+
+        remote_index = make_index(remote_dir, os.path.join(root, "remote-data"))
+        server = start_server(remote_index, port)
+
+        local_index = make_index(local_dir, os.path.join(root, "local-data"))
+        chunk_store = ChunkStore(local_index)
+        chunk_store.sync()
+        bandwidth = BandwidthScheduler()
+        sources = [{"peer_ip": "127.0.0.1", "port": port, "transfer_port": port}]
+        size_mb = len(version2) / 1e6
+        print(f"artifact {size_mb:.1f} MB in {chunks + 1} chunks, {changed} changed between versions")
+
+        ok, fetched, elapsed = download(sources, version2_hash, os.path.join(local_dir, "artifact-1.1.bin"),
+                                        chunk_store, bandwidth)
+        print(f"v1.1 with v1.0 on disk:    {verdict(ok, 'new version')}, {fetched / 1e6:.1f} MB from the network "
+              f"of {size_mb:.1f} MB in {elapsed:.2f}s")
+
+        local_index.refresh()
+        ok, fetched, elapsed = download(sources, version2_hash, os.path.join(local_dir, "artifact-latest.bin"),
+                                        chunk_store, bandwidth)
+        print(f"same content, new name:    {verdict(ok and fetched == 0, 'same content')}, {fetched / 1e6:.1f} MB from the network in {elapsed:.2f}s")
+
+        ok, fetched, elapsed = download(sources, version2_hash, os.path.join(root, "no-store.bin"), None, bandwidth)
+        print(f"without the chunk store:   {verdict(ok, 'without the chunk store')}, {fetched / 1e6:.1f} MB from the network in {elapsed:.2f}s")
+        print(f"chunk store: {len(chunk_store)} distinct chunks, {chunk_store.stats}")
+        server.stop_server()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download a new version of a file with the old version on disk.")
+    parser.add_argument("--chunks", type=int, default=64)
+    parser.add_argument("--changed", type=int, default=4)
+    parser.add_argument("--port", type=int, default=47011)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    run(args.chunks, args.changed, args.port)
+    sys.exit(exit_status())
@@ -0,0 +1,99 @@
+import argparse
+import gzip
+import hashlib
+import io
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.BandwidthScheduler import BandwidthScheduler, UPLOAD
+from utils.FileManager import FileClient
+from harness import exit_status, make_index, start_server, verdict
+
+# A FileServer behind an upload cap (standing in for a slow link) serves a text log, an already
+# gzipped copy of it and random bytes. Each is downloaded once with compression offered and once
+# without. The log should cross the link in far fewer bytes and faster; the other two should cost
+# the same either way.
+
+
+def make_log(size: int) -> bytes:
+    levels = ["INFO", "INFO", "INFO", "DEBUG", "WARNING", "ERROR"]
+    paths = ["/api/files", "/api/peers", "/api/search", "/ws", "/health"]
+    lines = []
+    total = 0
+    timestamp = 1_700_000_000.0
+    while total < size:
+        timestamp += random.random()
+        line = (f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))} {random.choice(levels):<7} "
+                f"node-{random.randrange(16):02d} GET {random.choice(paths)}?id={random.randrange(10 ** 6)} "
+                f"status={random.choice((200, 200, 200, 404, 500))} took={random.random() * 50:.2f}ms\n")
+        lines.append(line)
+        total += len(line)
+    return "".join(lines).encode()[:size]
+
+
+def download(port, file_hash, codecs) -> tuple:
+    buffer = io.BytesIO()
+    started = time.monotonic()
+    with FileClient("127.0.0.1", port, codecs=codecs) as client:
+        meta = client.request({'file_hash': file_hash}, buffer)
+    elapsed = time.monotonic() - started
+    return hashlib.sha256(buffer.getvalue()).hexdigest() == file_hash, meta.get('codec'), elapsed
+
+
+def run(size_mb: int, rate: float, port: int):
+    with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as data_directory:
+        log = make_log(size_mb * 1024 * 1024)
+        payloads = {"service.log": log, "service.log.gz": gzip.compress(log, 6), "random.bin": os.urandom(len(log))}
+        for name, data in payloads.items():
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(data)
+        scheduler = BandwidthScheduler(upload_rate=rate)
+        server = start_server(make_index(directory, data_directory), port, scheduler)
+
+        print(f"upload capped at {rate / 1e6:.1f} MB/s")
+        for name, data in payloads.items():
+            file_hash = hashlib.sha256(data).hexdigest()
+            for codecs in (None, []):
+                before = scheduler.limits()[UPLOAD]["bytes"]["foreground"]
+                ok, codec, elapsed = download(port, file_hash, codecs)
+                wire = scheduler.limits()[UPLOAD]["bytes"]["foreground"] - before
+                if name == "service.log" and codecs is None:
+                    # The log must actually be compressed when compression is on offer.
+                    ok = ok and wire < len(data) / 2
+                label = f"{name} {codec or 'raw'}"
+                print(f"  {name:<15} {codec or 'raw':<5} {verdict(ok, label):<6} {len(data) / 1e6:6.1f} MB as "
+                      f"{wire / 1e6:6.1f} MB on the wire in {elapsed:5.2f}s ({len(data) / elapsed / 1e6:6.2f} MB/s effective)")
+        server.stop_server()
+
+        # Uncapped loopback is faster than zlib can compress, so the controller should settle on raw
+        # and the log should leave through sendfile even though the client offered a codec.
+        fast_server = start_server(make_index(directory, data_directory), port + 1)
+        log_hash = hashlib.sha256(log).hexdigest()
+        with FileClient("127.0.0.1", port + 1) as client:
+            for attempt in range(1, 9):
+                buffer = io.BytesIO()
+                client.request({'file_hash': log_hash}, buffer)
+                if hashlib.sha256(buffer.getvalue()).hexdigest() != log_hash or fast_server.sendfile_bytes:
+                    break
+        ok = hashlib.sha256(buffer.getvalue()).hexdigest() == log_hash and fast_server.sendfile_bytes > 0
+        print(f"uncapped, zlib offered: {verdict(ok, 'raw path uses sendfile')}, {fast_server.sendfile_bytes / 1e6:.1f} MB "
+              f"sent with sendfile by pass {attempt}")
+        fast_server.stop_server()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare transfers with and without adaptive compression.")
+    parser.add_argument("--size", type=int, default=32, help="file size in MB")
+    parser.add_argument("--rate", type=float, default=20.0, help="upload cap in MB/s")
+    parser.add_argument("--port", type=int, default=47031)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(7)
+    run(args.size, args.rate * 1e6, args.port)
+    sys.exit(exit_status())
@@ -0,0 +1,82 @@
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.BandwidthScheduler import BandwidthScheduler, DOWNLOAD
+from utils.DeltaDownloader import DeltaDownloader
+from harness import exit_status, indexed_without_rehash, make_index, start_server, verdict
+
+# A remote FileServer shares today's build of an artifact; the local node has yesterday's under the
+# same name. Edits insert, delete and overwrite bytes at random places, so most of the file moves
+# to offsets that no longer line up with fixed chunks. Delta sync should transfer about the edited bytes.
+
+
+def edit(data: bytes, edits: int, edit_size: int) -> bytes:
+    result = bytearray(data)
+    for _ in range(edits):
+        position = random.randrange(len(result))
+        kind = random.choice(("insert", "delete", "overwrite"))
+        if kind == "insert":
+            result[position:position] = os.urandom(edit_size)
+        elif kind == "delete":
+            del result[position:position + edit_size]
+        else:
+            result[position:position + edit_size] = os.urandom(edit_size)
+    return bytes(result)
+
+
+def run(size_mb: int, edits: int, edit_size: int, port: int):
+    root = tempfile.mkdtemp()
+    try:
+        remote_dir, local_dir = os.path.join(root, "remote"), os.path.join(root, "local")
+        os.makedirs(remote_dir)
+        os.makedirs(local_dir)
+        yesterday = os.urandom(size_mb * 1024 * 1024)
+        today = edit(yesterday, edits, edit_size)
+        with open(os.path.join(remote_dir, "nightly.img"), "wb") as f:
+            f.write(today)
+        destination = os.path.join(local_dir, "nightly.img")
+        with open(destination, "wb") as f:
+            f.write(yesterday)
+        today_hash = hashlib.sha256(today).hexdigest()
+
+        server = start_server(make_index(remote_dir, os.path.join(root, "remote-data")), port)
+        local_index = make_index(local_dir, os.path.join(root, "local-data"))
+
+        bandwidth = BandwidthScheduler()
+        sources = [{"peer_ip": "127.0.0.1", "port": port, "transfer_port": port}]
+        started = time.monotonic()
+        ok = DeltaDownloader(sources, today_hash, destination, destination, bandwidth=bandwidth, file_index=local_index).run()
+        elapsed = time.monotonic() - started
+        fetched = bandwidth.limits()[DOWNLOAD]["bytes"]["foreground"]
+        with open(destination, "rb") as f:
+            intact = hashlib.sha256(f.read()).hexdigest() == today_hash
+
+        print(f"{size_mb} MB file, {edits} edits of {edit_size} bytes (inserts, deletes, overwrites)")
+        print(f"delta sync {verdict(ok and intact and fetched < len(today) / 2, 'delta sync')} in {elapsed:.2f}s: {fetched / 1e6:.2f} MB transferred "
+              f"instead of {len(today) / 1e6:.1f} MB ({fetched / len(today) * 100:.1f}%)")
+        print(f"indexed from the rebuilt chunks: {verdict(indexed_without_rehash(local_index, destination, today_hash), 'indexed')}")
+        server.stop_server()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Update a stale local copy of a file by delta sync.")
+    parser.add_argument("--size", type=int, default=256, help="file size in MB")
+    parser.add_argument("--edits", type=int, default=20)
+    parser.add_argument("--edit-size", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=47021)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(7)
+    run(args.size, args.edits, args.edit_size, args.port)
+    sys.exit(exit_status())
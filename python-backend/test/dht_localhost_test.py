@@ -0,0 +1,83 @@
+import argparse
+import hashlib
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.DHT import DHTNode
+
+# Every node is a DHTNode on 127.0.0.1 with its own UDP port, bootstrapped from the first one.
+# Each node announces a few made-up files, then random nodes look them up by hash, by name and
+# by keyword. A flooding query would cost one datagram per node; a lookup should stay near
+# ALPHA * log2(N) RPCs however large the network gets.
+
+
+def run(node_count: int, files_per_node: int, lookups: int, base_port: int):
+    seed = DHTNode(port=base_port, host="127.0.0.1", transfer_port=base_port, discovery_port=base_port)
+    nodes = [seed]
+    for i in range(1, node_count):
+        nodes.append(DHTNode(port=base_port + i, host="127.0.0.1", transfer_port=base_port + i,
+                             discovery_port=base_port + i, bootstrap=[("127.0.0.1", base_port)]))
+    for node in nodes:
+        node.start()
+
+    started = time.monotonic()
+    while time.monotonic() - started < 30 and not all(node.joined for node in nodes[1:]):
+        time.sleep(0.2)
+    table_sizes = [len(node.routing_table) for node in nodes]
+    print(f"{node_count} nodes joined in {time.monotonic() - started:.1f}s, "
+          f"routing table size min/median/max {min(table_sizes)}/{statistics.median(table_sizes):.0f}/{max(table_sizes)}")
+
+    files = []
+    for node in nodes:
+        for j in range(files_per_node):
+            filename = f"holiday photos {node.port} part{j}.jpg"
+            file_hash = hashlib.sha256(filename.encode()).hexdigest()
+            node.announce(file_hash, filename, 1024)
+            files.append((file_hash, filename, node.port))
+    print(f"announced {len(files)} files")
+
+    for mode in ("hash", "name", "keyword"):
+        hits = 0
+        latencies = []
+        rpcs = []
+        rounds = []
+        for _ in range(lookups):
+            file_hash, filename, owner_port = random.choice(files)
+            node = random.choice(nodes)
+            sent_before, rounds_before = node.stats["rpcs_sent"], node.stats["lookup_rounds"]
+            lookup_started = time.monotonic()
+            if mode == "hash":
+                providers = node.find_providers(file_hash)
+            elif mode == "name":
+                providers = node.find_by_name(filename)
+            else:
+                providers = node.search(f"photos {owner_port}")
+            latencies.append(time.monotonic() - lookup_started)
+            rpcs.append(node.stats["rpcs_sent"] - sent_before)
+            rounds.append(node.stats["lookup_rounds"] - rounds_before)
+            if any(p.get("file_hash") == file_hash and p.get("transfer_port") == owner_port for p in providers):
+                hits += 1
+        print(f"{mode:>8}: {hits}/{lookups} found, latency median {statistics.median(latencies) * 1000:.1f}ms "
+              f"max {max(latencies) * 1000:.1f}ms, RPCs per lookup median {statistics.median(rpcs):.0f} "
+              f"max {max(rpcs)}, rounds median {statistics.median(rounds):.0f}")
+
+    for node in nodes:
+        node.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run N DHT nodes on localhost and measure lookups.")
+    parser.add_argument("--nodes", type=int, default=50)
+    parser.add_argument("--files", type=int, default=2, help="files announced per node")
+    parser.add_argument("--lookups", type=int, default=100, help="lookups per mode")
+    parser.add_argument("--port", type=int, default=48000)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    run(args.nodes, args.files, args.lookups, args.port)
@@ -0,0 +1,70 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.DiscoverPeers import DiscoverPeers, BEACON_FIXED, BEACON_ADAPTIVE
+from utils.DiscoveryBackends import DISCOVERY_BROADCAST, DISCOVERY_GOSSIP
+
+# Every node binds its own 127.0.0.x address on the same port. Loopback has no broadcast,
+# so each node's "broadcast address" list is the full node list, which delivers exactly
+# what one subnet broadcast would: a copy of every beacon to every node. In gossip mode the
+# first node is the only bootstrap peer and nothing is broadcast.
+
+
+def run_mode(mode: str, node_count: int, duration: float, port: int, discovery_mode: str):
+    addresses = [f"127.0.0.{i + 2}" for i in range(node_count)]
+    shared_directory = tempfile.mkdtemp(prefix="discovery-bench-")
+    nodes = [
+        DiscoverPeers(port, shared_directory=shared_directory, host=address,
+                      broadcast_addresses=addresses, beacon_mode=mode, discovery_mode=discovery_mode,
+                      bootstrap_peers=[f"{addresses[0]}:{port}"])
+        for address in addresses
+    ]
+    started = time.monotonic()
+    for node in nodes:
+        node.start_beaconing()
+
+    converged_at = None
+    while time.monotonic() - started < duration:
+        time.sleep(0.2)
+        if converged_at is None and all(len(node.peers) == node_count - 1 for node in nodes):
+            converged_at = time.monotonic() - started
+            baseline = sum(node.discovery_stats["datagrams_received"] for node in nodes)
+
+    elapsed = time.monotonic() - started
+    for node in nodes:
+        node.stop_beaconing()
+
+    received = sum(node.discovery_stats["datagrams_received"] for node in nodes)
+    beacons = sum(node.discovery_stats["beacons_sent"] for node in nodes)
+    replies = sum(node.discovery_stats["replies_sent"] for node in nodes)
+    suppressed = sum(node.discovery_stats["replies_suppressed"] for node in nodes)
+    steady_rate = None
+    if converged_at is not None and elapsed > converged_at:
+        steady_rate = (received - baseline) / (elapsed - converged_at) / node_count
+
+    print(f"{mode:>8}: converged in {converged_at:.1f}s" if converged_at is not None else f"{mode:>8}: did not converge")
+    print(f"          datagrams received: {received} total, {received / elapsed / node_count:.1f}/s per node overall"
+          + (f", {steady_rate:.1f}/s per node after convergence" if steady_rate is not None else ""))
+    print(f"          beacons sent: {beacons}, replies sent: {replies}, replies suppressed: {suppressed}")
+    time.sleep(1.5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure discovery packet load for N nodes on loopback.")
+    parser.add_argument("--nodes", type=int, default=30)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--port", type=int, default=47100)
+    parser.add_argument("--modes", nargs="+", default=[BEACON_FIXED, BEACON_ADAPTIVE])
+    parser.add_argument("--discovery", choices=[DISCOVERY_BROADCAST, DISCOVERY_GOSSIP], default=DISCOVERY_BROADCAST)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    print(f"{args.nodes} nodes, {args.discovery} discovery, {args.duration:.0f}s per mode")
+    for offset, mode in enumerate(args.modes):
+        run_mode(mode, args.nodes, args.duration, args.port + offset, args.discovery)
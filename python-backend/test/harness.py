@@ -0,0 +1,54 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.FileIndex import FileIndex
+from utils.FileManager import FileServer
+from utils.ManifestManager import ManifestManager
+
+# Shared scaffolding for the loopback test scripts: an indexed directory, a FileServer that is
+# listening before the script goes on, and a tally of failed checks that becomes the exit status.
+
+failures = []
+
+
+def make_index(directory: str, data_directory: str) -> FileIndex:
+    file_index = FileIndex(directory, index_path=os.path.join(data_directory, "file_index.json"))
+    file_index.refresh()
+    return file_index
+
+
+def start_server(file_index: FileIndex, port: int, bandwidth=None, timeout: float = 5.0) -> FileServer:
+    server = FileServer("127.0.0.1", port, file_index=file_index, bandwidth=bandwidth)
+    threading.Thread(target=server.start_server, daemon=True).start()
+    deadline = time.monotonic() + timeout
+    while not server.running:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"FileServer on port {port} did not start within {timeout}s")
+        time.sleep(0.01)
+    return server
+
+
+def indexed_without_rehash(file_index: FileIndex, file_path: str, file_hash: str) -> bool:
+    # A finished download should already be in the index under a correct manifest, so the watcher's
+    # update_path has nothing left to hash.
+    manifest = file_index.read_manifest(file_hash)
+    return (file_index.get_hash(file_path) == file_hash and manifest is not None
+            and manifest["chunks"] == ManifestManager.generate_file_manifest(file_path)["chunks"]
+            and not file_index.update_path(file_path))
+
+
+def verdict(ok: bool, label: str) -> str:
+    if not ok:
+        failures.append(label)
+    return "ok" if ok else "FAILED"
+
+
+def exit_status() -> int:
+    if failures:
+        print(f"{len(failures)} check(s) failed: {', '.join(failures)}")
+        return 1
+    return 0
@@ -0,0 +1,97 @@
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.ManifestManager import CHUNK_SIZE, ManifestManager
+from utils.PartialDownload import PartialDownload
+from utils.SwarmDownloader import SwarmDownloader
+from harness import exit_status, indexed_without_rehash, make_index, start_server, verdict
+
+# Two FileServers share the same file, but one of them has had a few chunks damaged on disk after
+# it was indexed, so it still offers the file under the good hash. The download should re-fetch
+# those chunks from the healthy peer and hash the file without reading it back. Then a resumed .part
+# file whose bitmap claims chunks that were damaged in the meantime should be repaired before the
+# rename.
+
+
+def corrupt(path: str, chunk_indexes):
+    stat = os.stat(path)
+    with open(path, "r+b") as f:
+        for chunk_index in chunk_indexes:
+            f.seek(chunk_index * CHUNK_SIZE + 100)
+            f.write(os.urandom(64))
+    # Keep the index entry valid so the server goes on offering the damaged copy.
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+
+def check(label: str, downloader: SwarmDownloader, ok: bool, elapsed: float, destination: str, file_hash: str):
+    with open(destination, "rb") as f:
+        intact = hashlib.sha256(f.read()).hexdigest() == file_hash
+    print(f"{label:<32} {verdict(ok and intact, label.rstrip(':'))} in {elapsed:.2f}s, "
+          f"{downloader.reread_bytes / 1e6:.1f} MB read back for the content hash")
+
+
+def run(chunks: int, damaged: int, port: int):
+    root = tempfile.mkdtemp()
+    try:
+        healthy_dir, damaged_dir, local_dir = (os.path.join(root, name) for name in ("healthy", "damaged", "local"))
+        for directory in (healthy_dir, damaged_dir, local_dir):
+            os.makedirs(directory)
+        data = os.urandom(chunks * CHUNK_SIZE + CHUNK_SIZE // 2)
+        file_hash = hashlib.sha256(data).hexdigest()
+        for directory in (healthy_dir, damaged_dir):
+            with open(os.path.join(directory, "dataset.bin"), "wb") as f:
+                f.write(data)
+
+        servers = [start_server(make_index(healthy_dir, os.path.join(root, "healthy-data")), port),
+                   start_server(make_index(damaged_dir, os.path.join(root, "damaged-data")), port + 1)]
+        bad_chunks = random.sample(range(chunks), damaged)
+        corrupt(os.path.join(damaged_dir, "dataset.bin"), bad_chunks)
+        sources = [{"peer_ip": "127.0.0.1", "port": p, "transfer_port": p} for p in (port, port + 1)]
+        print(f"{len(data) / 1e6:.1f} MB in {chunks + 1} chunks, {damaged} damaged on one of two peers")
+
+        destination = os.path.join(local_dir, "dataset.bin")
+        local_index = make_index(local_dir, os.path.join(root, "local-data"))
+        downloader = SwarmDownloader(sources, file_hash, destination, file_index=local_index)
+        started = time.monotonic()
+        ok = downloader.run()
+        check("download with a damaged peer:", downloader, ok, time.monotonic() - started, destination, file_hash)
+        print(f"indexed from the manifest:        {verdict(indexed_without_rehash(local_index, destination, file_hash), 'indexed')}")
+
+        # A finished .part file with a full bitmap, damaged before the download resumes.
+        resumed = os.path.join(local_dir, "resumed.bin")
+        manifest = ManifestManager.generate_file_manifest(destination)
+        shutil.copyfile(destination, resumed + ".part")
+        partial = PartialDownload(resumed, manifest)
+        for chunk_index in range(manifest["chunk_count"]):
+            partial.mark_done(chunk_index)
+        partial.flush()
+        corrupt(resumed + ".part", random.sample(range(chunks), 2))
+        downloader = SwarmDownloader(sources[:1], file_hash, resumed)
+        started = time.monotonic()
+        ok = downloader.run()
+        check("resume of a damaged .part file:", downloader, ok, time.monotonic() - started, resumed, file_hash)
+        for server in servers:
+            server.stop_server()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download from a peer with damaged chunks and resume a damaged .part file.")
+    parser.add_argument("--chunks", type=int, default=64)
+    parser.add_argument("--damaged", type=int, default=6)
+    parser.add_argument("--port", type=int, default=47041)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(11)
+    run(args.chunks, args.damaged, args.port)
+    sys.exit(exit_status())
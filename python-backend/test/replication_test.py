@@ -0,0 +1,107 @@
+import argparse
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.BandwidthScheduler import BandwidthScheduler
+from utils.ChunkStore import ChunkStore
+from utils.ReplicationService import ReplicationService
+from utils.SwarmDownloader import SwarmDownloader
+from harness import exit_status, make_index, start_server, verdict
+
+# A remote FileServer behind a slow upload link shares a catalogue of files. The local node overhears
+# query_file traffic from many peers with Zipf-like popularity and runs replication rounds within a
+# quota. The first local request for a popular file is then compared with and without a replica, and
+# a shift in popularity should evict the replica that went cold.
+
+
+def query(service, names, count: int, requesters: int, hours_ago: float):
+    # Spreads the queries over the hour that ended hours_ago, so popularity decays as it would live.
+    weights = [1 / (rank + 1) for rank in range(len(names))]
+    start = time.monotonic() - (hours_ago + 1) * 3600
+    for i in range(count):
+        service.popularity.record(random.choices(names, weights)[0], f"10.0.0.{random.randrange(requesters)}",
+                                  start + i * 3600 / count)
+
+
+def first_download(sources, file_hash, destination, chunk_store) -> tuple:
+    started = time.monotonic()
+    ok = SwarmDownloader(sources, file_hash, destination, chunk_store=chunk_store).run()
+    with open(destination, "rb") as f:
+        intact = hashlib.sha256(f.read()).hexdigest() == file_hash
+    return ok and intact, time.monotonic() - started
+
+
+def run(files: int, size_mb: int, quota_files: int, rate: float, port: int):
+    root = tempfile.mkdtemp()
+    try:
+        remote_dir, local_dir = os.path.join(root, "remote"), os.path.join(root, "local")
+        os.makedirs(remote_dir)
+        os.makedirs(local_dir)
+        names = [f"video-{i:02d}.bin" for i in range(files)]
+        for name in names:
+            with open(os.path.join(remote_dir, name), "wb") as f:
+                f.write(os.urandom(size_mb * 1024 * 1024))
+        remote_index = make_index(remote_dir, os.path.join(root, "remote-data"))
+        server = start_server(remote_index, port, BandwidthScheduler(upload_rate=rate))
+
+        def find_sources(name):
+            file_hash = remote_index.get_hash_by_name(name)
+            return [{"peer_ip": "127.0.0.1", "port": port, "transfer_port": port, "file_hash": file_hash}] if file_hash else []
+
+        local_index = make_index(local_dir, os.path.join(root, "local-data"))
+        chunk_store = ChunkStore(local_index)
+        quota = quota_files * size_mb * 1024 * 1024 + 1024
+        service = ReplicationService(local_index, find_sources, quota, chunk_store=chunk_store,
+                                     data_directory=os.path.join(root, "local-data"))
+        print(f"{files} files of {size_mb} MB behind a {rate / 1e6:.0f} MB/s link, quota {quota_files} files")
+
+        query(service, names, 2000, 50, 2)
+        started = time.monotonic()
+        while service.replicate_once():
+            pass
+        print(f"replicated in {time.monotonic() - started:.1f}s: {sorted(service.replicas)} "
+              f"{verdict(len(service.replicas) == quota_files and names[0] in service.replicas, 'initial replicas')}")
+        print(f"popular: {[(entry['filename'], entry['score']) for entry in service.status()['popular'][:5]]}")
+
+        for name in (names[0], names[-1]):
+            held = name in service.replicas
+            ok, elapsed = first_download([{"peer_ip": "127.0.0.1", "port": port, "transfer_port": port}],
+                                         remote_index.get_hash_by_name(name), os.path.join(root, f"user-{name}"), chunk_store)
+            print(f"first request for {name} ({'replica held' if held else 'no replica'}): {elapsed:.2f}s "
+                  f"{verdict(ok, f'first request for {name}')}")
+
+        cold = names[0]
+        query(service, list(reversed(names)), 2000, 50, 0)
+        while service.replicate_once():
+            pass
+        print(f"after popularity shifted to the tail: {sorted(service.replicas)} ({cold} "
+              f"{'evicted' if cold not in service.replicas else 'kept'}) "
+              f"{verdict(cold not in service.replicas, 'cold replica evicted')}")
+        status = service.status()
+        print(f"used {status['used_bytes'] / 1e6:.0f} of {quota / 1e6:.0f} MB; replicated {status['replicated']}, "
+              f"evicted {status['evicted']}, failed {status['failed']}")
+        server.stop_server()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replicate popular files within a quota and measure first-request latency.")
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--size", type=int, default=8, help="file size in MB")
+    parser.add_argument("--quota", type=int, default=3, help="quota in files")
+    parser.add_argument("--rate", type=float, default=20.0, help="remote upload cap in MB/s")
+    parser.add_argument("--port", type=int, default=47051)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    random.seed(5)
+    run(args.files, args.size, args.quota, args.rate * 1e6, args.port)
+    sys.exit(exit_status())
@@ -0,0 +1,102 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.WireProtocol import decode_message, encode_message
+
+# Encodes and decodes one representative message of each control type with JSON (what every
+# node spoke before) and with the binary wire format, and prints bytes on the wire and the
+# per-message cost of each.
+
+
+def node_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+
+def sample_messages(peers: int) -> dict:
+    file_hash = hashlib.sha256(b"sample").hexdigest()
+    request_id = uuid.uuid4().hex
+    return {
+        "discover": {
+            "type": "discover", "port": 5003, "node_id": node_id(), "interval": 8.0, "sent_at": time.monotonic(),
+            "known": [node_id() for _ in range(peers)], "dht_port": 5004, "wire": [1]
+        },
+        "discover+gossip": {
+            "type": "discover", "port": 5003, "node_id": node_id(), "interval": 8.0, "sent_at": time.monotonic(),
+            "known": [node_id() for _ in range(peers)], "dht_port": 5004, "wire": [1],
+            "gossip": [[f"192.168.1.{i + 2}", 5003, node_id(), round(i * 0.7, 1), 16.0] for i in range(min(peers, 32))]
+        },
+        "peer_info": {
+            "type": "peer_info", "port": 5003, "node_id": node_id(), "dht_port": 5004, "wire": [1],
+            "echo": time.monotonic(), "held": 0.231
+        },
+        "query_file": {
+            "type": "query_file", "filename": "holiday-photos-2024.zip", "request_id": request_id, "reply_port": 5003
+        },
+        "file_found_response": {
+            "type": "file_found_response", "filename": "holiday-photos-2024.zip", "file_hash": file_hash,
+            "peer_ip": "192.168.1.20", "port": 5003, "transfer_port": 5001, "request_id": request_id
+        },
+        "receive_file": {
+            "type": "receive_file", "file_hash": file_hash, "port": 5003, "request_id": request_id, "reply_port": 5003
+        },
+        "file_offer": {
+            "type": "file_offer", "port": 5003, "file_hash": file_hash, "file_name": "holiday-photos-2024.zip",
+            "file_format": "zip", "size": 734003200, "transfer_port": 5001, "request_id": request_id
+        },
+        "query_files": {
+            "type": "query_files", "query_id": request_id, "request_id": request_id, "reply_port": 5003,
+            "queries": [{"pattern": f"*track{i:02d}*.flac", "match": "glob"} for i in range(20)]
+        },
+        "files_found_response": {
+            "type": "files_found_response", "query_id": request_id, "request_id": request_id,
+            "peer_ip": "192.168.1.20", "port": 5003, "transfer_port": 5001, "part": 0, "parts": 1,
+            "results": [{"query": i % 20, "filename": f"album - track{i:02d}.flac",
+                         "file_hash": hashlib.sha256(str(i).encode()).hexdigest(), "size": 31457280 + i}
+                        for i in range(50)]
+        },
+    }
+
+
+def per_call_us(function, argument, iterations: int, repeats: int = 5) -> float:
+    # Best of several runs, like timeit: the minimum is the least disturbed by other load.
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function(argument)
+        best = min(best, time.perf_counter() - started)
+    return best / iterations * 1e6
+
+
+def run(iterations: int, peers: int):
+    print(f"{'message':<22}{'JSON B':>8}{'bin B':>8}{'ratio':>7}"
+          f"{'JSON enc':>10}{'bin enc':>10}{'JSON dec':>10}{'bin dec':>10}   (microseconds)")
+    totals = [0, 0]
+    for name, message in sample_messages(peers).items():
+        json_bytes = json.dumps(message).encode()
+        binary_bytes = encode_message(message)
+        if decode_message(binary_bytes) != json.loads(json_bytes):
+            print(f"{name}: binary round trip differs from JSON")
+        totals[0] += len(json_bytes)
+        totals[1] += len(binary_bytes)
+        print(f"{name:<22}{len(json_bytes):>8}{len(binary_bytes):>8}{len(binary_bytes) / len(json_bytes):>7.2f}"
+              f"{per_call_us(lambda m: json.dumps(m).encode(), message, iterations):>10.2f}"
+              f"{per_call_us(encode_message, message, iterations):>10.2f}"
+              f"{per_call_us(lambda b: json.loads(b.decode()), json_bytes, iterations):>10.2f}"
+              f"{per_call_us(decode_message, binary_bytes, iterations):>10.2f}")
+    print(f"{'all':<22}{totals[0]:>8}{totals[1]:>8}{totals[1] / totals[0]:>7.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare JSON and binary encoding of discovery control messages.")
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--peers", type=int, default=30, help="peers listed in a beacon's known/gossip fields")
+    args = parser.parse_args()
+    run(args.iterations, args.peers)
@@ -0,0 +1,256 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import partial
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+UPLOAD = "upload"
+DOWNLOAD = "download"
+DIRECTIONS = (UPLOAD, DOWNLOAD)
+
+PRIORITY_FOREGROUND = "foreground"
+PRIORITY_BACKGROUND = "background"
+PRIORITIES = (PRIORITY_FOREGROUND, PRIORITY_BACKGROUND)
+
+BURST_SECONDS = 0.25
+MIN_BURST = 64 * 1024
+MAX_WAIT = 0.5
+IDLE_BUCKET_EXPIRY = 60.0
+
+
+def parse_rate(value) -> Optional[float]:
+    if value is None:
+        return None
+    rate = float(value)
+    if rate < 0:
+        raise ValueError(f"rate must be positive or null, got {value!r}")
+    return rate or None
+
+
+class TokenBucket:
+    def __init__(self, rate: Optional[float]):
+        self.rate: Optional[float] = None
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate: Optional[float]):
+        self.refill(time.monotonic())
+        was_limited = bool(self.rate)
+        self.rate = rate
+        self.capacity = max(rate * BURST_SECONDS, MIN_BURST) if rate else 0.0
+        # A bucket that was unlimited starts full; one that was already limited keeps any debt.
+        self.tokens = min(self.tokens, self.capacity) if was_limited else self.capacity
+
+    def refill(self, now: float):
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        # A grant may overdraw the bucket; the debt is paid off before the next one.
+        if not self.rate:
+            return 0.0
+        self.refill(now)
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def consume(self, byte_count: int):
+        if self.rate:
+            self.tokens -= byte_count
+
+    @property
+    def idle(self) -> bool:
+        return not self.rate or self.tokens >= self.capacity
+
+
+class Ticket:
+    __slots__ = ("size", "granted")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.granted = False
+
+
+class Lane:
+    def __init__(self, direction: str, global_rate: Optional[float], peer_rate: Optional[float]):
+        self.direction = direction
+        self.global_bucket = TokenBucket(global_rate)
+        self.peer_rate = peer_rate
+        self.peer_overrides: Dict[str, Optional[float]] = {}
+        self.peer_buckets: Dict[str, TokenBucket] = {}
+        self.queues: Dict[str, "OrderedDict[str, deque]"] = {priority: OrderedDict() for priority in PRIORITIES}
+        self.bytes_granted: Dict[str, int] = {priority: 0 for priority in PRIORITIES}
+        self.last_pruned = time.monotonic()
+
+    @property
+    def unlimited(self) -> bool:
+        return (self.global_bucket.rate is None and self.peer_rate is None
+                and not any(self.peer_overrides.values()))
+
+    def rate_for(self, peer: str) -> Optional[float]:
+        return self.peer_overrides[peer] if peer in self.peer_overrides else self.peer_rate
+
+    def peer_bucket(self, peer: str) -> TokenBucket:
+        bucket = self.peer_buckets.get(peer)
+        if bucket is None:
+            bucket = self.peer_buckets[peer] = TokenBucket(self.rate_for(peer))
+        return bucket
+
+    def waiting(self) -> int:
+        return sum(len(tickets) for queue in self.queues.values() for tickets in queue.values())
+
+    def prune(self, now: float):
+        if now - self.last_pruned < IDLE_BUCKET_EXPIRY:
+            return
+        self.last_pruned = now
+        queued = {peer for queue in self.queues.values() for peer in queue}
+        for peer, bucket in list(self.peer_buckets.items()):
+            bucket.refill(now)
+            if peer not in queued and bucket.idle:
+                del self.peer_buckets[peer]
+
+    def to_dict(self) -> Dict:
+        return {
+            "global": self.global_bucket.rate,
+            "per_peer": self.peer_rate,
+            "peers": dict(self.peer_overrides),
+            "waiting": self.waiting(),
+            "bytes": dict(self.bytes_granted)
+        }
+
+
+class BandwidthScheduler:
+    def __init__(self, upload_rate: Optional[float] = None, download_rate: Optional[float] = None,
+                 upload_peer_rate: Optional[float] = None, download_peer_rate: Optional[float] = None):
+        self.condition = threading.Condition()
+        self.lanes = {
+            UPLOAD: Lane(UPLOAD, upload_rate, upload_peer_rate),
+            DOWNLOAD: Lane(DOWNLOAD, download_rate, download_peer_rate)
+        }
+
+    def lane(self, direction: str) -> Lane:
+        lane = self.lanes.get(direction)
+        if lane is None:
+            raise ValueError(f"unknown direction {direction!r}")
+        return lane
+
+    def set_global_limit(self, direction: str, rate: Optional[float]):
+        with self.condition:
+            self.lane(direction).global_bucket.set_rate(rate)
+            self.condition.notify_all()
+        logger.info(f"Global {direction} limit set to {self.describe(rate)}.")
+
+    def set_default_peer_limit(self, direction: str, rate: Optional[float]):
+        with self.condition:
+            lane = self.lane(direction)
+            lane.peer_rate = rate
+            for peer, bucket in lane.peer_buckets.items():
+                if peer not in lane.peer_overrides:
+                    bucket.set_rate(rate)
+            self.condition.notify_all()
+        logger.info(f"Per-peer {direction} limit set to {self.describe(rate)}.")
+
+    def set_peer_limit(self, direction: str, peer: str, rate: Optional[float]):
+        with self.condition:
+            lane = self.lane(direction)
+            if rate is None:
+                lane.peer_overrides.pop(peer, None)
+            else:
+                lane.peer_overrides[peer] = rate
+            if peer in lane.peer_buckets:
+                lane.peer_buckets[peer].set_rate(lane.rate_for(peer))
+            self.condition.notify_all()
+        logger.info(f"{direction.capitalize()} limit for {peer} set to {self.describe(rate) if rate is not None else 'the per-peer default'}.")
+
+    def configure(self, limits: Dict):
+        if not isinstance(limits, dict):
+            raise ValueError("expected an object keyed by direction")
+        changes = []
+        for direction, settings in limits.items():
+            self.lane(direction)
+            if not isinstance(settings, dict):
+                raise ValueError(f"limits for {direction!r} must be an object")
+            if "global" in settings:
+                changes.append(partial(self.set_global_limit, direction, parse_rate(settings["global"])))
+            if "per_peer" in settings:
+                changes.append(partial(self.set_default_peer_limit, direction, parse_rate(settings["per_peer"])))
+            for peer, rate in (settings.get("peers") or {}).items():
+                changes.append(partial(self.set_peer_limit, direction, str(peer), parse_rate(rate)))
+        # Everything is validated before any limit changes.
+        for change in changes:
+            change()
+
+    def limits(self) -> Dict:
+        with self.condition:
+            return {direction: lane.to_dict() for direction, lane in self.lanes.items()}
+
+    def acquire(self, direction: str, peer: str, byte_count: int, priority: str = PRIORITY_FOREGROUND):
+        lane = self.lane(direction)
+        if priority not in PRIORITIES:
+            priority = PRIORITY_FOREGROUND
+        if lane.unlimited:
+            with self.condition:
+                lane.bytes_granted[priority] += byte_count
+            return
+        ticket = Ticket(byte_count)
+        with self.condition:
+            lane.queues[priority].setdefault(peer, deque()).append(ticket)
+            while not ticket.granted:
+                delay = self.dispatch(lane)
+                if ticket.granted:
+                    break
+                self.condition.wait(min(delay, MAX_WAIT) if delay is not None else MAX_WAIT)
+
+    async def acquire_async(self, direction: str, peer: str, byte_count: int, priority: str = PRIORITY_FOREGROUND):
+        if self.lane(direction).unlimited:
+            self.acquire(direction, peer, byte_count, priority)
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.acquire, direction, peer, byte_count, priority)
+
+    def dispatch(self, lane: Lane) -> Optional[float]:
+        # Called with the condition held. Foreground is served strictly before background, peers
+        # within a priority take turns one grant at a time, and each grant must fit both the
+        # peer's bucket and the global one.
+        now = time.monotonic()
+        delay = None
+        granted = False
+        for priority in PRIORITIES:
+            queue = lane.queues[priority]
+            blocked_on_global = False
+            progress = True
+            while progress and queue and not blocked_on_global:
+                progress = False
+                for peer in list(queue):
+                    peer_wait = lane.peer_bucket(peer).wait_time(now)
+                    if peer_wait > 0:
+                        delay = peer_wait if delay is None else min(delay, peer_wait)
+                        continue
+                    global_wait = lane.global_bucket.wait_time(now)
+                    if global_wait > 0:
+                        delay = global_wait if delay is None else min(delay, global_wait)
+                        blocked_on_global = True
+                        break
+                    tickets = queue.pop(peer)
+                    ticket = tickets.popleft()
+                    if tickets:
+                        queue[peer] = tickets
+                    lane.peer_bucket(peer).consume(ticket.size)
+                    lane.global_bucket.consume(ticket.size)
+                    lane.bytes_granted[priority] += ticket.size
+                    ticket.granted = True
+                    granted = progress = True
+            if blocked_on_global:
+                break
+        lane.prune(now)
+        if granted:
+            self.condition.notify_all()
+        return delay
+
+    @staticmethod
+    def describe(rate: Optional[float]) -> str:
+        return f"{rate / 1e6:.2f}MB/s" if rate else "unlimited"
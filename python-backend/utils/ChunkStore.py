@@ -0,0 +1,129 @@
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from utils.ManifestManager import ManifestManager
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkStore:
+    def __init__(self, file_index):
+        self.file_index = file_index
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.synced_version: Optional[int] = None
+        # chunk hash -> [(file hash, chunk index)] for every chunk of every indexed file with a cached manifest.
+        self.locations: Dict[str, List[tuple]] = {}
+        # file hash -> (size, chunk size), enough to find a chunk's bytes; the chunk list stays in the manifest on disk.
+        self.file_layouts: Dict[str, tuple] = {}
+        self.stats = {"chunks_reused": 0, "bytes_reused": 0, "stale_locations": 0}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.locations)
+
+    def sync(self, wait: bool = True):
+        # Brings the chunk map up to date with the file index. Without wait, a caller that finds a sync
+        # already running goes ahead with the map as it is.
+        if not self.sync_lock.acquire(blocking=wait):
+            return
+        try:
+            version = self.file_index.version
+            if version == self.synced_version:
+                return
+            started = time.monotonic()
+            live = set(self.file_index.hashes())
+            with self.lock:
+                known = set(self.file_layouts)
+                if known - live:
+                    self.forget(known - live)
+            added = 0
+            for file_hash in live - known:
+                manifest = self.file_index.read_manifest(file_hash)
+                if manifest is not None:
+                    with self.lock:
+                        self.learn(manifest)
+                    added += 1
+            self.synced_version = version
+            if added or known - live:
+                logger.info(f"Chunk map synced in {time.monotonic() - started:.2f}s: {len(self.file_layouts)} files, "
+                            f"{len(self.locations)} distinct chunks ({added} files added, {len(known - live)} removed).")
+        finally:
+            self.sync_lock.release()
+
+    def learn(self, manifest: Dict):
+        file_hash = manifest["sha256"]
+        self.file_layouts[file_hash] = (manifest["size"], manifest["chunk_size"])
+        for index, chunk_hash, _, _ in ManifestManager.iter_chunks(manifest):
+            self.locations.setdefault(chunk_hash, []).append((file_hash, index))
+
+    def forget(self, file_hashes: Set[str]):
+        # The index prunes a removed file's manifest before the map hears of it, so instead of reading
+        # chunk lists back, one pass over the map drops every location of the removed files.
+        for file_hash in file_hashes:
+            self.file_layouts.pop(file_hash, None)
+        for chunk_hash, locations in list(self.locations.items()):
+            holders = [location for location in locations if location[0] not in file_hashes]
+            if not holders:
+                del self.locations[chunk_hash]
+            elif len(holders) != len(locations):
+                self.locations[chunk_hash] = holders
+
+    def has_chunk(self, chunk_hash: str) -> bool:
+        with self.lock:
+            return chunk_hash in self.locations
+
+    def local_chunks(self, chunk_hashes: List[str]) -> Set[str]:
+        with self.lock:
+            return {chunk_hash for chunk_hash in chunk_hashes if chunk_hash in self.locations}
+
+    def read_chunk(self, chunk_hash: str) -> Optional[bytes]:
+        with self.lock:
+            holders = [(location, self.file_layouts[location[0]]) for location in self.locations.get(chunk_hash, ())]
+        for (file_hash, index), (size, chunk_size) in holders:
+            file_path = self.file_index.get_path(file_hash)
+            if file_path is None:
+                continue
+            offset = index * chunk_size
+            length = min(chunk_size, size - offset)
+            try:
+                with open(file_path, "rb") as f:
+                    data = os.pread(f.fileno(), length, offset)
+            except OSError as e:
+                logger.debug(f"Could not read chunk {chunk_hash} from {file_path}: {e}")
+                continue
+            # The file may have changed since it was indexed; only bytes that still hash right are used.
+            if ManifestManager.hash_chunk(data) == chunk_hash:
+                return data
+            with self.lock:
+                self.stats["stale_locations"] += 1
+        return None
+
+    def copy_chunks(self, manifest: Dict, chunk_indexes: List[int], destination) -> List[int]:
+        # Writes every wanted chunk that some local file already holds into destination at its offset,
+        # and returns the indexes that were filled.
+        self.sync(wait=False)
+        wanted = self.local_chunks([manifest["chunks"][index] for index in chunk_indexes])
+        copied = []
+        copied_bytes = 0
+        for index in chunk_indexes:
+            chunk_hash = manifest["chunks"][index]
+            if chunk_hash not in wanted:
+                continue
+            data = self.read_chunk(chunk_hash)
+            if data is None:
+                continue
+            offset, _ = ManifestManager.chunk_range(manifest, index)
+            os.pwrite(destination.fileno(), data, offset)
+            copied.append(index)
+            copied_bytes += len(data)
+        if copied:
+            with self.lock:
+                self.stats["chunks_reused"] += len(copied)
+                self.stats["bytes_reused"] += copied_bytes
+            logger.info(f"Assembled {len(copied)}/{manifest['chunk_count']} chunks ({copied_bytes / 1e6:.1f} MB) of "
+                        f"{manifest['filename']} from local files.")
+        return copied
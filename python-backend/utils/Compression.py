@@ -0,0 +1,158 @@
+import logging
+import math
+import os
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+COMPRESSED_EXTENSIONS = frozenset((
+    "7z", "aac", "apk", "avi", "br", "bz2", "deb", "docx", "epub", "flac", "gif", "gz", "heic", "jar", "jpeg",
+    "jpg", "lz", "lz4", "lzma", "m4a", "m4v", "mkv", "mov", "mp3", "mp4", "odp", "ods", "odt", "ogg", "opus",
+    "png", "pptx", "rar", "rpm", "tgz", "txz", "webm", "webp", "whl", "woff", "woff2", "xlsx", "xz", "zip", "zst"
+))
+MIN_COMPRESSIBLE_SIZE = 4 * 1024
+ENTROPY_SAMPLES = 4
+ENTROPY_SAMPLE_SIZE = 16 * 1024
+ENTROPY_LIMIT = 7.5
+MIN_SAVING = 0.05
+INCOMPRESSIBLE_STREAK = 4
+LEVELS = (1, 3, 6, 9)
+WINDOW_SECONDS = 0.25
+PROBE_SECONDS = 10.0
+
+
+class Codec(ABC):
+    name = ""
+
+    @abstractmethod
+    def compress(self, data, level: int) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data, max_size: int) -> bytes:
+        pass
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+
+    def compress(self, data, level: int) -> bytes:
+        return zlib.compress(data, level)
+
+    def decompress(self, data, max_size: int) -> bytes:
+        decompressor = zlib.decompressobj()
+        try:
+            output = decompressor.decompress(data, max_size)
+        except zlib.error as e:
+            raise ValueError(f"corrupt zlib chunk: {e}")
+        # Each chunk is a complete stream; anything left over means it would expand past max_size.
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError(f"zlib chunk is truncated or expands past {max_size} bytes")
+        return output
+
+
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+def supported_codecs() -> List[str]:
+    return list(CODECS)
+
+
+def negotiate_codec(offered) -> Optional[Codec]:
+    # The requester lists codecs in order of preference; the first one we also have wins.
+    if not isinstance(offered, list):
+        return None
+    for name in offered:
+        if isinstance(name, str) and name in CODECS:
+            return CODECS[name]
+    return None
+
+
+register_codec(ZlibCodec())
+
+
+def byte_entropy(data) -> float:
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def looks_compressible(f, file_path: str, size: int) -> bool:
+    if size < MIN_COMPRESSIBLE_SIZE:
+        return False
+    extension = os.path.splitext(file_path)[1].lower().lstrip(".")
+    if extension in COMPRESSED_EXTENSIONS:
+        return False
+    # A few samples spread over the file; compressed or encrypted data sits close to 8 bits per byte.
+    step = max((size - ENTROPY_SAMPLE_SIZE) // max(ENTROPY_SAMPLES - 1, 1), 1)
+    samples = [os.pread(f.fileno(), ENTROPY_SAMPLE_SIZE, min(i * step, max(size - ENTROPY_SAMPLE_SIZE, 0)))
+               for i in range(ENTROPY_SAMPLES)]
+    return byte_entropy(b"".join(samples)) < ENTROPY_LIMIT
+
+
+class LevelController:
+    # One per connection. Sending raw and the zlib levels are steps on one scale, and the controller
+    # hill-climbs it on measured throughput: raw bytes delivered per second of compressing plus sending.
+    # Per-chunk send times alone say little, because the bandwidth bucket refills while a chunk is
+    # being compressed. A neighbouring step is measured again once its last measurement is stale.
+    def __init__(self):
+        self.step = 1
+        self.rates: Dict[int, tuple] = {}
+        self.window = [0, 0.0]
+        self.warmed_up = False
+        self.incompressible = 0
+        self.stats = {"raw_bytes": 0, "wire_bytes": 0}
+
+    @property
+    def level(self) -> int:
+        return LEVELS[self.step - 1] if self.step else 0
+
+    def should_compress(self) -> bool:
+        return self.step > 0
+
+    def record(self, raw_size: int, wire_size: int, seconds: float):
+        self.stats["raw_bytes"] += raw_size
+        self.stats["wire_bytes"] += wire_size
+        if self.step:
+            self.incompressible = self.incompressible + 1 if wire_size >= raw_size * (1 - MIN_SAVING) else 0
+            if self.incompressible >= INCOMPRESSIBLE_STREAK:
+                self.rates[self.step] = (0.0, time.monotonic())
+                self.move(0)
+                return
+        self.window[0] += raw_size
+        self.window[1] += seconds
+        if self.window[1] < WINDOW_SECONDS:
+            return
+        rate = self.window[0] / self.window[1]
+        self.window = [0, 0.0]
+        # The first window after a change still drains socket buffers and bandwidth bursts.
+        if not self.warmed_up:
+            self.warmed_up = True
+            return
+        now = time.monotonic()
+        self.rates[self.step] = (rate, now)
+        fresh = {step: rate for step, (rate, measured) in self.rates.items() if now - measured < PROBE_SECONDS}
+        neighbours = [step for step in (self.step - 1, self.step + 1) if 0 <= step <= len(LEVELS)]
+        for step in neighbours:
+            if step not in fresh:
+                self.move(step)
+                return
+        best = max([self.step] + neighbours, key=fresh.get)
+        if best != self.step:
+            self.move(best)
+
+    def move(self, step: int):
+        logger.debug(f"Compression level {self.level} -> {LEVELS[step - 1] if step else 0}, rates {self.rates}")
+        self.step = step
+        self.window = [0, 0.0]
+        self.warmed_up = False
+        self.incompressible = 0
@@ -0,0 +1,517 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+ID_BITS = 160
+K = 20
+ALPHA = 3
+RPC_TIMEOUT = 1.0
+MAX_DATAGRAM_SIZE = 65535
+RECORD_TTL = 3600.0
+REPUBLISH_INTERVAL = 1200.0
+PUBLISH_CHECK_INTERVAL = 10.0
+BUCKET_REFRESH_INTERVAL = 900.0
+SEED_PING_INTERVAL = 60.0
+MAX_PROVIDERS_PER_KEY = 200
+MAX_PROVIDERS_PER_REPLY = 50
+MAX_KEYWORDS_PER_FILE = 8
+MIN_KEYWORD_LENGTH = 3
+MAX_CONCURRENT_LOOKUPS = 16
+MAX_ANNOUNCE_LOOKUPS_PER_PASS = 500
+KEYWORD_SPLIT = re.compile(r"[^0-9a-z]+")
+
+
+def key_for(namespace: str, value: str) -> int:
+    return int.from_bytes(hashlib.sha1(f"{namespace}:{value}".encode()).digest(), "big")
+
+
+def content_key(file_hash: str) -> int:
+    return key_for("hash", file_hash)
+
+
+def name_key(filename: str) -> int:
+    return key_for("name", filename.lower())
+
+
+def keyword_key(keyword: str) -> int:
+    return key_for("kw", keyword)
+
+
+def filename_keywords(filename: str) -> List[str]:
+    stem = os.path.splitext(filename.lower())[0]
+    keywords = []
+    for token in KEYWORD_SPLIT.split(stem):
+        if len(token) >= MIN_KEYWORD_LENGTH and token not in keywords:
+            keywords.append(token)
+    return keywords[:MAX_KEYWORDS_PER_FILE]
+
+
+def resolve(future: Future, result) -> bool:
+    # A reply and its timeout can race; whichever lands first wins.
+    try:
+        future.set_result(result)
+        return True
+    except InvalidStateError:
+        return False
+
+
+class Contact:
+    __slots__ = ("id", "ip", "port", "last_seen", "failures")
+
+    def __init__(self, node_id: int, ip: str, port: int):
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+        self.last_seen = time.monotonic()
+        self.failures = 0
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.ip, self.port
+
+    def to_wire(self) -> list:
+        return [format(self.id, "040x"), self.ip, self.port]
+
+
+class RoutingTable:
+    def __init__(self, own_id: int, k: int = K):
+        self.own_id = own_id
+        self.k = k
+        self.buckets: List[List[Contact]] = [[] for _ in range(ID_BITS)]
+        self.replacements: List[List[Contact]] = [[] for _ in range(ID_BITS)]
+        self.refreshed_at = [time.monotonic()] * ID_BITS
+        self.lock = threading.Lock()
+
+    def bucket_index(self, node_id: int) -> int:
+        return max((node_id ^ self.own_id).bit_length() - 1, 0)
+
+    def add(self, contact: Contact):
+        if contact.id == self.own_id:
+            return
+        index = self.bucket_index(contact.id)
+        with self.lock:
+            bucket = self.buckets[index]
+            self.refreshed_at[index] = time.monotonic()
+            for i, existing in enumerate(bucket):
+                if existing.id == contact.id:
+                    # Least recently seen at the head, most recently seen at the tail.
+                    bucket.pop(i)
+                    existing.ip, existing.port = contact.ip, contact.port
+                    existing.last_seen = time.monotonic()
+                    existing.failures = 0
+                    bucket.append(existing)
+                    return
+            if len(bucket) < self.k:
+                bucket.append(contact)
+                return
+            replacements = self.replacements[index]
+            replacements[:] = [c for c in replacements if c.id != contact.id][-(self.k - 1):] + [contact]
+
+    def remove(self, node_id: int):
+        index = self.bucket_index(node_id)
+        with self.lock:
+            bucket = self.buckets[index]
+            remaining = [c for c in bucket if c.id != node_id]
+            if len(remaining) == len(bucket):
+                return
+            bucket[:] = remaining
+            if self.replacements[index]:
+                bucket.append(self.replacements[index].pop())
+
+    def record_failure(self, node_id: int, max_failures: int = 2):
+        with self.lock:
+            contact = next((c for c in self.buckets[self.bucket_index(node_id)] if c.id == node_id), None)
+            if contact is None:
+                return
+            contact.failures += 1
+            failed = contact.failures >= max_failures
+        if failed:
+            self.remove(node_id)
+
+    def closest(self, target: int, count: int = K, exclude: Optional[int] = None) -> List[Contact]:
+        with self.lock:
+            contacts = [c for bucket in self.buckets for c in bucket if c.id != exclude]
+        contacts.sort(key=lambda c: c.id ^ target)
+        return contacts[:count]
+
+    def stale_buckets(self, max_age: float) -> List[int]:
+        now = time.monotonic()
+        with self.lock:
+            return [i for i, bucket in enumerate(self.buckets) if bucket and now - self.refreshed_at[i] > max_age]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets)
+
+
+class DHTNode:
+    def __init__(self, port: int = 0, host: str = "0.0.0.0", file_index=None, transfer_port: Optional[int] = None,
+                 discovery_port: Optional[int] = None, bootstrap: Optional[List[Tuple[str, int]]] = None):
+        self.node_id = int.from_bytes(hashlib.sha1(uuid.uuid4().bytes).digest(), "big")
+        self.file_index = file_index
+        self.transfer_port = transfer_port
+        self.discovery_port = discovery_port
+        self.bootstrap = list(bootstrap or [])
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.settimeout(1.0)
+        self.port = self.sock.getsockname()[1]
+
+        self.routing_table = RoutingTable(self.node_id)
+        self.pending: Dict[str, Tuple[Future, Optional[int]]] = {}
+        self.pending_lock = threading.Lock()
+        self.storage: Dict[int, Dict[str, Dict]] = {}
+        self.storage_lock = threading.Lock()
+        self.published: Dict[str, float] = {}
+        self.seeded: Dict[Tuple[str, int], float] = {}
+        self.joined = False
+        self.stop_event = threading.Event()
+        self.lookup_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOOKUPS, thread_name_prefix="DHTLookup")
+        self.stats = {"rpcs_sent": 0, "rpcs_received": 0, "timeouts": 0, "lookups": 0, "lookup_rounds": 0}
+
+    def start(self):
+        self.stop_event.clear()
+        threading.Thread(target=self.receive_loop, daemon=True).start()
+        threading.Thread(target=self.maintenance_loop, daemon=True).start()
+        logger.info(f"DHT node {format(self.node_id, '040x')[:12]} listening on UDP {self.port}.")
+
+    def stop(self):
+        self.stop_event.set()
+        self.lookup_pool.shutdown(wait=False, cancel_futures=True)
+        self.sock.close()
+
+    # Wire protocol
+
+    def send(self, address: Tuple[str, int], message: Dict):
+        message["sender"] = format(self.node_id, "040x")
+        try:
+            self.sock.sendto(json.dumps(message).encode(), address)
+            self.stats["rpcs_sent"] += 1
+        except OSError as e:
+            logger.debug(f"DHT send to {address[0]}:{address[1]} failed: {e}")
+
+    def request(self, contact_address: Tuple[str, int], message: Dict, node_id: Optional[int] = None) -> Future:
+        rid = uuid.uuid4().hex[:16]
+        future: Future = Future()
+        future.dht_rid = rid
+        future.dht_node_id = node_id
+        future.dht_sent_at = time.monotonic()
+        with self.pending_lock:
+            self.pending[rid] = (future, node_id)
+        message["rid"] = rid
+        self.send(contact_address, message)
+        return future
+
+    def expire_request(self, future: Future):
+        with self.pending_lock:
+            self.pending.pop(future.dht_rid, None)
+        if resolve(future, None):
+            self.stats["timeouts"] += 1
+            if future.dht_node_id is not None:
+                self.routing_table.record_failure(future.dht_node_id)
+
+    def receive_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                data, addr = self.sock.recvfrom(MAX_DATAGRAM_SIZE)
+                message = json.loads(data.decode())
+                sender_id = int(message["sender"], 16)
+            except socket.timeout:
+                continue
+            except (ValueError, KeyError, TypeError):
+                continue
+            except OSError as e:
+                if not self.stop_event.is_set():
+                    logger.warning(f"DHT socket error: {e}")
+                continue
+            self.stats["rpcs_received"] += 1
+            self.routing_table.add(Contact(sender_id, addr[0], addr[1]))
+            try:
+                self.handle_message(message, addr)
+            except Exception as e:
+                logger.warning(f"Error handling DHT message from {addr[0]}:{addr[1]}: {e}")
+
+    def handle_message(self, message: Dict, addr):
+        kind = message.get("dht")
+        if kind == "response":
+            with self.pending_lock:
+                pending = self.pending.pop(message.get("rid"), None)
+            if pending is not None:
+                resolve(pending[0], message)
+            return
+
+        reply = {"dht": "response", "rid": message.get("rid")}
+        if kind == "ping":
+            pass
+        elif kind == "find_node":
+            reply["nodes"] = self.closest_wire(int(message["target"], 16))
+        elif kind == "find_value":
+            key = int(message["key"], 16)
+            providers = self.get_providers(key)
+            if providers:
+                reply["providers"] = providers[:MAX_PROVIDERS_PER_REPLY]
+            else:
+                reply["nodes"] = self.closest_wire(key)
+        elif kind == "store":
+            self.store_record(int(message["key"], 16), message.get("record", {}), addr[0])
+            if not message.get("rid"):
+                return
+        else:
+            return
+        self.send(addr, reply)
+
+    def closest_wire(self, target: int) -> List[list]:
+        return [contact.to_wire() for contact in self.routing_table.closest(target)]
+
+    # Storage
+
+    def store_record(self, key: int, record: Dict, sender_ip: str):
+        if not isinstance(record, dict) or not record.get("file_hash"):
+            return
+        # The provider address is the one the STORE came from, not whatever the record claims.
+        record = {
+            "peer_ip": sender_ip,
+            "port": record.get("port"),
+            "transfer_port": record.get("transfer_port"),
+            "file_hash": record["file_hash"],
+            "filename": record.get("filename"),
+            "size": record.get("size"),
+            "expires_at": time.time() + RECORD_TTL
+        }
+        provider_key = f"{record['peer_ip']}:{record['transfer_port']}:{record['file_hash']}"
+        with self.storage_lock:
+            providers = self.storage.setdefault(key, {})
+            if provider_key not in providers and len(providers) >= MAX_PROVIDERS_PER_KEY:
+                oldest = min(providers, key=lambda k: providers[k]["expires_at"])
+                del providers[oldest]
+            providers[provider_key] = record
+
+    def get_providers(self, key: int) -> List[Dict]:
+        now = time.time()
+        with self.storage_lock:
+            providers = self.storage.get(key)
+            if not providers:
+                return []
+            for provider_key in [k for k, record in providers.items() if record["expires_at"] < now]:
+                del providers[provider_key]
+            if not providers:
+                del self.storage[key]
+                return []
+            return [{k: v for k, v in record.items() if k != "expires_at"} for record in providers.values()]
+
+    # Lookups
+
+    def lookup(self, target: int, find_value: bool = False) -> Tuple[List[Contact], List[Dict]]:
+        self.stats["lookups"] += 1
+        shortlist: Dict[int, Contact] = {c.id: c for c in self.routing_table.closest(target)}
+        if not shortlist:
+            for address in self.bootstrap:
+                self.ping(address)
+            shortlist = {c.id: c for c in self.routing_table.closest(target)}
+        queried = set()
+        responded = set()
+        in_flight: Dict[Future, Contact] = {}
+        providers: Dict[str, Dict] = {}
+
+        while True:
+            closest = sorted(shortlist.values(), key=lambda c: c.id ^ target)[:K]
+            candidates = [c for c in closest if c.id not in queried]
+            if not candidates and not in_flight:
+                break
+            # Stop as soon as a value is found, once nothing better is still outstanding.
+            if find_value and providers and not in_flight:
+                break
+            while candidates and len(in_flight) < ALPHA:
+                contact = candidates.pop(0)
+                queried.add(contact.id)
+                message = {"dht": "find_value", "key": format(target, "040x")} if find_value else \
+                    {"dht": "find_node", "target": format(target, "040x")}
+                in_flight[self.request(contact.address, message, contact.id)] = contact
+            if not in_flight:
+                break
+
+            self.stats["lookup_rounds"] += 1
+            oldest = min(future.dht_sent_at for future in in_flight)
+            done, _ = wait(list(in_flight), timeout=max(RPC_TIMEOUT - (time.monotonic() - oldest), 0.01),
+                           return_when=FIRST_COMPLETED)
+            for future in [f for f in in_flight if not f.done() and time.monotonic() - f.dht_sent_at >= RPC_TIMEOUT]:
+                self.expire_request(future)
+                done.add(future)
+
+            for future in done:
+                contact = in_flight.pop(future)
+                reply = future.result()
+                if reply is None:
+                    shortlist.pop(contact.id, None)
+                    continue
+                responded.add(contact.id)
+                for record in reply.get("providers", []):
+                    if isinstance(record, dict) and record.get("file_hash"):
+                        providers[f"{record.get('peer_ip')}:{record.get('transfer_port')}:{record['file_hash']}"] = record
+                for wire in reply.get("nodes", []):
+                    try:
+                        node_id, ip, port = int(wire[0], 16), wire[1], int(wire[2])
+                    except (ValueError, TypeError, IndexError):
+                        continue
+                    if node_id != self.node_id and node_id not in shortlist:
+                        shortlist[node_id] = Contact(node_id, ip, port)
+
+        contacts = sorted((c for c in shortlist.values() if c.id in responded), key=lambda c: c.id ^ target)[:K]
+        return contacts, list(providers.values())
+
+    def ping(self, address: Tuple[str, int], timeout: float = RPC_TIMEOUT) -> bool:
+        future = self.request(address, {"dht": "ping"})
+        try:
+            reply = future.result(timeout=timeout)
+        except Exception:
+            reply = None
+        if reply is None:
+            self.expire_request(future)
+        return reply is not None
+
+    def add_seed(self, ip: str, port: int):
+        if ":" in ip:
+            return
+        now = time.monotonic()
+        if now - self.seeded.get((ip, port), -SEED_PING_INTERVAL) < SEED_PING_INTERVAL:
+            return
+        self.seeded[(ip, port)] = now
+        # The reply lands in the routing table through receive_loop; nobody waits on it.
+        self.send((ip, port), {"dht": "ping"})
+
+    def join(self):
+        for address in self.bootstrap:
+            self.ping(address)
+        if len(self.routing_table):
+            # Looking up our own id fills the buckets near us and tells those nodes we exist.
+            self.lookup(self.node_id)
+            self.joined = True
+
+    # Publishing and searching
+
+    def file_record(self, file_hash: str, filename: str, size: Optional[int]) -> Dict:
+        return {
+            "port": self.discovery_port,
+            "transfer_port": self.transfer_port,
+            "file_hash": file_hash,
+            "filename": filename,
+            "size": size
+        }
+
+    @staticmethod
+    def file_keys(file_hash: str, filename: str) -> List[int]:
+        return [content_key(file_hash), name_key(filename)] + [keyword_key(word) for word in filename_keywords(filename)]
+
+    def announce(self, file_hash: str, filename: str, size: Optional[int] = None):
+        record = self.file_record(file_hash, filename, size)
+        self.store_records({key: [record] for key in self.file_keys(file_hash, filename)})
+
+    def store_records(self, batch: Dict[int, List[Dict]]):
+        # One lookup per distinct key, up to MAX_CONCURRENT_LOOKUPS at a time; every record for the key
+        # goes to the contacts that lookup found.
+        def store(key: int, records: List[Dict]):
+            contacts, _ = self.lookup(key)
+            for contact in contacts:
+                for record in records:
+                    self.send(contact.address, {"dht": "store", "key": format(key, "040x"), "record": record})
+
+        futures = [self.lookup_pool.submit(store, key, records) for key, records in batch.items()]
+        for future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                if not self.stop_event.is_set():
+                    logger.warning(f"DHT store failed: {e}")
+
+    def find_providers(self, file_hash: str) -> List[Dict]:
+        _, providers = self.lookup(content_key(file_hash), find_value=True)
+        return [p for p in providers if p.get("file_hash") == file_hash]
+
+    def find_by_name(self, filename: str) -> List[Dict]:
+        _, providers = self.lookup(name_key(filename), find_value=True)
+        return [p for p in providers if (p.get("filename") or "").lower() == filename.lower()]
+
+    def search(self, query: str) -> List[Dict]:
+        keywords = filename_keywords(query)
+        if not keywords:
+            return self.find_by_name(query)
+        # A common keyword's reply is capped, so results are pooled from every keyword and then
+        # filtered locally; the rarest keyword is the one that actually finds the file.
+        matches = {}
+        for keyword in keywords[:3]:
+            _, providers = self.lookup(keyword_key(keyword), find_value=True)
+            for p in providers:
+                if all(word in filename_keywords(p.get("filename") or "") for word in keywords):
+                    matches[f"{p.get('peer_ip')}:{p.get('transfer_port')}:{p.get('file_hash')}"] = p
+        return list(matches.values())
+
+    # Maintenance
+
+    def local_files(self) -> List[Tuple[str, str, int]]:
+        if self.file_index is None:
+            return []
+        _, listing = self.file_index.files()
+        return list({f["hash"]: (f["hash"], f["filename"], f["size"]) for f in listing}.values())
+
+    def publish_local_files(self):
+        now = time.monotonic()
+        current = self.local_files()
+        # Files never announced go first, then the longest overdue. Files sharing a keyword share its
+        # lookup, and a pass stops at MAX_ANNOUNCE_LOOKUPS_PER_PASS lookups; the rest wait for the next one.
+        due = sorted((self.published.get(f"{file_hash}:{filename}", float("-inf")), file_hash, filename, size)
+                     for file_hash, filename, size in current
+                     if now - self.published.get(f"{file_hash}:{filename}", -REPUBLISH_INTERVAL) >= REPUBLISH_INTERVAL)
+        batch: Dict[int, List[Dict]] = {}
+        announced = []
+        for _, file_hash, filename, size in due:
+            keys = self.file_keys(file_hash, filename)
+            new_keys = sum(1 for key in keys if key not in batch)
+            if announced and len(batch) + new_keys > MAX_ANNOUNCE_LOOKUPS_PER_PASS:
+                break
+            record = self.file_record(file_hash, filename, size)
+            for key in keys:
+                records = batch.setdefault(key, [])
+                # A node keeps at most MAX_PROVIDERS_PER_KEY records per key, so more would only churn its storage.
+                if len(records) < MAX_PROVIDERS_PER_KEY:
+                    records.append(record)
+            announced.append(f"{file_hash}:{filename}")
+        if batch:
+            self.store_records(batch)
+        if self.stop_event.is_set():
+            return
+        for key in announced:
+            self.published[key] = now
+        live = {f"{file_hash}:{filename}" for file_hash, filename, _ in current}
+        for key in [k for k in self.published if k not in live]:
+            del self.published[key]
+        if announced:
+            logger.info(f"DHT announced {len(announced)} file(s) with {len(batch)} lookup(s); {len(due) - len(announced)} "
+                        f"wait for a later pass; routing table holds {len(self.routing_table)} contact(s).")
+
+    def maintenance_loop(self):
+        self.join()
+        while not self.stop_event.wait(PUBLISH_CHECK_INTERVAL):
+            try:
+                # Without bootstrap nodes the first contacts arrive later, seeded by discovery beacons.
+                if not self.joined or len(self.routing_table) == 0:
+                    self.join()
+                if not self.joined:
+                    continue
+                for index in self.routing_table.stale_buckets(BUCKET_REFRESH_INTERVAL):
+                    self.lookup(self.node_id ^ ((1 << index) | random.getrandbits(index)))
+                self.publish_local_files()
+            except Exception as e:
+                logger.error(f"DHT maintenance failed: {e}", exc_info=True)
@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+from typing import Callable, Dict, List, Optional
+
+from utils.BandwidthScheduler import PRIORITY_FOREGROUND
+from utils.FileManager import FileClient
+from utils.ManifestManager import CHUNK_SIZE, ManifestManager
+from utils.PartialDownload import PART_SUFFIX
+from utils.TransferProtocol import TransferError
+
+logger = logging.getLogger(__name__)
+
+DELTA_SUFFIX = ".delta" + PART_SUFFIX
+MAX_DELTA_SOURCES = 2
+
+
+class ChunkHashingWriter:
+    # Hashes manifest chunks from the bytes on their way to disk; the delta is rebuilt front to back,
+    # so the finished file can be indexed without reading it again.
+    def __init__(self, f):
+        self.f = f
+        self.pending = bytearray()
+        self.chunks: List[str] = []
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+        view = memoryview(data)
+        if self.pending:
+            taken = min(CHUNK_SIZE - len(self.pending), len(view))
+            self.pending += view[:taken]
+            view = view[taken:]
+            if len(self.pending) < CHUNK_SIZE:
+                return
+            self.chunks.append(ManifestManager.hash_chunk(self.pending))
+            self.pending = bytearray()
+        whole = len(view) - len(view) % CHUNK_SIZE
+        for start in range(0, whole, CHUNK_SIZE):
+            self.chunks.append(ManifestManager.hash_chunk(view[start:start + CHUNK_SIZE]))
+        self.pending += view[whole:]
+
+    def manifest(self, file_hash: str, filename: str) -> Dict:
+        chunks = self.chunks + ([ManifestManager.hash_chunk(self.pending)] if self.pending else [])
+        return {
+            "filename": filename,
+            "size": self.size,
+            "sha256": file_hash,
+            "chunk_size": CHUNK_SIZE,
+            "chunk_count": len(chunks),
+            "chunks": chunks
+        }
+
+
+class DeltaDownloader:
+    def __init__(self, sources: List[Dict], file_hash: str, destination_path: str, basis_path: str,
+                 progress_callback: Optional[Callable[[int, int], None]] = None,
+                 cancel_event: Optional[threading.Event] = None,
+                 bandwidth=None, priority: str = PRIORITY_FOREGROUND, file_index=None):
+        self.sources = sources
+        self.file_hash = file_hash
+        self.destination_path = destination_path
+        self.basis_path = basis_path
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event or threading.Event()
+        self.bandwidth = bandwidth
+        self.priority = priority
+        self.file_index = file_index
+        self.temp_path = destination_path + DELTA_SUFFIX
+
+    def run(self) -> bool:
+        try:
+            for source in self.sources[:MAX_DELTA_SOURCES]:
+                if self.cancel_event.is_set():
+                    return False
+                if self.fetch_from(source):
+                    return True
+            return False
+        finally:
+            try:
+                os.remove(self.temp_path)
+            except FileNotFoundError:
+                pass
+
+    def fetch_from(self, source: Dict) -> bool:
+        client = FileClient(source['peer_ip'], source['transfer_port'], bandwidth=self.bandwidth, priority=self.priority)
+        try:
+            with open(self.temp_path, 'wb') as f:
+                writer = ChunkHashingWriter(f)
+                result = client.request_delta(self.file_hash, self.basis_path, writer, self.cancel_event, self.progress_callback)
+                f.flush()
+                os.fsync(f.fileno())
+        except (OSError, TransferError, ValueError) as e:
+            logger.warning(f"Delta sync of {self.file_hash} from {source['peer_ip']} failed: {e}")
+            return False
+        finally:
+            client.close()
+
+        if result['sha256'] != self.file_hash:
+            logger.warning(f"Delta from {source['peer_ip']} rebuilt content with hash {result['sha256']}, expected {self.file_hash}. Discarding it.")
+            return False
+        os.replace(self.temp_path, self.destination_path)
+        if self.file_index is not None:
+            self.file_index.store_verified(self.destination_path,
+                                           writer.manifest(self.file_hash, os.path.basename(self.destination_path)))
+        logger.info(f"Delta sync of {self.destination_path} from {source['peer_ip']}: {result['literal_bytes'] / 1e6:.1f} MB "
+                    f"transferred, {result['copied_bytes'] / 1e6:.1f} MB reused from the local copy.")
+        return True
@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import math
+import struct
+import zlib
+from itertools import accumulate, count, repeat
+from operator import add, lshift, mod, mul, or_, sub
+from typing import Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+MAX_SIGNATURE_BLOCKS = 1 << 22
+STRONG_HASH_SIZE = 16
+SIGNATURE = struct.Struct(f"!I{STRONG_HASH_SIZE}s")
+COPY_INSTRUCTION = struct.Struct("!QI")
+ADLER_MODULUS = 65521
+SCAN_WINDOW = 64 * 1024
+FULL_SCAN_LIMIT = 1024 * 1024
+SPARSE_SCAN_STRIDE = 16
+LITERAL_FRAME_SIZE = 512 * 1024
+
+
+def block_size_for(basis_size: int) -> int:
+    # As in rsync: about sqrt(size), so the signature and the cost of one changed block stay balanced.
+    block_size = 1 << max(0, math.isqrt(max(basis_size, 1)).bit_length() - 1)
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def block_count_for(basis_size: int, block_size: int) -> int:
+    return (basis_size + block_size - 1) // block_size
+
+
+def strong_hash(data) -> bytes:
+    return hashlib.sha256(data).digest()[:STRONG_HASH_SIZE]
+
+
+def file_signatures(f, block_size: int) -> bytes:
+    signatures = bytearray()
+    while block := f.read(block_size):
+        signatures += SIGNATURE.pack(zlib.adler32(block), strong_hash(block))
+    return bytes(signatures)
+
+
+def rolling_checksums(window, block_size: int) -> List[int]:
+    # The Adler-32 of every block_size window in one pass, built from prefix sums so the per-byte
+    # work runs in C. Position k's value equals zlib.adler32(window[k:k + block_size]).
+    positions = len(window) - block_size + 1
+    sums = list(accumulate(window, initial=0))
+    weighted = list(accumulate(map(mul, window, count()), initial=0))
+    window_sums = list(map(sub, sums[block_size:], sums[:positions]))
+    a = map(mod, map(add, window_sums, repeat(1)), repeat(ADLER_MODULUS))
+    b = map(mod, map(sub, map(mul, range(block_size, block_size + positions), window_sums),
+                     map(add, map(sub, weighted[block_size:], weighted[:positions]), repeat(-block_size))),
+            repeat(ADLER_MODULUS))
+    return list(map(or_, map(lshift, b, repeat(16)), a))
+
+
+class DeltaEncoder:
+    def __init__(self, signatures: bytes, block_size: int, basis_size: int):
+        if not MIN_BLOCK_SIZE <= block_size <= MAX_BLOCK_SIZE:
+            raise ValueError(f"block size {block_size} out of range")
+        block_count = block_count_for(basis_size, block_size)
+        if len(signatures) != block_count * SIGNATURE.size:
+            raise ValueError(f"expected {block_count} signatures, got {len(signatures) / SIGNATURE.size:g}")
+        self.block_size = block_size
+        self.basis_size = basis_size
+        self.tail_size = basis_size - (block_count - 1) * block_size if block_count else 0
+        if self.tail_size == block_size:
+            self.tail_size = 0
+        self.strong: List[bytes] = []
+        self.table: Dict[int, Dict[bytes, int]] = {}
+        self.tail: Optional[tuple] = None
+        for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(signatures)):
+            self.strong.append(strong)
+            if self.tail_size and index == block_count - 1:
+                self.tail = (weak, strong, index)
+            else:
+                self.table.setdefault(weak, {}).setdefault(strong, index)
+        self.run: Optional[List[int]] = None
+        self.stats = {"copied_bytes": 0, "literal_bytes": 0, "scanned_bytes": 0}
+
+    def match(self, weak: int, block, expected: Optional[int]) -> Optional[int]:
+        candidates = self.table.get(weak)
+        if not candidates:
+            return None
+        strong = strong_hash(block)
+        # Prefer the block after the last match so runs of copies merge into one instruction.
+        if expected is not None and expected < len(self.strong) and self.strong[expected] == strong:
+            return expected
+        return candidates.get(strong)
+
+    def scan(self, data, start: int, end: int) -> Optional[tuple]:
+        # First position in [start, end] whose block matches the basis, with the matching block index.
+        block_size = self.block_size
+        checksums = rolling_checksums(data[start:end + block_size], block_size)
+        self.stats["scanned_bytes"] += len(checksums)
+        if self.table.keys().isdisjoint(checksums):
+            return None
+        for offset, weak in enumerate(checksums):
+            if weak in self.table:
+                position = start + offset
+                index = self.match(weak, data[position:position + block_size], None)
+                if index is not None:
+                    return position, index
+        return None
+
+    def encode(self, data) -> Iterator[tuple]:
+        # Yields ("copy", first_block, block_count) and ("literal", bytes) in file order.
+        size = len(data)
+        block_size = self.block_size
+        position = 0
+        literal_start = 0
+        miss_bytes = 0
+        self.run = None
+        while position + block_size <= size:
+            block = data[position:position + block_size]
+            index = self.match(zlib.adler32(block), block, sum(self.run) if self.run else None)
+            if index is None and (miss_bytes < FULL_SCAN_LIMIT or (position // SCAN_WINDOW) % SPARSE_SCAN_STRIDE == 0):
+                # Past the limit only one window in SPARSE_SCAN_STRIDE is rolled over, which bounds the cost of
+                # a file that shares nothing with the basis while still finding long shifted matches.
+                end = min(position + SCAN_WINDOW, size - block_size)
+                found = self.scan(data, position + 1, end) if end > position else None
+                if found is None:
+                    miss_bytes += end - position + 1
+                    position = end + 1
+                else:
+                    miss_bytes += found[0] - position
+                    position, index = found
+            elif index is None:
+                miss_bytes += block_size
+                position += block_size
+
+            if index is None:
+                if position - literal_start >= LITERAL_FRAME_SIZE:
+                    yield from self.emit_literal(data, literal_start, position)
+                    literal_start = position
+                continue
+            yield from self.emit_literal(data, literal_start, position)
+            yield from self.emit_copy(index)
+            miss_bytes = 0
+            position += block_size
+            literal_start = position
+
+        if self.tail and size - position == self.tail_size:
+            block = data[position:size]
+            weak, strong, index = self.tail
+            if zlib.adler32(block) == weak and strong_hash(block) == strong:
+                yield from self.emit_literal(data, literal_start, position)
+                yield from self.emit_copy(index)
+                literal_start = size
+        yield from self.emit_literal(data, literal_start, size)
+        if self.run:
+            yield self.copy()
+
+    def emit_copy(self, index: int) -> Iterator[tuple]:
+        if self.run and sum(self.run) == index:
+            self.run[1] += 1
+            return
+        if self.run:
+            yield self.copy()
+        self.run = [index, 1]
+
+    def emit_literal(self, data, start: int, end: int) -> Iterator[tuple]:
+        if start >= end:
+            return
+        if self.run:
+            yield self.copy()
+        self.stats["literal_bytes"] += end - start
+        for offset in range(start, end, LITERAL_FRAME_SIZE):
+            yield ("literal", data[offset:min(offset + LITERAL_FRAME_SIZE, end)])
+
+    def copy(self) -> tuple:
+        first, block_count = self.run
+        self.run = None
+        self.stats["copied_bytes"] += min(block_count * self.block_size, self.basis_size - first * self.block_size)
+        return ("copy", first, block_count)
+
+
+def copy_range(first_block: int, block_count: int, block_size: int, basis_size: int) -> tuple:
+    offset = first_block * block_size
+    if block_count <= 0 or offset >= basis_size:
+        raise ValueError(f"copy of blocks {first_block}+{block_count} is outside the basis")
+    return offset, min(block_count * block_size, basis_size - offset)
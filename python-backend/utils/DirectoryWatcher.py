@@ -0,0 +1,239 @@
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import errno
+import logging
+import select
+import struct
+import threading
+from typing import Dict, Optional, Tuple
+
+from utils.FileIndex import IGNORED_SUFFIXES
+
+logger = logging.getLogger(__name__)
+
+WRITE_DEBOUNCE_SECONDS = 2.0
+RENAME_PAIRING_SECONDS = 0.5
+POLL_INTERVAL = 10
+INDEX_SAVE_INTERVAL = 5.0
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path: str) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_add_watch failed for {path}: {os.strerror(error)}")
+        return wd
+
+    def remove_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout: float):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, cookie, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    def __init__(self, file_index, debounce: float = WRITE_DEBOUNCE_SECONDS, poll_interval: int = POLL_INTERVAL):
+        self.file_index = file_index
+        self.directory = file_index.directory
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.inotify: Optional[Inotify] = None
+        self.watches: Dict[int, str] = {}
+        self.pending_writes: Dict[str, float] = {}
+        self.pending_moves: Dict[int, Tuple[str, bool, float]] = {}
+        self.index_dirty = False
+        self.last_save = 0.0
+
+    @property
+    def mode(self) -> str:
+        return "inotify" if self.inotify is not None else "polling"
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.stop_event.clear()
+        if sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify()
+            except (OSError, AttributeError) as e:
+                logger.warning(f"inotify unavailable ({e}); falling back to polling every {self.poll_interval}s.")
+                self.inotify = None
+
+        if self.inotify is None:
+            self.file_index.start_auto_refresh(self.poll_interval)
+            return
+
+        self.watch_tree(self.directory)
+        threading.Thread(target=self.run, daemon=True).start()
+        logger.info(f"Watching {self.directory} with inotify ({len(self.watches)} directories).")
+
+    def stop(self):
+        self.stop_event.set()
+        self.file_index.stop()
+
+    def watch_tree(self, root: str):
+        for directory, _, _ in os.walk(root):
+            try:
+                self.watches[self.inotify.add_watch(directory)] = directory
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    logger.error("inotify watch limit reached; raise fs.inotify.max_user_watches. Some directories are not watched.")
+                    return
+                logger.warning(str(e))
+
+    def unwatch_tree(self, root: str):
+        prefix = root + os.sep
+        for wd, watched in list(self.watches.items()):
+            if watched == root or watched.startswith(prefix):
+                self.inotify.remove_watch(wd)
+                del self.watches[wd]
+
+    def run(self):
+        # The startup scan is the only full walk; everything after it is event driven.
+        try:
+            self.file_index.refresh()
+        except Exception as e:
+            logger.error(f"Initial index scan failed: {e}", exc_info=True)
+
+        while not self.stop_event.is_set():
+            try:
+                for wd, mask, cookie, name in self.inotify.read_events(timeout=0.25):
+                    self.handle_event(wd, mask, cookie, name)
+                self.flush_pending_moves()
+                self.flush_pending_writes()
+                self.save_index_if_due()
+            except Exception as e:
+                logger.error(f"Directory watcher error: {e}", exc_info=True)
+        self.inotify.close()
+        self.save_index_if_due(force=True)
+
+    def handle_event(self, wd: int, mask: int, cookie: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning("inotify queue overflowed; rescanning the shared directory once.")
+            self.index_dirty = self.file_index.refresh() or self.index_dirty
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        directory = self.watches.get(wd)
+        if directory is None or not name:
+            return
+        path = os.path.join(directory, name)
+        is_dir = bool(mask & IN_ISDIR)
+        if not is_dir and name.endswith(IGNORED_SUFFIXES):
+            return
+
+        if mask & IN_MOVED_FROM:
+            self.pending_moves[cookie] = (path, is_dir, time.monotonic())
+        elif mask & IN_MOVED_TO:
+            moved = self.pending_moves.pop(cookie, None)
+            if moved is not None:
+                self.apply_rename(moved[0], path, is_dir)
+            else:
+                self.apply_created(path, is_dir)
+        elif mask & IN_CREATE:
+            self.apply_created(path, is_dir)
+        elif mask & IN_DELETE:
+            self.pending_writes.pop(path, None)
+            self.index_dirty = self.file_index.remove_path(path) or self.index_dirty
+        elif mask & IN_ATTRIB and not is_dir:
+            self.pending_writes.setdefault(path, time.monotonic())
+        elif mask & (IN_MODIFY | IN_CLOSE_WRITE) and not is_dir:
+            if path not in self.pending_writes:
+                # Stop advertising the old content while the file is being rewritten.
+                self.index_dirty = self.file_index.remove_path(path) or self.index_dirty
+            self.pending_writes[path] = time.monotonic()
+
+    def apply_created(self, path: str, is_dir: bool):
+        if is_dir:
+            self.watch_tree(path)
+            for root, _, filenames in os.walk(path):
+                for filename in filenames:
+                    self.pending_writes[os.path.join(root, filename)] = time.monotonic()
+        else:
+            self.pending_writes[path] = time.monotonic()
+
+    def apply_rename(self, old_path: str, new_path: str, is_dir: bool):
+        if is_dir:
+            old_prefix = old_path + os.sep
+            for wd, watched in list(self.watches.items()):
+                if watched == old_path:
+                    self.watches[wd] = new_path
+                elif watched.startswith(old_prefix):
+                    self.watches[wd] = os.path.join(new_path, watched[len(old_prefix):])
+            for pending in [p for p in self.pending_writes if p.startswith(old_prefix)]:
+                self.pending_writes[os.path.join(new_path, pending[len(old_prefix):])] = self.pending_writes.pop(pending)
+        elif old_path in self.pending_writes:
+            self.pending_writes[new_path] = self.pending_writes.pop(old_path)
+            return
+        self.index_dirty = self.file_index.rename_path(old_path, new_path) or self.index_dirty
+
+    def flush_pending_moves(self):
+        now = time.monotonic()
+        for cookie, (path, is_dir, seen_at) in list(self.pending_moves.items()):
+            if now - seen_at >= RENAME_PAIRING_SECONDS:
+                del self.pending_moves[cookie]
+                if is_dir:
+                    self.unwatch_tree(path)
+                self.pending_writes.pop(path, None)
+                self.index_dirty = self.file_index.remove_path(path) or self.index_dirty
+
+    def flush_pending_writes(self):
+        now = time.monotonic()
+        for path, last_event in list(self.pending_writes.items()):
+            if now - last_event >= self.debounce:
+                del self.pending_writes[path]
+                self.index_dirty = self.file_index.update_path(path) or self.index_dirty
+
+    def save_index_if_due(self, force: bool = False):
+        if self.index_dirty and (force or time.monotonic() - self.last_save >= INDEX_SAVE_INTERVAL):
+            self.file_index.save()
+            self.index_dirty = False
+            self.last_save = time.monotonic()
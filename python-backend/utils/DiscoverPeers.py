@@ -1,235 +1,559 @@
+import asyncio
 import socket
 import json
 import netifaces
-from typing import List, Dict
+from typing import Callable, List, Dict
 import threading
 import time
-import pathlib
 import os
 import logging
-import base64
-import hashlib
-import time
+import uuid
+import random
+from utils.DirectoryWatcher import DirectoryWatcher
+from utils.DiscoveryBackends import DISCOVERY_BROADCAST, create_discovery_backend
+from utils.PeerRegistry import PeerRegistry
+from utils.ManifestManager import ManifestManager
+from utils.FileIndex import FileIndex, MATCH_EXACT, MATCH_GLOB, MATCH_SUBSTRING, GLOB_CHARACTERS
+from utils.SwarmDownloader import SwarmDownloader
+from utils.DeltaDownloader import DeltaDownloader
+from utils.WireProtocol import SUPPORTED_WIRE_VERSIONS, WireError, decode_message, encode_message, is_binary, negotiate
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+MAX_DATAGRAM_SIZE = 65535
+SEARCH_RESPONSE_PAYLOAD_LIMIT = 8000
+MAX_SEARCH_QUERIES = 500
+MAX_RESULTS_PER_QUERY = 100
+
+BEACON_FIXED = "fixed"
+BEACON_ADAPTIVE = "adaptive"
+BEACON_MIN_INTERVAL = 2.0
+BEACON_MAX_INTERVAL = 30.0
+BEACON_BACKOFF = 2.0
+BEACON_JITTER = 0.2
+REPLY_JITTER = 0.5
+KNOWN_PEERS_LIMIT = 256
+INTERFACE_RESCAN_INTERVAL = 60.0
+RESPONSE_TYPES = ('file_found_response', 'files_found_response', 'file_offer')
+
+
+class DiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, node):
+        self.node = node
+
+    def datagram_received(self, data: bytes, addr):
+        self.node.handle_datagram(data, addr)
+
+    def error_received(self, exc: Exception):
+        # ICMP errors for earlier sends (port unreachable and the like) land here; nothing waits on them.
+        logger.debug(f"Discovery socket error: {exc}")
+
+
 class DiscoverPeers:
-    def __init__(self, port: int):
+    def __init__(self, port: int, shared_directory: str = "publicFiles", transfer_port: int | None = None,
+                 host: str = '0.0.0.0', broadcast_addresses: List[str] | None = None, beacon_mode: str = BEACON_ADAPTIVE,
+                 discovery_mode: str = DISCOVERY_BROADCAST, bootstrap_peers: List[str] | None = None,
+                 multicast_groups: List[str] | None = None, dht=None, file_index: FileIndex | None = None,
+                 bandwidth=None, chunk_store=None):
         self.discovery_target_port = port 
         self.port = port 
-        self.discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        self.discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.transfer_port = transfer_port
+        self.host = host
+        self.node_id = uuid.uuid4().hex[:12]
+        self.beacon_mode = beacon_mode
+        self.static_broadcast_addresses = sorted(set(broadcast_addresses)) if broadcast_addresses else None
+        self.cached_broadcast_addresses: List[str] | None = None
+        self.interface_signature_cache = None
+        self.interfaces_scanned_at = 0.0
+        self.interface_lock = threading.Lock()
+        self.local_address_cache = None
+        self.stop_event = threading.Event()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.loop_thread_id: int | None = None
+        self.transport: asyncio.DatagramTransport | None = None
+        self.transport6: asyncio.DatagramTransport | None = None
+        self.pending_requests: Dict[str, tuple] = {}
+        self.pending_reply_targets = set()
+        self.discovery_stats = {"beacons_sent": 0, "replies_sent": 0, "replies_suppressed": 0, "datagrams_received": 0}
+        self.control_thread: threading.Thread | None = None
+        self.discovery_socket = self.open_discovery_socket()
+
+        self.peer_registry = PeerRegistry()
+        self.discovery_socket6: socket.socket | None = None
+        self.dht = dht
+        self.bandwidth = bandwidth
+        self.chunk_store = chunk_store
+        # Called with (filename, requester ip) for every query_file seen, answered or not.
+        self.query_listeners: List[Callable[[str, str], None]] = []
+        self.discovery_backend = create_discovery_backend(discovery_mode, self, bootstrap_peers, multicast_groups)
+        self.discovery_backend.open()
+
+        self.shared_directory = shared_directory
+        self.file_index = file_index if file_index is not None else FileIndex(shared_directory)
+        self.directory_watcher = DirectoryWatcher(self.file_index)
+
+    @property
+    def peers(self) -> List[str]:
+        return self.peer_registry.keys()
+
+    def open_discovery_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            self.discovery_socket.bind(('0.0.0.0', self.port))
+            sock.bind((self.host, self.port))
         except OSError as e:
             logger.error(f"Error binding discovery socket to {self.port}: {e}. Trying random port.")
-            self.discovery_socket.bind(('0.0.0.0', 0))
-            self.port = self.discovery_socket.getsockname()[1]
+            sock.bind((self.host, 0))
+            self.port = sock.getsockname()[1]
             logger.info(f"Bound to new port: {self.port}. Discovery broadcasts will still target: {self.discovery_target_port}")
+        return sock
 
-        self.peers: List[str] = []
-        self.discovery_socket.settimeout(1.0)
-
-    def discover_peers(self):
-        
-        logger.info("Starting peer discovery broadcast.")
-        message = {
-            'type': 'discover',
-            'port': self.port
-        }
-
-        while True:
+    def open_ipv6_socket(self) -> socket.socket:
+        if self.discovery_socket6 is None:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
             try:
-                interfaces = netifaces.interfaces()
-                for interface in interfaces:
-                    ifaddresses = netifaces.ifaddresses(interface)
-                    inet_info = ifaddresses.get(netifaces.AF_INET, [])
-
-                    for link in inet_info:
-                        broadcast_ip = link.get('broadcast')
-                        if broadcast_ip:
-                            try:
-                                self.discovery_socket.sendto(
-                                    json.dumps(message).encode(),
-                                    (broadcast_ip, self.discovery_target_port) 
-                                )
-                                logger.debug(f"Discovery message sent to {broadcast_ip}:{self.discovery_target_port}")
-                            except Exception as send_err:
-                                logger.warning(f"Error sending to {broadcast_ip}: {send_err}")
-                logger.debug("Finished broadcasting discovery messages for this cycle.")
-            except Exception as e:
-                logger.error(f"Error during interface scan or broadcast: {e}", exc_info=True)
-            time.sleep(2)
+                sock.bind(('::', self.port))
+            except OSError:
+                sock.close()
+                raise
+            self.discovery_socket6 = sock
+        return self.discovery_socket6
+
+    def send_datagram(self, payload: bytes, address: tuple):
+        transport = self.transport6 if ':' in address[0] else self.transport
+        if transport is None:
+            family = "IPv6" if ':' in address[0] else "IPv4"
+            raise OSError(f"{family} discovery transport is not open; cannot send to {address[0]}")
+        if threading.get_ident() == self.loop_thread_id:
+            transport.sendto(payload, address)
+        else:
+            self.loop.call_soon_threadsafe(transport.sendto, payload, address)
+
+    def encode_for(self, message: Dict, wire_version: int | None) -> bytes:
+        if wire_version is not None:
+            try:
+                return encode_message(message, wire_version)
+            except WireError as e:
+                logger.debug(f"Sending {message.get('type')} as JSON: {e}")
+        return json.dumps(message).encode()
+
+    def send_message(self, message: Dict, address: tuple, encoded: Dict | None = None):
+        # Binary only goes to peers that advertised it; broadcast and unknown addresses get JSON,
+        # which every node understands.
+        wire_version = self.peer_registry.wire_version(f"{address[0]}:{address[1]}")
+        if encoded is None:
+            payload = self.encode_for(message, wire_version)
+        else:
+            if wire_version not in encoded:
+                encoded[wire_version] = self.encode_for(message, wire_version)
+            payload = encoded[wire_version]
+        self.send_datagram(payload, address)
+
+    async def request(self, message: Dict, targets: List[tuple], timeout_duration: float, on_response,
+                      description: str) -> bool:
+        # Responses come back to the discovery socket carrying our request_id; on_response sees each
+        # one as it arrives and returns True once the caller has what it needs.
+        request_id = message.setdefault('request_id', uuid.uuid4().hex)
+        message.setdefault('reply_port', self.port)
+        done = self.loop.create_future()
+        self.pending_requests[request_id] = (on_response, done)
+        encoded = {}
+        sent = 0
+        for target in targets:
+            try:
+                sent += self.discovery_backend.send(message, target, encoded)
+                logger.debug(f"{description} sent to {target[0]}:{target[1]}")
+            except OSError as send_err:
+                logger.warning(f"Error sending {description} to {target[0]}: {send_err}")
+        try:
+            if sent:
+                await asyncio.wait_for(done, timeout_duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.pending_requests.pop(request_id, None)
+        return done.done() and not done.cancelled()
 
-    def listen_for_peers(self):
-        
-        logger.info("Starting to listen for peers.")
-        while True:
+    def run_request(self, message: Dict, targets: List[tuple], timeout_duration: float, on_response,
+                    description: str) -> bool:
+        if self.loop is None or not self.loop.is_running():
+            logger.error(f"Cannot send {description}: the discovery control plane is not running.")
+            return False
+        return asyncio.run_coroutine_threadsafe(
+            self.request(message, targets, timeout_duration, on_response, description), self.loop
+        ).result()
+
+    def complete_request(self, message: Dict, addr):
+        pending = self.pending_requests.get(message.get('request_id'))
+        if pending is None:
+            logger.debug(f"Ignoring {message.get('type')} from {addr[0]}:{addr[1]} for an unknown or finished request.")
+            return
+        on_response, done = pending
+        if not done.done() and on_response(message, addr):
+            done.set_result(True)
+
+    async def discover_peers(self):
+
+        logger.info(f"Starting peer discovery broadcast ({self.beacon_mode} beaconing).")
+        interval = BEACON_MIN_INTERVAL
+        previous_peers = None
+        previous_topology = None
+
+        while not self.stop_event.is_set():
+            self.peer_registry.evict_expired()
+            peers = frozenset(self.peer_registry.keys())
             try:
-                data, addr = self.discovery_socket.recvfrom(1024)
-                message = json.loads(data.decode())
-                sender_ip = addr[0]
-                sender_port = message.get('port', addr[1])
-                logger.debug(f"Received message: {message} from {sender_ip}:{sender_port}")
+                targets = self.discovery_backend.beacon_targets()
+            except Exception as e:
+                logger.error(f"Error during interface scan: {e}", exc_info=True)
+                targets = [("255.255.255.255", self.discovery_target_port)]
+
+            # Beacon quickly while the neighbourhood is changing, then back off while it stays the same.
+            topology = self.discovery_backend.topology()
+            if self.beacon_mode == BEACON_FIXED or not peers or peers != previous_peers or topology != previous_topology:
+                interval = BEACON_MIN_INTERVAL
+            else:
+                interval = min(interval * BEACON_BACKOFF, BEACON_MAX_INTERVAL)
+            previous_peers = peers
+            previous_topology = topology
+
+            message = {
+                'type': 'discover',
+                'port': self.port,
+                'node_id': self.node_id,
+                'interval': interval,
+                'sent_at': time.monotonic()
+            }
+            if self.beacon_mode == BEACON_ADAPTIVE:
+                message['known'] = self.peer_registry.node_ids(KNOWN_PEERS_LIMIT)
+            if self.dht is not None:
+                message['dht_port'] = self.dht.port
+            message['wire'] = list(SUPPORTED_WIRE_VERSIONS)
+            self.discovery_backend.decorate_beacon(message)
+            encoded = {}
+
+            for target in targets:
+                try:
+                    self.discovery_stats["beacons_sent"] += self.discovery_backend.send(message, target, encoded)
+                    logger.debug(f"Discovery message sent to {target[0]}:{target[1]}")
+                except Exception as send_err:
+                    logger.warning(f"Error sending to {target[0]}: {send_err}")
+            logger.debug(f"Finished broadcasting discovery messages for this cycle; next in {interval:.0f}s.")
+            await asyncio.sleep(interval * random.uniform(1 - BEACON_JITTER, 1 + BEACON_JITTER))
+
+    def schedule_reply(self, response: Dict, addr):
+        if self.beacon_mode == BEACON_FIXED:
+            self.send_reply(response, addr, 0.0)
+            return
+        # Spread replies out so a discover heard by the whole subnet does not come back as one burst.
+        if addr in self.pending_reply_targets:
+            return
+        self.pending_reply_targets.add(addr)
+        self.loop.call_later(random.uniform(0, REPLY_JITTER), self.send_scheduled_reply, response, addr, self.loop.time())
+
+    def send_scheduled_reply(self, response: Dict, addr, queued_at: float):
+        self.pending_reply_targets.discard(addr)
+        self.send_reply(response, addr, self.loop.time() - queued_at)
+
+    def send_reply(self, response: Dict, addr, held: float):
+        response['held'] = held
+        try:
+            self.send_message(response, addr)
+            self.discovery_stats["replies_sent"] += 1
+        except OSError as e:
+            logger.warning(f"Error replying to {addr[0]}:{addr[1]}: {e}")
 
-                if message['type'] == 'discover':
-                    response = {
-                        'type': 'peer_info',
-                        'port': self.port,
-                    }
-                    logger.info(f"Received discover from {sender_ip}:{sender_port}. Responding.")
-                    self.discovery_socket.sendto(
-                        json.dumps(response).encode(),
-                        (sender_ip, sender_port)
-                    )
-                    peer_addr = f"{sender_ip}:{sender_port}"
-                    if peer_addr not in self.peers:
-                        self.peers.append(peer_addr)
-                        logger.info(f"Peer added: {peer_addr}")
-
-                elif message['type'] == 'peer_info':
-                    peer_addr = f"{sender_ip}:{message['port']}"
-                    if peer_addr not in self.peers:
-                        self.peers.append(peer_addr)
-                        logger.info(f"Discovered peer via peer_info: {peer_addr}")
+    def handle_datagram(self, data: bytes, addr):
+        try:
+            self.discovery_stats["datagrams_received"] += 1
+            addr = (addr[0][7:] if addr[0].startswith('::ffff:') else addr[0], addr[1])
+            message = decode_message(data) if is_binary(data) else json.loads(data.decode())
+            sender_ip = addr[0]
+            sender_port = message.get('port', addr[1])
+            logger.debug(f"Received message: {message} from {sender_ip}:{sender_port}")
+
+            if message['type'] in ('discover', 'peer_info') and message.get('node_id') == self.node_id:
+                return
+            if message['type'] in ('discover', 'peer_info') and self.dht is not None and isinstance(message.get('dht_port'), int):
+                self.dht.add_seed(sender_ip, message['dht_port'])
+
+            if message['type'] in RESPONSE_TYPES:
+                self.complete_request(message, addr)
+
+            elif message['type'] == 'discover':
+                if self.peer_registry.touch(sender_ip, sender_port, message.get('node_id'), message.get('interval'),
+                                            negotiate(message.get('wire'))):
+                    logger.info(f"Peer added: {sender_ip}:{sender_port}")
+                self.discovery_backend.handle_beacon(message, sender_ip)
+                # A sender that already lists us heard our beacons; answering again only adds load.
+                if self.node_id in message.get('known', ()):
+                    self.discovery_stats["replies_suppressed"] += 1
+                    return
+                logger.info(f"Received discover from {sender_ip}:{sender_port}. Responding.")
+                self.schedule_reply({
+                    'type': 'peer_info',
+                    'port': self.port,
+                    'node_id': self.node_id,
+                    'dht_port': self.dht.port if self.dht is not None else None,
+                    'wire': list(SUPPORTED_WIRE_VERSIONS),
+                    'echo': message.get('sent_at')
+                }, (sender_ip, sender_port))
+
+            elif message['type'] == 'peer_info':
+                if self.peer_registry.touch(sender_ip, message['port'], message.get('node_id'),
+                                            wire_version=negotiate(message.get('wire'))):
+                    logger.info(f"Discovered peer via peer_info: {sender_ip}:{message['port']}")
+                # The echo is our own monotonic send time, so no clock agreement is needed.
+                echo = message.get('echo')
+                if isinstance(echo, (int, float)):
+                    held = message.get('held', 0)
+                    held = held if isinstance(held, (int, float)) else 0
+                    self.peer_registry.record_rtt(sender_ip, message['port'], time.monotonic() - echo - held)
                 
-                elif message['type'] == 'query_file':
-                    requested_filename = message['filename']
-                    sender_ip = addr[0]
-                    original_sender_port = addr[1]
+            elif message['type'] == 'query_file':
+                requested_filename = message['filename']
+                sender_ip = addr[0]
+                original_sender_port = addr[1]
                     
                    
-                    logger.info(f"Received query_file for '{requested_filename}' from {sender_ip}:{original_sender_port} (reply to port: {message.get('reply_port')})")
+                logger.info(f"Received query_file for '{requested_filename}' from {sender_ip}:{original_sender_port} (reply to port: {message.get('reply_port')})")
+                # Broadcasts loop back to us; our own queries say nothing about demand elsewhere.
+                listeners = self.query_listeners if not self.is_own_datagram(addr) else ()
+                for listener in listeners:
+                    try:
+                        listener(requested_filename, sender_ip)
+                    except Exception as e:
+                        logger.warning(f"query_file listener failed: {e}")
                     
-                    found_file_hash = None
-                    local_files = self.list_all_files("publicFiles")
-                    for f_hash, f_path in local_files.items():
-                        if os.path.basename(f_path) == requested_filename:
-                            found_file_hash = f_hash
-                            break
+                found_file_hash = self.file_index.get_hash_by_name(requested_filename)
                     
-                    if found_file_hash:
-                        logger.info(f"File '{requested_filename}' found locally with hash {found_file_hash}. Responding.")
-                        response = {
-                            'type': 'file_found_response',
-                            'filename': requested_filename,
-                            'file_hash': found_file_hash,
-                            'peer_ip': self.get_local_ip(),
-                            'port': self.port            
-                        }
+                if found_file_hash:
+                    logger.info(f"File '{requested_filename}' found locally with hash {found_file_hash}. Responding.")
+                    response = {
+                        'type': 'file_found_response',
+                        'filename': requested_filename,
+                        'file_hash': found_file_hash,
+                        'peer_ip': self.get_local_ip(),
+                        'port': self.port,
+                        'transfer_port': self.transfer_port,
+                        'request_id': message.get('request_id')
+                    }
                         
                        
-                        reply_to_port = message.get('reply_port')
-                        if reply_to_port:
+                    reply_to_port = message.get('reply_port')
+                    if reply_to_port:
                            
-                            response_addr = (sender_ip, reply_to_port)
-                            logger.debug(f"Sending file_found_response to {response_addr} (using reply_port from message)")
-                        else:
+                        response_addr = (sender_ip, reply_to_port)
+                        logger.debug(f"Sending file_found_response to {response_addr} (using reply_port from message)")
+                    else:
                            
                            
-                            response_addr = addr 
-                            logger.warning(f"reply_port not found in query_file message from {sender_ip}. Responding to original sender port {original_sender_port}.")
+                        response_addr = addr 
+                        logger.warning(f"reply_port not found in query_file message from {sender_ip}. Responding to original sender port {original_sender_port}.")
                         
-                        self.discovery_socket.sendto(json.dumps(response).encode(), response_addr)
-                    else:
-                        logger.info(f"File '{requested_filename}' not found locally.")
+                    self.send_message(response, response_addr)
+                else:
+                    logger.info(f"File '{requested_filename}' not found locally.")
+
+            elif message['type'] == 'query_files':
+                # Matching hundreds of patterns against the index is too slow to do on the event loop.
+                self.loop.run_in_executor(None, self.answer_file_search, message, addr)
 
-                elif message['type'] == "receive_file" and 'file_hash' in message:
-                    file_hash_to_send = message['file_hash']
-                    requester_ip = addr[0]
+            elif message['type'] == "receive_file" and 'file_hash' in message:
+                file_hash_to_send = message['file_hash']
+                requester_ip = addr[0]
                    
-                    requester_reply_port = message.get('port')
+                requester_reply_port = message.get('port')
 
-                    logger.info(f"Received 'receive_file' request for hash {file_hash_to_send} from {requester_ip}:{addr[1]}. Requester expects data on port {requester_reply_port}.")
+                logger.info(f"Received 'receive_file' request for hash {file_hash_to_send} from {requester_ip}:{addr[1]}. Requester expects data on port {requester_reply_port}.")
                     
-                    local_files = self.list_all_files("publicFiles")
-                    if file_hash_to_send in local_files:
-                        file_path_to_send = local_files[file_hash_to_send]
-                        file_name_to_send = os.path.basename(file_path_to_send)
-                        file_format = file_name_to_send.split('.')[-1] if '.' in file_name_to_send else ""
+                file_path_to_send = self.file_index.get_path(file_hash_to_send)
+                if file_path_to_send:
+                    file_name_to_send = os.path.basename(file_path_to_send)
+                    file_format = file_name_to_send.split('.')[-1] if '.' in file_name_to_send else ""
                         
-                        try:
-                            with open(file_path_to_send, 'rb') as f:
-                                file_data_bytes = f.read()
-                            
-                            import base64
-                            file_data_encoded = base64.b64encode(file_data_bytes).decode('utf-8')
-
-                            data_message = {
-                                'type': 'file_data',
-                                'port': self.port,
-                                'file_hash': file_hash_to_send,
-                                'file_name': file_name_to_send,
-                                'file_format': file_format,
-                                'data': file_data_encoded
-                            }
-
-                            data_payload_bytes = json.dumps(data_message).encode()
-                            payload_size = len(data_payload_bytes)
-                            logger.info(f"Attempting to send file_data payload of size: {payload_size} bytes for {file_name_to_send} to {requester_ip}:{requester_reply_port}")
-                            if payload_size > 60000:
-                                logger.warning(f"Payload size {payload_size} for {file_name_to_send} is very large for a single UDP packet and may cause transmission failure. Consider implementing chunking for robust transfer.")
-
-                            if requester_reply_port:
-                               
-                                reply_address = (requester_ip, requester_reply_port)
-                                self.discovery_socket.sendto(data_payload_bytes, reply_address)
-                                logger.info(f"Sent file data for {file_name_to_send} to {reply_address[0]}:{reply_address[1]}")
-                            else:
-                                logger.error(f"Cannot send file {file_name_to_send}: 'port' not specified in 'receive_file' message from {requester_ip}:{addr[1]}.")
-                        except FileNotFoundError:
-                            logger.error(f"File not found for sending: {file_path_to_send}")
-                        except Exception as e:
-                            logger.error(f"Error reading or sending file {file_path_to_send}: {e}", exc_info=True)
-                    else:
-                        logger.warning(f"Requested file hash {file_hash_to_send} not found in local files for sending.")
+                    try:
+                        offer_message = {
+                            'type': 'file_offer',
+                            'port': self.port,
+                            'file_hash': file_hash_to_send,
+                            'file_name': file_name_to_send,
+                            'file_format': file_format,
+                            'size': os.path.getsize(file_path_to_send),
+                            'transfer_port': self.transfer_port,
+                            'request_id': message.get('request_id')
+                        }
 
-            except socket.timeout:
-                continue
-            except json.JSONDecodeError:
-                logger.warning(f"Error decoding JSON from {addr[0] if 'addr' in locals() else 'unknown'}. Data: {data if 'data' in locals() else 'N/A'}")
-            except Exception as e:
-                logger.error(f"Error in listen_for_peers: {e}", exc_info=True)
+                        if not self.transfer_port:
+                            logger.error(f"Cannot offer file {file_name_to_send}: no file transfer port is configured.")
+                        elif requester_reply_port:
+                            reply_address = (requester_ip, requester_reply_port)
+                            self.send_message(offer_message, reply_address)
+                            logger.info(f"Offered {file_name_to_send} to {reply_address[0]}:{reply_address[1]} via transfer port {self.transfer_port}")
+                        else:
+                            logger.error(f"Cannot offer file {file_name_to_send}: 'port' not specified in 'receive_file' message from {requester_ip}:{addr[1]}.")
+                    except FileNotFoundError:
+                        logger.error(f"File not found for sending: {file_path_to_send}")
+                    except Exception as e:
+                        logger.error(f"Error offering file {file_path_to_send}: {e}", exc_info=True)
+                else:
+                    logger.warning(f"Requested file hash {file_hash_to_send} not found in local files for sending.")
+
+        except json.JSONDecodeError:
+            logger.warning(f"Error decoding JSON from {addr[0]}. Data: {data}")
+        except WireError as e:
+            logger.warning(f"Error decoding binary message from {addr[0]}: {e}")
+        except Exception as e:
+            logger.error(f"Error handling discovery message from {addr[0]}: {e}", exc_info=True)
 
     def start_discovery(self):
         
         logger.info("Initializing discovery threads.")
-        threading.Thread(target=self.listen_for_peers, daemon=True).start()
-
-        threading.Thread(target=self.discover_peers, daemon=True).start()
+        self.directory_watcher.start()
+        self.start_beaconing()
+
+    def start_beaconing(self):
+        if self.control_thread is not None and self.control_thread.is_alive():
+            if not self.stop_event.is_set():
+                return
+            # A stopped control plane finishes closing its transports before the next one opens new ones.
+            self.control_thread.join()
+        self.stop_event.clear()
+        ready = threading.Event()
+        self.control_thread = threading.Thread(target=self.run_control_plane, args=(ready,), daemon=True)
+        self.control_thread.start()
+        ready.wait()
+
+    def run_control_plane(self, ready: threading.Event):
+        # One event loop owns the discovery socket(s): beacons, replies and every outstanding query
+        # share it, so concurrent lookups cost neither threads nor extra sockets.
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop_thread_id = threading.get_ident()
+        try:
+            self.loop.run_until_complete(self.open_control_plane())
+        except OSError as e:
+            logger.error(f"Could not start the discovery control plane: {e}", exc_info=True)
+            self.loop.close()
+            self.loop = None
+            return
+        finally:
+            ready.set()
 
-    def list_of_peer_accordingly_to_ips(self, file_name, files) -> List[str]:
-        
-        
-        
-        logger.warning("list_of_peer_accordingly_to_ips is likely deprecated or needs rework.")
-        return ("", "")
+        logger.info("Starting to listen for peers.")
+        self.loop.run_forever()
+
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        for transport in (self.transport, self.transport6):
+            if transport is not None:
+                transport.close()
+        self.transport = self.transport6 = None
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    async def open_control_plane(self):
+        if self.discovery_socket.fileno() == -1:
+            # A previous run closed the sockets along with its transports: bind fresh ones and let the
+            # backend join its multicast groups on them again.
+            self.discovery_socket = self.open_discovery_socket()
+            self.discovery_socket6 = None
+            self.discovery_backend.open()
+        self.transport, _ = await self.loop.create_datagram_endpoint(lambda: DiscoveryProtocol(self), sock=self.discovery_socket)
+        if self.discovery_socket6 is not None:
+            self.transport6, _ = await self.loop.create_datagram_endpoint(lambda: DiscoveryProtocol(self), sock=self.discovery_socket6)
+        self.loop.create_task(self.discover_peers())
+
+    def stop_beaconing(self):
+        self.stop_event.set()
+        if self.loop is not None and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def stop_discovery(self):
+        self.stop_beaconing()
+        self.directory_watcher.stop()
+
+    def add_query_listener(self, listener: Callable[[str, str], None]):
+        self.query_listeners.append(listener)
 
     def find_file_source(self, requested_filename: str) -> tuple[str | None, int | None, str | None]:
         
         logger.info(f"Searching for file source: {requested_filename}")
+        found = []
 
-        response_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        response_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            response_socket.bind(('0.0.0.0', 0))
-        except Exception as e:
-            logger.error(f"Error binding temporary response socket for find_file_source: {e}", exc_info=True)
-            response_socket.close()
+        def on_response(response: Dict, addr) -> bool:
+            if response.get('type') != 'file_found_response' or response.get('filename') != requested_filename:
+                return False
+            found.append((response.get('peer_ip', addr[0]), response.get('port'), response.get('file_hash')))
+            return True
+
+        timeout_duration = 3
+        message = {'type': 'query_file', 'filename': requested_filename}
+        logger.info(f"Sending file query over {self.discovery_backend.name} discovery")
+        self.run_request(message, self.discovery_backend.query_targets(), timeout_duration, on_response, "file query")
+
+        if not found:
+            logger.warning(f"File '{requested_filename}' not found on the network after {timeout_duration}s.")
+            return None, None, None
+        peer_ip, peer_port, file_hash = found[0]
+        if peer_port is None:
+            logger.warning(f"File_found_response from {peer_ip} for '{requested_filename}' did not include a port.")
             return None, None, None
-            
-        reply_to_port = response_socket.getsockname()[1]
-        logger.debug(f"find_file_source listening for response on temporary port {reply_to_port}")
+        logger.info(f"Found file '{requested_filename}' at {peer_ip}:{peer_port} with hash {file_hash}")
+        return peer_ip, peer_port, file_hash
+
+    def get_broadcast_addresses(self) -> List[str]:
+        if self.static_broadcast_addresses:
+            return list(self.static_broadcast_addresses)
+
+        signature = self.interface_signature()
+        with self.interface_lock:
+            stale = time.monotonic() - self.interfaces_scanned_at >= INTERFACE_RESCAN_INTERVAL
+            if self.cached_broadcast_addresses is None or signature != self.interface_signature_cache or stale:
+                broadcast_addresses = self.scan_broadcast_addresses()
+                if broadcast_addresses != self.cached_broadcast_addresses:
+                    logger.info(f"Broadcast addresses: {broadcast_addresses}")
+                self.cached_broadcast_addresses = broadcast_addresses
+                self.interface_signature_cache = signature
+                self.interfaces_scanned_at = time.monotonic()
+            return list(self.cached_broadcast_addresses)
+
+    def interface_signature(self):
+        # if_nameindex is a single cheap syscall; a full netifaces scan only runs when it changes.
+        try:
+            return tuple(socket.if_nameindex())
+        except (OSError, AttributeError):
+            return None
+
+    def local_addresses(self) -> set:
+        signature = self.interface_signature()
+        with self.interface_lock:
+            cache = self.local_address_cache
+            if cache is None or cache[0] != signature or time.monotonic() - cache[1] >= INTERFACE_RESCAN_INTERVAL:
+                addresses = {"127.0.0.1", "::1"}
+                try:
+                    for interface in netifaces.interfaces():
+                        for family in (netifaces.AF_INET, netifaces.AF_INET6):
+                            for link in netifaces.ifaddresses(interface).get(family, []):
+                                if link.get('addr'):
+                                    addresses.add(link['addr'].split('%')[0])
+                except Exception as e:
+                    logger.warning(f"Could not list local addresses: {e}")
+                cache = self.local_address_cache = (signature, time.monotonic(), addresses)
+            return cache[2]
 
-        message = {
-            'type': 'query_file',
-            'filename': requested_filename,
-            'reply_port': reply_to_port
-        }
-        encoded_message = json.dumps(message).encode()
+    def is_own_datagram(self, addr) -> bool:
+        # Everything we send leaves from the discovery port, so a local address alone is not enough:
+        # other nodes may run on this host.
+        return addr[1] == self.port and addr[0] in self.local_addresses()
 
+    def scan_broadcast_addresses(self) -> List[str]:
         broadcast_addresses = []
         try:
             interfaces = netifaces.interfaces()
@@ -247,53 +571,163 @@ class DiscoverPeers:
         if not broadcast_addresses:
              logger.warning("No broadcast addresses found by netifaces, using 255.255.255.255 as a fallback.")
              broadcast_addresses.append("255.255.255.255")
-        
-        logger.info(f"Attempting to broadcast file query to the following addresses: {list(set(broadcast_addresses))}")
+        return sorted(set(broadcast_addresses))
 
-        for bcast_ip in set(broadcast_addresses):
-            try:
-               
-                self.discovery_socket.sendto(encoded_message, (bcast_ip, self.discovery_target_port))
-                logger.debug(f"File query for '{requested_filename}' sent to {bcast_ip}:{self.discovery_target_port}, reply expected on port {reply_to_port}")
-            except Exception as send_err:
-                logger.warning(f"Error sending file query to {bcast_ip}: {send_err}")
+    def find_file_sources(self, requested_filename: str, timeout_duration: float = 3) -> List[Dict]:
         
-        start_time = time.time()
-        timeout_duration = 3
-        
-        response_socket.settimeout(0.5)
+        logger.info(f"Collecting all sources for file: {requested_filename}")
+        sources: Dict[str, Dict] = {}
+
+        def on_response(response: Dict, addr) -> bool:
+            if response.get('type') != 'file_found_response' or response.get('filename') != requested_filename:
+                return False
+            if response.get('port') is None or not response.get('transfer_port'):
+                logger.warning(f"Ignoring file_found_response from {addr[0]} for '{requested_filename}' without port information.")
+                return False
+            source = {
+                'peer_ip': response.get('peer_ip', addr[0]),
+                'port': response['port'],
+                'transfer_port': response['transfer_port'],
+                'file_hash': response.get('file_hash')
+            }
+            sources[f"{source['peer_ip']}:{source['port']}"] = source
+            return False
 
-        try:
-            while time.time() - start_time < timeout_duration:
-                try:
-                    data, addr = response_socket.recvfrom(1024)
-                    response = json.loads(data.decode())
-                    logger.debug(f"Received response while searching for file: {response} from {addr} on temp port {reply_to_port}")
-                    
-                    if response.get('type') == 'file_found_response' and \
-                       response.get('filename') == requested_filename:
-                        peer_ip = response.get('peer_ip', addr[0])
-                        file_hash = response.get('file_hash')
-                        peer_port = response.get('port')
-                        if peer_port is None:
-                            logger.warning(f"File_found_response from {peer_ip} for '{requested_filename}' did not include a port.")
-                            return None, None, None 
-                        logger.info(f"Found file '{requested_filename}' at {peer_ip}:{peer_port} with hash {file_hash}")
-                        return peer_ip, peer_port, file_hash 
-                except socket.timeout:
-                    continue
-                except json.JSONDecodeError:
-                    logger.warning(f"JSON decode error while searching for file from {addr[0] if 'addr' in locals() else 'unknown'}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving file_found_response: {e}", exc_info=True)
+        message = {'type': 'query_file', 'filename': requested_filename}
+        self.run_request(message, self.discovery_backend.query_targets(), timeout_duration, on_response, "file query")
+
+        logger.info(f"Found {len(sources)} source(s) for '{requested_filename}'.")
+        return list(sources.values())
+
+    def normalize_search_queries(self, queries: List, default_match: str = "auto") -> List[Dict]:
+        # Remote queries are untrusted, so entries of the wrong type are skipped rather than raising.
+        if not isinstance(queries, list):
+            return []
+        normalized = []
+        for query in queries[:MAX_SEARCH_QUERIES]:
+            if isinstance(query, str):
+                query = {'pattern': query}
+            if not isinstance(query, dict) or not isinstance(query.get('pattern', ''), str):
+                continue
+            pattern = query.get('pattern', '')
+            match = query.get('match', default_match)
+            if match == "auto":
+                match = MATCH_GLOB if GLOB_CHARACTERS & set(pattern) else MATCH_EXACT
+            if pattern and match in (MATCH_EXACT, MATCH_GLOB, MATCH_SUBSTRING):
+                normalized.append({'pattern': pattern, 'match': match})
+        return normalized
+
+    def answer_file_search(self, message: Dict, addr):
+        queries = self.normalize_search_queries(message.get('queries', []))
+        reply_port = message.get('reply_port')
+        if not queries or not reply_port:
+            return
+
+        results = []
+        for query_index, query in enumerate(queries):
+            for match in self.file_index.search(query['pattern'], query['match'], limit=MAX_RESULTS_PER_QUERY):
+                results.append({'query': query_index, 'filename': match['filename'], 'file_hash': match['file_hash'], 'size': match['size']})
+        logger.info(f"Received query_files with {len(queries)} queries from {addr[0]}; {len(results)} local matches.")
+        if not results:
+            return
+
+        parts = [[]]
+        part_size = 0
+        for result in results:
+            result_size = len(json.dumps(result)) + 2
+            if parts[-1] and part_size + result_size > SEARCH_RESPONSE_PAYLOAD_LIMIT:
+                parts.append([])
+                part_size = 0
+            parts[-1].append(result)
+            part_size += result_size
+
+        for part_index, part in enumerate(parts):
+            response = {
+                'type': 'files_found_response',
+                'query_id': message.get('query_id'),
+                'request_id': message.get('request_id'),
+                'peer_ip': self.get_local_ip(),
+                'port': self.port,
+                'transfer_port': self.transfer_port,
+                'part': part_index,
+                'parts': len(parts),
+                'results': part
+            }
+            try:
+                self.send_message(response, (addr[0], reply_port))
+            except OSError as e:
+                logger.warning(f"Error sending search results to {addr[0]}:{reply_port}: {e}")
+                return
+
+    def search_files(self, queries: List, match: str = "auto", timeout_duration: float = 3, quorum: int | None = None) -> List[Dict]:
+        if not isinstance(queries, list) or not all(isinstance(query, (str, dict)) for query in queries):
+            raise ValueError("Search patterns must be a list of strings or {'pattern', 'match'} objects.")
+        if quorum is not None and (isinstance(quorum, bool) or not isinstance(quorum, int) or quorum < 1):
+            raise ValueError(f"Search quorum must be a positive integer, got {quorum!r}.")
+        normalized = self.normalize_search_queries(queries, match)
+        if not normalized:
+            return []
+        logger.info(f"Searching the network for {len(normalized)} pattern(s) in one query.")
+
+        query_id = uuid.uuid4().hex
+        message = {
+            'type': 'query_files',
+            'query_id': query_id,
+            'request_id': query_id,
+            'queries': normalized
+        }
+        if len(json.dumps(message)) > MAX_DATAGRAM_SIZE - 100:
+            logger.error(f"Search query of {len(json.dumps(message))} bytes does not fit in one datagram.")
+            return []
+
+        grouped: Dict[str, Dict] = {}
+        parts_seen: Dict[str, set] = {}
+        complete_peers = set()
+
+        def on_response(response: Dict, addr) -> bool:
+            if response.get('type') != 'files_found_response' or response.get('query_id') != query_id:
+                return False
+
+            peer_key = f"{response.get('peer_ip', addr[0])}:{response.get('port')}"
+            source = {
+                'peer_ip': response.get('peer_ip', addr[0]),
+                'port': response.get('port'),
+                'transfer_port': response.get('transfer_port')
+            }
+            for result in response.get('results', []):
+                query_index = result.get('query')
+                if not isinstance(query_index, int) or not 0 <= query_index < len(normalized):
                     continue
-        finally:
-            response_socket.close()
-            logger.debug(f"Closed temporary response socket on port {reply_to_port} for find_file_source")
+                group = grouped.setdefault(result['file_hash'], {
+                    'file_hash': result['file_hash'],
+                    'size': result.get('size'),
+                    'filenames': set(),
+                    'patterns': set(),
+                    'sources': {}
+                })
+                group['filenames'].add(result['filename'])
+                group['patterns'].add(normalized[query_index]['pattern'])
+                group['sources'][peer_key] = source
+
+            parts_seen.setdefault(peer_key, set()).add(response.get('part'))
+            if len(parts_seen[peer_key]) >= response.get('parts', 1):
+                complete_peers.add(peer_key)
+            return bool(quorum) and len(complete_peers) >= quorum
 
-        logger.warning(f"File '{requested_filename}' not found on the network after {timeout_duration}s.")
-        return None, None, None
+        start_time = time.time()
+        self.run_request(message, self.discovery_backend.query_targets(), timeout_duration, on_response, "search query")
+
+        logger.info(f"Search finished: {len(grouped)} distinct file(s) from {len(parts_seen)} peer(s) in {time.time() - start_time:.2f}s.")
+        return [
+            {
+                'file_hash': group['file_hash'],
+                'size': group['size'],
+                'filenames': sorted(group['filenames']),
+                'patterns': sorted(group['patterns']),
+                'sources': list(group['sources'].values())
+            }
+            for group in grouped.values()
+        ]
 
     def query_peer_for_file(self, target_peer_address_str: str, requested_filename: str) -> tuple[str | None, int | None, str | None]:
         
@@ -306,160 +740,65 @@ class DiscoverPeers:
             logger.error(f"Invalid peer address format: {target_peer_address_str}. Expected IP:PORT")
             return None, None, None
 
-        response_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        response_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            response_socket.bind(('0.0.0.0', 0))
-        except Exception as e:
-            logger.error(f"Error binding temporary response socket for query_peer_for_file: {e}", exc_info=True)
-            response_socket.close()
-            return None, None, None
+        found = []
 
-        reply_to_port = response_socket.getsockname()[1]
-        logger.debug(f"query_peer_for_file listening for response on temporary port {reply_to_port}")
+        def on_response(response: Dict, addr) -> bool:
+            if addr[0] != target_ip or response.get('type') != 'file_found_response' or \
+               response.get('filename') != requested_filename:
+                return False
+            found.append((response.get('peer_ip', addr[0]), response.get('port'), response.get('file_hash')))
+            return True
 
-        message = {
-            'type': 'query_file',
-            'filename': requested_filename,
-            'reply_port': reply_to_port 
-        }
-        encoded_message = json.dumps(message).encode()
+        message = {'type': 'query_file', 'filename': requested_filename}
+        self.run_request(message, [(target_ip, target_port)], 2, on_response, "file query")
 
-        try:
-           
-            self.discovery_socket.sendto(encoded_message, (target_ip, target_port))
-            logger.debug(f"File query for '{requested_filename}' sent to {target_ip}:{target_port}, reply expected on port {reply_to_port}")
-        except Exception as send_err:
-            logger.warning(f"Error sending file query to {target_ip}:{target_port}: {send_err}")
-            response_socket.close() 
+        if not found:
+            logger.info(f"File '{requested_filename}' not found on peer {target_peer_address_str} or no response.")
             return None, None, None
-        
-        start_time = time.time()
-        timeout_duration = 2  
-        
-        response_socket.settimeout(0.2)
-
-        try:
-            while time.time() - start_time < timeout_duration:
-                try:
-                    data, addr = response_socket.recvfrom(1024)
-                    
-                    if addr[0] == target_ip: 
-                        response = json.loads(data.decode())
-                        logger.debug(f"Received response while querying {target_peer_address_str}: {response} from {addr} on temp port {reply_to_port}")
-                        
-                        if response.get('type') == 'file_found_response' and \
-                           response.get('filename') == requested_filename:
-                            peer_ip_from_response = response.get('peer_ip', addr[0])
-                            file_hash = response.get('file_hash')
-                            peer_port_from_response = response.get('port') 
-                            if peer_port_from_response is None:
-                                logger.warning(f"File_found_response from {target_peer_address_str} for '{requested_filename}' did not include a port.")
-                                return None, None, None
-                            logger.info(f"Peer {target_peer_address_str} has file '{requested_filename}' (IP: {peer_ip_from_response}, Port: {peer_port_from_response}, Hash: {file_hash})")
-                            return peer_ip_from_response, peer_port_from_response, file_hash 
-                except socket.timeout:
-                    continue
-                except json.JSONDecodeError:
-                    logger.warning(f"JSON decode error while querying {target_peer_address_str} from {addr[0] if 'addr' in locals() else 'unknown'}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving response from {target_peer_address_str}: {e}", exc_info=True)
-                    break 
-        finally:
-            response_socket.close()
-            logger.debug(f"Closed temporary response socket on port {reply_to_port} for query_peer_for_file")
-
-        logger.info(f"File '{requested_filename}' not found on peer {target_peer_address_str} or no response.")
-        return None, None, None
+        peer_ip_from_response, peer_port_from_response, file_hash = found[0]
+        if peer_port_from_response is None:
+            logger.warning(f"File_found_response from {target_peer_address_str} for '{requested_filename}' did not include a port.")
+            return None, None, None
+        logger.info(f"Peer {target_peer_address_str} has file '{requested_filename}' (IP: {peer_ip_from_response}, Port: {peer_port_from_response}, Hash: {file_hash})")
+        return peer_ip_from_response, peer_port_from_response, file_hash
 
     def receive_file(self, peer_ip: str, peer_port: int, file_hash: str, destination_path: str) -> bool:
         logger.info(f"Requesting file with hash {file_hash} from {peer_ip}:{peer_port} to be saved at {destination_path}")
+        offers = []
 
-        response_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        response_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            response_socket.bind(('0.0.0.0', 0))
-        except Exception as e:
-            logger.error(f"Error binding temporary response socket for receive_file: {e}", exc_info=True)
-            response_socket.close()
-            return False
-            
-        reply_to_port = response_socket.getsockname()[1]
-        logger.debug(f"receive_file listening for file data on temporary port {reply_to_port}")
+        def on_response(response: Dict, addr) -> bool:
+            if addr[0] != peer_ip:
+                logger.warning(f"Received a reply from unexpected IP {addr[0]} (expected {peer_ip}) while expecting a file offer. Ignoring.")
+                return False
+            if response.get('type') != 'file_offer' or response.get('file_hash') != file_hash:
+                return False
+            offers.append(response)
+            return True
 
         request_message = {
             'type': 'receive_file', 
             'file_hash': file_hash,
-            'port': reply_to_port
+            'port': self.port
         }
-        
-        try:
-           
-            self.discovery_socket.sendto(json.dumps(request_message).encode(), (peer_ip, peer_port))
-            logger.debug(f"Sent 'receive_file' request to {peer_ip}:{peer_port} for hash {file_hash}, expecting data on port {reply_to_port}")
-        except Exception as e:
-            logger.error(f"Error sending file request to {peer_ip}:{peer_port}: {e}", exc_info=True)
-            response_socket.close() 
-            return False
+        self.run_request(request_message, [(peer_ip, peer_port)], 5, on_response, "file request")
 
-        start_time = time.time()
-        timeout_duration = 30
-        
-        response_socket.settimeout(2.0)
+        offer = offers[0] if offers else None
+        if offer is None or not offer.get('transfer_port'):
+            logger.warning(f"Timeout or error waiting for file offer {file_hash} from {peer_ip}:{peer_port}.")
+            return False
 
+        logger.info(f"Peer {peer_ip} offered {offer.get('file_name')} ({offer.get('size')} bytes) on transfer port {offer['transfer_port']}")
+        source = {'peer_ip': peer_ip, 'port': peer_port, 'transfer_port': offer['transfer_port']}
         try:
-            while time.time() - start_time < timeout_duration:
-                try:
-                    data, addr = response_socket.recvfrom(65535) 
-                    logger.debug(f"Received {len(data)} bytes from {addr} while waiting for file on temp port {reply_to_port}")
-                    
-                    if addr[0] != peer_ip:
-                        logger.warning(f"Received data from unexpected IP {addr[0]} (expected {peer_ip}) while expecting file from {peer_ip} on port {reply_to_port}. Ignoring.")
-                        continue
-
-                    response = json.loads(data.decode())
-                    logger.debug(f"Received message type: {response.get('type')} from {addr} on temp port {reply_to_port} for hash {file_hash}")
-
-                    if response.get('type') == 'file_data' and response.get('file_hash') == file_hash:
-                        logger.info(f"Received file_data for hash {file_hash} from {addr[0]}")
-                        file_data_encoded = response.get('data')
-                        
-                        
-                        try:
-                            file_data_bytes = base64.b64decode(file_data_encoded)
-                            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
-                            with open(destination_path, 'wb') as f:
-                                f.write(file_data_bytes)
-                            logger.info(f"File {destination_path} received and saved successfully.")
-                            return True
-                        except (base64.binascii.Error, TypeError) as b64_err:
-                            logger.error(f"Base64 decode error for file {file_hash}: {b64_err}", exc_info=True)
-                            return False
-                        except IOError as io_err:
-                            logger.error(f"IOError writing file {destination_path}: {io_err}", exc_info=True)
-                            return False
-                except socket.timeout:
-                    continue
-                except json.JSONDecodeError:
-                    logger.warning(f"JSON decode error while receiving file data from {addr[0] if 'addr' in locals() else 'unknown'}")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error receiving file data: {e}", exc_info=True)
-                    return False 
-        finally:
-            response_socket.close()
-            logger.debug(f"Closed temporary response socket on port {reply_to_port} for receive_file")
-
-        logger.warning(f"Timeout or error receiving file {file_hash} from {peer_ip}:{peer_port}.")
-        return False
-
-    def get_key_by_value(self,d, target_value_basename):
-        
-        for key, value_path in d.items():
-            if os.path.basename(value_path) == target_value_basename:
-                return key
-        return None
+            if os.path.isfile(destination_path) and self.file_index.get_hash(destination_path) != file_hash:
+                if DeltaDownloader([source], file_hash, destination_path, destination_path, bandwidth=self.bandwidth,
+                                   file_index=self.file_index).run():
+                    return True
+            return SwarmDownloader([source], file_hash, destination_path, bandwidth=self.bandwidth,
+                                   chunk_store=self.chunk_store, file_index=self.file_index).run()
+        except OSError as e:
+            logger.error(f"Error receiving file {file_hash} from {peer_ip}:{offer['transfer_port']}: {e}", exc_info=True)
+            return False
 
     def get_local_ip(self):
         
@@ -478,19 +817,13 @@ class DiscoverPeers:
             return '127.0.0.1'
         
     def list_all_files(self, directory):
-        files = {}
-        for root, _, filenames in os.walk(directory):
-            for filename in filenames:
-                file_path = os.path.join(root, filename)
-                tmp = self.hash_file(file_path)
-                files[tmp] = file_path
-        return files
-
-    def hash_file(self, filepath):
-        sha256_hash = hashlib.sha256()
+        if os.path.normpath(directory) == os.path.normpath(self.shared_directory):
+            self.file_index.refresh()
+            return self.file_index.as_dict()
 
-        with open(filepath, "rb") as f:
-            for byte_block in iter(lambda: f.read(4096), b""):
-                sha256_hash.update(byte_block)
+        file_paths = [os.path.join(root, filename) for root, _, filenames in os.walk(directory) for filename in filenames]
+        manifests = self.file_index.hashing_engine.hash_files(file_paths)
+        return {manifest["sha256"]: file_path for file_path, manifest in manifests.items()}
 
-        return sha256_hash.hexdigest()
\ No newline at end of file
+    def hash_file(self, filepath):
+        return ManifestManager.hash_file(filepath)
\ No newline at end of file
@@ -0,0 +1,226 @@
+import logging
+import random
+import socket
+import struct
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+import netifaces
+
+logger = logging.getLogger(__name__)
+
+DISCOVERY_BROADCAST = "broadcast"
+DISCOVERY_MULTICAST = "multicast"
+DISCOVERY_GOSSIP = "gossip"
+
+MULTICAST_GROUP_V4 = "239.255.77.77"
+MULTICAST_GROUP_V6 = "ff05::7777"
+MULTICAST_TTL = 8
+GOSSIP_FANOUT = 3
+GOSSIP_TABLE_SAMPLE = 32
+GOSSIP_PEER_TTL = 30.0
+
+
+def parse_peer_address(address: str, default_port: int) -> tuple:
+    address = address.strip()
+    if address.startswith("["):
+        host, _, rest = address[1:].partition("]")
+        port = rest.lstrip(":")
+        return host, int(port) if port else default_port
+    if address.count(":") == 1:
+        host, port = address.split(":")
+        return host, int(port)
+    return address, default_port
+
+
+class DiscoveryBackend(ABC):
+    name = ""
+
+    def __init__(self, node):
+        self.node = node
+
+    def open(self):
+        pass
+
+    @abstractmethod
+    def beacon_targets(self) -> List[tuple]:
+        pass
+
+    def query_targets(self) -> List[tuple]:
+        return self.beacon_targets()
+
+    def topology(self) -> tuple:
+        return tuple(sorted(self.beacon_targets()))
+
+    def decorate_beacon(self, message: Dict):
+        pass
+
+    def send(self, message: Dict, target: tuple, encoded: Dict) -> int:
+        self.node.send_message(message, target, encoded)
+        return 1
+
+    def handle_beacon(self, message: Dict, sender_ip: str):
+        pass
+
+
+class BroadcastBackend(DiscoveryBackend):
+    name = DISCOVERY_BROADCAST
+
+    def beacon_targets(self) -> List[tuple]:
+        return [(address, self.node.discovery_target_port) for address in self.node.get_broadcast_addresses()]
+
+
+class MulticastBackend(DiscoveryBackend):
+    name = DISCOVERY_MULTICAST
+
+    def __init__(self, node, groups: Optional[List[str]] = None, ttl: int = MULTICAST_TTL):
+        super().__init__(node)
+        self.requested_groups = groups or [MULTICAST_GROUP_V4, MULTICAST_GROUP_V6]
+        self.ttl = ttl
+        self.groups: List[str] = []
+        self.ipv4_interfaces: List[str] = []
+        self.ipv6_interfaces: List[int] = []
+
+    def open(self):
+        self.groups = []
+        self.ipv4_interfaces = []
+        self.ipv6_interfaces = []
+        for group in self.requested_groups:
+            try:
+                if ":" in group:
+                    self.join_ipv6(group)
+                else:
+                    self.join_ipv4(group)
+                self.groups.append(group)
+            except OSError as e:
+                logger.warning(f"Could not join multicast group {group}: {e}")
+        if not self.groups:
+            logger.error("No multicast group could be joined; discovery will not find any peers.")
+        logger.info(f"Multicast discovery on groups {self.groups} (TTL {self.ttl}).")
+
+    def join_ipv4(self, group: str):
+        sock = self.node.discovery_socket
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.ttl)
+        joined = []
+        # Join on every IPv4 interface so the group is heard whichever VLAN a peer sits on; send()
+        # beacons out of each of them for the same reason.
+        for interface_address in self.ipv4_interface_addresses():
+            membership = socket.inet_aton(group) + socket.inet_aton(interface_address)
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+                joined.append(interface_address)
+            except OSError as e:
+                logger.debug(f"Could not join {group} on {interface_address}: {e}")
+        self.ipv4_interfaces = list(dict.fromkeys(self.ipv4_interfaces + joined))
+        if not joined:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(group) + struct.pack("=I", socket.INADDR_ANY))
+
+    def join_ipv6(self, group: str):
+        sock = self.node.open_ipv6_socket()
+        sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_HOPS, self.ttl)
+        joined = []
+        for index, name in socket.if_nameindex():
+            membership = socket.inet_pton(socket.AF_INET6, group) + struct.pack("@I", index)
+            try:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, membership)
+                joined.append(index)
+            except OSError as e:
+                logger.debug(f"Could not join {group} on {name}: {e}")
+        self.ipv6_interfaces = list(dict.fromkeys(self.ipv6_interfaces + joined))
+        if not joined:
+            raise OSError(f"no interface accepted IPv6 group {group}")
+
+    def ipv4_interface_addresses(self) -> List[str]:
+        addresses = []
+        try:
+            for interface in netifaces.interfaces():
+                for link in netifaces.ifaddresses(interface).get(netifaces.AF_INET, []):
+                    if link.get("addr"):
+                        addresses.append(link["addr"])
+        except Exception as e:
+            logger.warning(f"Could not enumerate interfaces for multicast: {e}")
+        return addresses
+
+    def beacon_targets(self) -> List[tuple]:
+        return [(group, self.node.discovery_target_port) for group in self.groups]
+
+    def send(self, message: Dict, target: tuple, encoded: Dict) -> int:
+        # Without IP_MULTICAST_IF the kernel sends a group datagram out of the default route's
+        # interface only, so each beacon goes out once per joined interface. The send happens on the
+        # event loop right after the option is set, so no other datagram picks it up in between.
+        if ":" in target[0]:
+            sock, level, option = self.node.discovery_socket6, socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF
+            interfaces = [(index, struct.pack("@I", index)) for index in self.ipv6_interfaces]
+        else:
+            sock, level, option = self.node.discovery_socket, socket.IPPROTO_IP, socket.IP_MULTICAST_IF
+            interfaces = [(address, socket.inet_aton(address)) for address in self.ipv4_interfaces]
+        if sock is None or not interfaces:
+            return super().send(message, target, encoded)
+        sent = 0
+        for interface, value in interfaces:
+            try:
+                sock.setsockopt(level, option, value)
+                self.node.send_message(message, target, encoded)
+                sent += 1
+            except OSError as e:
+                logger.debug(f"Could not send to {target[0]} on interface {interface}: {e}")
+        if not sent:
+            raise OSError(f"no interface could send to {target[0]}")
+        return sent
+
+
+class GossipBackend(DiscoveryBackend):
+    name = DISCOVERY_GOSSIP
+
+    def __init__(self, node, bootstrap_peers: Optional[List[str]] = None, fanout: int = GOSSIP_FANOUT):
+        super().__init__(node)
+        self.bootstrap = [parse_peer_address(peer, node.discovery_target_port) for peer in bootstrap_peers or []]
+        self.fanout = fanout
+
+    def open(self):
+        # Peers are mostly heard about second hand, so they are given longer before they count as gone.
+        self.node.peer_registry.ttl = max(self.node.peer_registry.ttl, GOSSIP_PEER_TTL)
+        if not self.bootstrap:
+            logger.warning("Gossip discovery started without bootstrap peers; this node can only be found by others.")
+        logger.info(f"Gossip discovery with fanout {self.fanout}, bootstrap {self.bootstrap}.")
+
+    def known_addresses(self) -> List[tuple]:
+        return [(peer.ip, peer.port) for peer in self.node.peer_registry.values()]
+
+    def beacon_targets(self) -> List[tuple]:
+        known = self.known_addresses()
+        targets = random.sample(known, min(self.fanout, len(known)))
+        if len(known) < self.fanout and self.bootstrap:
+            targets.extend(address for address in self.bootstrap if address not in targets)
+        elif self.bootstrap:
+            # Keep touching a bootstrap node so partitions heal through it.
+            targets.append(random.choice(self.bootstrap))
+        return list(dict.fromkeys(targets))
+
+    def query_targets(self) -> List[tuple]:
+        return list(dict.fromkeys(self.known_addresses() + self.bootstrap))
+
+    def topology(self) -> tuple:
+        return tuple(self.bootstrap)
+
+    def decorate_beacon(self, message: Dict):
+        message['gossip'] = self.node.peer_registry.gossip_sample(GOSSIP_TABLE_SAMPLE)
+
+    def handle_beacon(self, message: Dict, sender_ip: str):
+        entries = message.get('gossip')
+        if isinstance(entries, list):
+            learned = self.node.peer_registry.merge_gossip(entries, self.node.node_id)
+            for key in learned:
+                logger.info(f"Learned peer {key} via gossip from {sender_ip}.")
+
+
+def create_discovery_backend(mode: str, node, bootstrap_peers: Optional[List[str]] = None,
+                             multicast_groups: Optional[List[str]] = None) -> DiscoveryBackend:
+    if mode == DISCOVERY_BROADCAST:
+        return BroadcastBackend(node)
+    if mode == DISCOVERY_MULTICAST:
+        return MulticastBackend(node, multicast_groups)
+    if mode == DISCOVERY_GOSSIP:
+        return GossipBackend(node, bootstrap_peers)
+    raise ValueError(f"Unknown discovery mode: {mode}")
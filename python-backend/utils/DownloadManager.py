@@ -0,0 +1,175 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_DOWNLOADS = 4
+MAX_FINISHED_JOBS = 200
+PROGRESS_EVENT_INTERVAL = 0.5
+RATE_SMOOTHING = 0.3
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+FINISHED_STATES = (JOB_COMPLETED, JOB_FAILED, JOB_CANCELLED)
+
+
+class DownloadJob:
+    def __init__(self, filename: str):
+        self.id = uuid.uuid4().hex
+        self.filename = filename
+        self.status = JOB_QUEUED
+        self.bytes_done = 0
+        self.total_bytes: Optional[int] = None
+        self.rate = 0.0
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.cancel_event = threading.Event()
+        self.future: Optional[Future] = None
+        self.last_sample: Optional[tuple] = None
+        self.last_event_at = 0.0
+
+    def record_progress(self, bytes_done: int, total_bytes: int):
+        now = time.monotonic()
+        if self.last_sample is not None:
+            elapsed = now - self.last_sample[0]
+            if elapsed > 0:
+                rate = (bytes_done - self.last_sample[1]) / elapsed
+                self.rate = rate if self.rate == 0 else (1 - RATE_SMOOTHING) * self.rate + RATE_SMOOTHING * rate
+        self.last_sample = (now, bytes_done)
+        self.bytes_done = bytes_done
+        self.total_bytes = total_bytes
+
+    @property
+    def eta(self) -> Optional[float]:
+        if self.total_bytes is None or self.rate <= 0:
+            return None
+        return max(self.total_bytes - self.bytes_done, 0) / self.rate
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "filename": self.filename,
+            "status": self.status,
+            "bytes_done": self.bytes_done,
+            "total_bytes": self.total_bytes,
+            "rate": round(self.rate, 1),
+            "eta": round(self.eta, 1) if self.eta is not None else None,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at
+        }
+
+
+class DownloadManager:
+    def __init__(self, download_function: Callable, max_workers: int = MAX_CONCURRENT_DOWNLOADS):
+        self.download_function = download_function
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Download")
+        self.jobs: "OrderedDict[str, DownloadJob]" = OrderedDict()
+        self.listeners: List[Callable[[Dict], None]] = []
+        self.lock = threading.Lock()
+
+    def submit(self, filename: str) -> DownloadJob:
+        job = DownloadJob(filename)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.prune_finished_jobs()
+        self.emit("download_queued", job)
+        job.future = self.executor.submit(self.run_job, job)
+        return job
+
+    def get_job(self, job_id: str) -> Optional[DownloadJob]:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self) -> List[Dict]:
+        with self.lock:
+            return [job.to_dict() for job in self.jobs.values()]
+
+    def cancel(self, job_id: str) -> bool:
+        job = self.get_job(job_id)
+        if job is None or job.status in FINISHED_STATES:
+            return False
+        job.cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            self.finish(job, JOB_CANCELLED)
+        return True
+
+    def add_listener(self, listener: Callable[[Dict], None]):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[Dict], None]):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def shutdown(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel_event.set()
+            # Jobs still waiting for a worker never reach run_job, so they are reported here.
+            if job.future is not None and job.future.cancel():
+                self.finish(job, JOB_CANCELLED)
+        self.executor.shutdown(wait=False)
+
+    def run_job(self, job: DownloadJob):
+        if job.cancel_event.is_set():
+            self.finish(job, JOB_CANCELLED)
+            return
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        self.emit("download_started", job)
+
+        def on_progress(bytes_done: int, total_bytes: int):
+            job.record_progress(bytes_done, total_bytes)
+            now = time.monotonic()
+            if now - job.last_event_at >= PROGRESS_EVENT_INTERVAL:
+                job.last_event_at = now
+                self.emit("download_progress", job)
+
+        try:
+            success = self.download_function(job.filename, progress_callback=on_progress, cancel_event=job.cancel_event)
+        except Exception as e:
+            logger.error(f"Download job {job.id} for '{job.filename}' raised: {e}", exc_info=True)
+            job.error = str(e)
+            success = False
+
+        if job.cancel_event.is_set():
+            self.finish(job, JOB_CANCELLED)
+        elif success:
+            self.finish(job, JOB_COMPLETED)
+        else:
+            job.error = job.error or "Download failed."
+            self.finish(job, JOB_FAILED)
+
+    def finish(self, job: DownloadJob, status: str):
+        job.status = status
+        job.finished_at = time.time()
+        self.emit(f"download_{status}", job)
+
+    def emit(self, event_type: str, job: DownloadJob):
+        event = {"type": event_type, "job": job.to_dict()}
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.warning(f"Download event listener failed: {e}")
+
+    def prune_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED_STATES]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
@@ -0,0 +1,509 @@
+import os
+import json
+import bisect
+import fnmatch
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set
+from utils.ManifestManager import ManifestManager, HashingEngine
+from utils.PartialDownload import PART_SUFFIX, BITMAP_SUFFIX
+
+logger = logging.getLogger(__name__)
+
+DATA_DIRECTORY = ".p2pdata"
+INDEX_FILE_NAME = "file_index.json"
+MANIFEST_DIRECTORY_NAME = "manifests"
+INDEX_FORMAT_VERSION = 1
+INDEX_REFRESH_INTERVAL = 30
+INDEX_PROGRESS_INTERVAL = 5.0
+IGNORED_SUFFIXES = (PART_SUFFIX, BITMAP_SUFFIX, BITMAP_SUFFIX + ".tmp")
+MATCH_EXACT = "exact"
+MATCH_GLOB = "glob"
+MATCH_SUBSTRING = "substring"
+GLOB_CHARACTERS = set("*?[")
+SORT_KEYS = {
+    "name": lambda f: (f["filename"].lower(), f["path"]),
+    "size": lambda f: (f["size"], f["path"]),
+    "mtime": lambda f: (f["mtime"], f["path"]),
+    "extension": lambda f: (os.path.splitext(f["filename"])[1].lower(), f["filename"].lower(), f["path"]),
+}
+MAX_CACHED_VIEWS = 8
+MAX_PAGE_SIZE = 1000
+
+
+class FileIndex:
+    def __init__(self, directory: str, index_path: Optional[str] = None, hashing_engine: Optional[HashingEngine] = None):
+        self.directory = directory
+        self.index_path = index_path or os.path.join(DATA_DIRECTORY, INDEX_FILE_NAME)
+        self.manifest_directory = os.path.join(os.path.dirname(self.index_path), MANIFEST_DIRECTORY_NAME)
+        self.hashing_engine = hashing_engine or HashingEngine()
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+        self.entries: Dict[str, Dict] = {}
+        self.paths_by_hash: Dict[str, Set[str]] = {}
+        self.paths_by_name: Dict[str, Set[str]] = {}
+        # Bumped on every add or remove so readers can cache anything derived from the index.
+        self.version = 0
+        self.listing_cache: Optional[tuple] = None
+        self.view_cache: OrderedDict = OrderedDict()
+        self.listeners: List[Callable[[str, str, Optional[Dict], int], None]] = []
+
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not load file index from {self.index_path}: {e}. Starting with an empty index.")
+            return
+
+        if data.get("version") != INDEX_FORMAT_VERSION or data.get("directory") != self.directory:
+            logger.info(f"Ignoring file index at {self.index_path} (format or directory changed).")
+            return
+
+        with self.lock:
+            for path, entry in data.get("files", {}).items():
+                entry.pop("manifest", None)
+                self._add_entry(path, entry)
+        logger.info(f"Loaded {len(self.entries)} entries from file index {self.index_path}")
+
+    def save(self):
+        with self.lock:
+            data = {
+                "version": INDEX_FORMAT_VERSION,
+                "directory": self.directory,
+                "files": dict(self.entries)
+            }
+        index_dir = os.path.dirname(self.index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        tmp_path = self.index_path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"Could not save file index to {self.index_path}: {e}")
+
+    def refresh(self) -> bool:
+        with self.refresh_lock:
+            seen: Set[str] = set()
+            to_hash: Dict[str, os.stat_result] = {}
+            changed = False
+            with self.lock:
+                entries_by_identity = {self._identity(entry): entry for entry in self.entries.values()}
+
+            for root, _, filenames in os.walk(self.directory):
+                for filename in filenames:
+                    if filename.endswith(IGNORED_SUFFIXES):
+                        continue
+                    file_path = os.path.join(root, filename)
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    seen.add(file_path)
+
+                    with self.lock:
+                        entry = self.entries.get(file_path)
+                    if entry and self._matches_stat(entry, stat):
+                        continue
+                    moved = entries_by_identity.get((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+                    if moved is not None:
+                        self._store(file_path, stat, moved["hash"])
+                        changed = True
+                    else:
+                        to_hash[file_path] = stat
+
+            with self.lock:
+                for file_path in [p for p in self.entries if p not in seen]:
+                    self._remove_entry(file_path)
+                    changed = True
+
+            if to_hash:
+                changed = self._hash_and_store(to_hash) or changed
+
+            if changed:
+                logger.info(f"File index refreshed: {len(self.entries)} files, {len(to_hash)} (re)hashed.")
+                self.save()
+                self.prune_manifests()
+            return changed
+
+    def _hash_and_store(self, to_hash: Dict[str, os.stat_result]) -> bool:
+        last_report = [time.monotonic()]
+
+        def on_progress(files_done: int, file_count: int, bytes_done: int, total_bytes: int):
+            now = time.monotonic()
+            if now - last_report[0] >= INDEX_PROGRESS_INTERVAL:
+                last_report[0] = now
+                logger.info(f"Indexing {self.directory}: {files_done}/{file_count} files, "
+                            f"{bytes_done / 1e9:.2f}/{total_bytes / 1e9:.2f} GB hashed.")
+
+        manifests = self.hashing_engine.hash_files(list(to_hash), on_progress)
+        changed = False
+        for file_path, manifest in manifests.items():
+            changed = self._store_manifest(file_path, to_hash[file_path], manifest) or changed
+        return changed
+
+    def _store_manifest(self, file_path: str, stat: os.stat_result, manifest: Dict) -> bool:
+        try:
+            current = os.stat(file_path)
+        except OSError:
+            return False
+        if not self._same_stat(stat, current) or manifest["size"] != stat.st_size:
+            logger.info(f"{file_path} changed while it was being hashed; it will be indexed on the next pass.")
+            return False
+        self.write_manifest(manifest)
+        self._store(file_path, stat, manifest["sha256"])
+        return True
+
+    def _store(self, file_path: str, stat: os.stat_result, file_hash: str):
+        with self.lock:
+            self._remove_entry(file_path)
+            self._add_entry(file_path, {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "inode": stat.st_ino,
+                "hash": file_hash
+            })
+
+    def update_path(self, file_path: str) -> bool:
+        if os.path.basename(file_path).endswith(IGNORED_SUFFIXES):
+            return False
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return self.remove_path(file_path)
+        if not os.path.isfile(file_path):
+            return False
+        with self.refresh_lock:
+            with self.lock:
+                entry = self.entries.get(file_path)
+            if entry and self._matches_stat(entry, stat):
+                return False
+            try:
+                manifest = ManifestManager.generate_file_manifest(file_path)
+            except OSError as e:
+                logger.warning(f"Could not hash {file_path}: {e}")
+                return False
+            changed = self._store_manifest(file_path, stat, manifest)
+        if changed:
+            logger.info(f"File index updated: {file_path}")
+        return changed
+
+    def store_verified(self, file_path: str, manifest: Dict) -> bool:
+        # For files whose content was just checked against manifest (a finished download), so the
+        # index entry can be written without reading the file again.
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+        with self.refresh_lock:
+            changed = self._store_manifest(file_path, stat, {**manifest, "filename": os.path.basename(file_path)})
+        if changed:
+            logger.info(f"File index updated: {file_path}")
+        return changed
+
+    def remove_path(self, path: str) -> bool:
+        prefix = path.rstrip(os.sep) + os.sep
+        with self.lock:
+            if path in self.entries:
+                removed = [path]
+            else:
+                removed = [p for p in self.entries if p.startswith(prefix)]
+            for file_path in removed:
+                self._remove_entry(file_path)
+        if removed:
+            logger.info(f"File index removed {len(removed)} entr{'y' if len(removed) == 1 else 'ies'} under {path}")
+        return bool(removed)
+
+    def rename_path(self, old_path: str, new_path: str) -> bool:
+        old_prefix = old_path.rstrip(os.sep) + os.sep
+        with self.lock:
+            if old_path in self.entries:
+                moves = [(old_path, new_path)]
+            else:
+                moves = [(p, os.path.join(new_path, p[len(old_prefix):])) for p in self.entries if p.startswith(old_prefix)]
+            for source, target in moves:
+                entry = self.entries[source]
+                self._remove_entry(source)
+                self._remove_entry(target)
+                self._add_entry(target, entry)
+        if moves:
+            logger.info(f"File index renamed {old_path} -> {new_path} ({len(moves)} file(s), no rehash)")
+        return bool(moves)
+
+    def start_auto_refresh(self, interval: int = INDEX_REFRESH_INTERVAL):
+        self.stop_event.clear()
+
+        def refresh_loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    logger.error(f"Error refreshing file index: {e}", exc_info=True)
+                if self.stop_event.wait(interval):
+                    break
+
+        threading.Thread(target=refresh_loop, daemon=True).start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get_path(self, file_hash: str) -> Optional[str]:
+        with self.lock:
+            paths = self.paths_by_hash.get(file_hash)
+            if not paths:
+                return None
+            return next(iter(paths))
+
+    def hashes(self) -> List[str]:
+        with self.lock:
+            return list(self.paths_by_hash)
+
+    def get_manifest(self, file_hash: str) -> Optional[Dict]:
+        file_path = self.get_path(file_hash)
+        if not file_path:
+            return None
+        manifest = self.read_manifest(file_hash)
+        if manifest is not None:
+            return manifest
+
+        try:
+            manifest = ManifestManager.generate_file_manifest(file_path)
+        except OSError as e:
+            logger.warning(f"Could not build manifest for {file_path}: {e}")
+            return None
+        if manifest["sha256"] != file_hash:
+            logger.warning(f"{file_path} changed since it was indexed; not serving a manifest for {file_hash}.")
+            return None
+        self.write_manifest(manifest)
+        return manifest
+
+    def manifest_path(self, file_hash: str) -> str:
+        return os.path.join(self.manifest_directory, f"{file_hash}.json")
+
+    def read_manifest(self, file_hash: str) -> Optional[Dict]:
+        try:
+            with open(self.manifest_path(file_hash), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Discarding unreadable manifest for {file_hash}: {e}")
+            return None
+        if manifest.get("sha256") != file_hash or len(manifest.get("chunks", [])) != manifest.get("chunk_count"):
+            return None
+        return manifest
+
+    def write_manifest(self, manifest: Dict):
+        manifest_path = self.manifest_path(manifest["sha256"])
+        if os.path.isfile(manifest_path):
+            return
+        tmp_path = f"{manifest_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.manifest_directory, exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, manifest_path)
+        except OSError as e:
+            logger.warning(f"Could not cache manifest for {manifest['sha256']}: {e}")
+
+    def prune_manifests(self):
+        try:
+            names = os.listdir(self.manifest_directory)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            live = {f"{file_hash}.json" for file_hash in self.paths_by_hash}
+        for name in names:
+            if name not in live:
+                try:
+                    os.remove(os.path.join(self.manifest_directory, name))
+                except OSError:
+                    pass
+
+    def get_hash(self, file_path: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(file_path)
+            return entry["hash"] if entry else None
+
+    def get_hash_by_name(self, filename: str) -> Optional[str]:
+        with self.lock:
+            paths = self.paths_by_name.get(filename)
+            if not paths:
+                return None
+            return self.entries[next(iter(paths))]["hash"]
+
+    def find_by_name(self, filename: str) -> List[str]:
+        with self.lock:
+            return list(self.paths_by_name.get(filename, ()))
+
+    def search(self, pattern: str, match: str = MATCH_EXACT, limit: Optional[int] = None) -> List[Dict]:
+        with self.lock:
+            if match == MATCH_EXACT:
+                names = [pattern] if pattern in self.paths_by_name else []
+            elif match == MATCH_GLOB:
+                lowered = pattern.lower()
+                names = [name for name in self.paths_by_name if fnmatch.fnmatchcase(name.lower(), lowered)]
+            elif match == MATCH_SUBSTRING:
+                lowered = pattern.lower()
+                names = [name for name in self.paths_by_name if lowered in name.lower()]
+            else:
+                raise ValueError(f"Unknown match mode: {match}")
+
+            results = []
+            for name in sorted(names):
+                for file_path in self.paths_by_name[name]:
+                    entry = self.entries[file_path]
+                    results.append({"filename": name, "path": file_path, "file_hash": entry["hash"], "size": entry["size"]})
+                    if limit is not None and len(results) >= limit:
+                        return results
+            return results
+
+    def files(self) -> tuple:
+        # The list is shared between callers until the next change; treat it as read-only.
+        with self.lock:
+            if self.listing_cache is not None and self.listing_cache[0] == self.version:
+                return self.listing_cache
+            version = self.version
+            entries = list(self.entries.items())
+        # Built outside the lock so lookups from the network are not held up by a large rebuild.
+        listing = [self.listing_entry(path, entry) for path, entry in sorted(entries)]
+        with self.lock:
+            if self.listing_cache is None or self.listing_cache[0] < version:
+                self.listing_cache = (version, listing)
+        return version, listing
+
+    def sorted_view(self, sort: str = "name", pattern: Optional[str] = None, extensions: Optional[List[str]] = None) -> tuple:
+        # Each (sort, filter) combination is sorted once per index version; pages are then bisected out of it.
+        if sort not in SORT_KEYS:
+            raise ValueError(f"Unknown sort key: {sort}")
+        extensions = tuple(sorted(e.lower().lstrip(".") for e in extensions)) if extensions else None
+        version, listing = self.files()
+        cache_key = (sort, pattern.lower() if pattern else None, extensions)
+        with self.lock:
+            cached = self.view_cache.get(cache_key)
+            if cached is not None and cached[0] == version:
+                self.view_cache.move_to_end(cache_key)
+                return cached
+
+        matches = self.listing_filter(pattern, extensions)
+        sort_key = SORT_KEYS[sort]
+        view = sorted((f for f in listing if matches(f)), key=sort_key)
+        cached = (version, view, [sort_key(f) for f in view])
+        with self.lock:
+            self.view_cache[cache_key] = cached
+            self.view_cache.move_to_end(cache_key)
+            while len(self.view_cache) > MAX_CACHED_VIEWS:
+                self.view_cache.popitem(last=False)
+        return cached
+
+    def page(self, sort: str = "name", descending: bool = False, pattern: Optional[str] = None,
+             extensions: Optional[List[str]] = None, cursor: Optional[list] = None, limit: int = 100) -> Dict:
+        # The cursor is the sort key of the last entry sent, so pages stay consistent while files come and go.
+        version, view, keys = self.sorted_view(sort, pattern, extensions)
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        cursor_key = tuple(cursor) if cursor is not None else None
+        if descending:
+            end = bisect.bisect_left(keys, cursor_key) if cursor_key is not None else len(view)
+            start = max(end - limit, 0)
+            files = view[start:end][::-1]
+            more = start > 0
+        else:
+            start = bisect.bisect_right(keys, cursor_key) if cursor_key is not None else 0
+            files = view[start:start + limit]
+            more = start + limit < len(view)
+        return {
+            "version": version,
+            "total": len(view),
+            "files": files,
+            "next_cursor": list(SORT_KEYS[sort](files[-1])) if more and files else None
+        }
+
+    def listing_filter(self, pattern: Optional[str], extensions: Optional[tuple]) -> Callable[[Dict], bool]:
+        extensions = {e.lower().lstrip(".") for e in extensions} if extensions else None
+        lowered = pattern.lower() if pattern else None
+        glob = bool(lowered) and bool(GLOB_CHARACTERS & set(lowered))
+
+        def matches(f: Dict) -> bool:
+            name = f["filename"].lower()
+            if extensions is not None and os.path.splitext(name)[1].lstrip(".") not in extensions:
+                return False
+            if lowered is None:
+                return True
+            return fnmatch.fnmatchcase(name, lowered) if glob else lowered in name
+        return matches
+
+    def add_listener(self, listener: Callable[[str, str, Optional[Dict], int], None]):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[str, str, Optional[Dict], int], None]):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def listing_entry(self, path: str, entry: Dict) -> Dict:
+        return {
+            "filename": os.path.basename(path),
+            "hash": entry["hash"],
+            "path": path,
+            "size": entry["size"],
+            "mtime": entry.get("mtime_ns", 0) / 1e9
+        }
+
+    def as_dict(self) -> Dict[str, str]:
+        with self.lock:
+            return {entry["hash"]: path for path, entry in self.entries.items()}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def _identity(self, entry: Dict):
+        return (entry.get("inode"), entry.get("size"), entry.get("mtime_ns"))
+
+    def _matches_stat(self, entry: Dict, stat: os.stat_result) -> bool:
+        return self._identity(entry) == (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _same_stat(self, before: os.stat_result, after: os.stat_result) -> bool:
+        return (before.st_ino, before.st_size, before.st_mtime_ns) == (after.st_ino, after.st_size, after.st_mtime_ns)
+
+    def _add_entry(self, file_path: str, entry: Dict):
+        self.version += 1
+        self.entries[file_path] = entry
+        self.paths_by_hash.setdefault(entry["hash"], set()).add(file_path)
+        self.paths_by_name.setdefault(os.path.basename(file_path), set()).add(file_path)
+        self._notify("added", file_path, entry)
+
+    def _remove_entry(self, file_path: str):
+        entry = self.entries.pop(file_path, None)
+        if not entry:
+            return
+        self.version += 1
+        for table, key in ((self.paths_by_hash, entry["hash"]), (self.paths_by_name, os.path.basename(file_path))):
+            paths = table.get(key)
+            if paths:
+                paths.discard(file_path)
+                if not paths:
+                    del table[key]
+        self._notify("removed", file_path, None)
+
+    def _notify(self, change: str, file_path: str, entry: Optional[Dict]):
+        # Called with the lock held; listeners only queue the change.
+        if not self.listeners:
+            return
+        listed = self.listing_entry(file_path, entry) if entry is not None else None
+        for listener in self.listeners:
+            try:
+                listener(change, file_path, listed, self.version)
+            except Exception as e:
+                logger.warning(f"File index listener failed: {e}")
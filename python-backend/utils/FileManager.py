@@ -1,26 +1,69 @@
 import socket
 import os
+import mmap
+import hashlib
 import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from utils.BandwidthScheduler import DOWNLOAD, PRIORITY_FOREGROUND, UPLOAD
+from utils.Compression import CODECS, MIN_SAVING, LevelController, looks_compressible, negotiate_codec, supported_codecs
+from utils.DeltaSync import (
+    COPY_INSTRUCTION, MAX_SIGNATURE_BLOCKS, SIGNATURE, DeltaEncoder, block_count_for, block_size_for, copy_range,
+    file_signatures
+)
+from utils.TransferProtocol import (
+    FRAME_HEADER, FRAME_REQUEST, FRAME_META, FRAME_DATA, FRAME_END, FRAME_ERROR, FRAME_MANIFEST,
+    FRAME_SIGNATURES, FRAME_COPY, FRAME_COMPRESSED, TRANSFER_CHUNK_SIZE, TransferError, tune_socket, send_frame, send_json_frame,
+    recv_exact, recv_exact_into, recv_frame_header, recv_json_payload, recv_json_frame
+)
+
+SENDFILE_AVAILABLE = hasattr(os, "sendfile")
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
+MAX_UPLOAD_WORKERS = 32
+MAX_UPLOADS_PER_PEER = 4
+LISTEN_BACKLOG = 128
+CONNECTION_IDLE_TIMEOUT = 60.0
+MAX_COMPRESSIBILITY_ENTRIES = 1024
 
 class FileServer:
-    def __init__(self, host, port):
+    def __init__(self, host, port, file_index=None, max_workers: int = MAX_UPLOAD_WORKERS,
+                 max_uploads_per_peer: int = MAX_UPLOADS_PER_PEER, backlog: int = LISTEN_BACKLOG,
+                 bandwidth=None):
         self.host = host
         self.port = port
         self.running = False
         self.server = None
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        self.public_files_dir = os.path.abspath(os.path.join(script_dir, "publicFiles"))
-        
+        self.file_index = file_index
+        self.bandwidth = bandwidth
+        self.max_workers = max_workers
+        self.max_uploads_per_peer = max_uploads_per_peer
+        self.backlog = backlog
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.connections_lock = threading.Lock()
+        self.active_connections = 0
+        self.connections_per_peer: Dict[str, int] = {}
+        self.compressibility_lock = threading.Lock()
+        self.compressibility: "OrderedDict[tuple, bool]" = OrderedDict()
+        self.sendfile_bytes = 0
+        if file_index is not None:
+            self.public_files_dir = os.path.abspath(file_index.directory)
+        else:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            self.public_files_dir = os.path.abspath(os.path.join(script_dir, "publicFiles"))
+
         if not os.path.isdir(self.public_files_dir):
             try:
-                
+                os.makedirs(self.public_files_dir, exist_ok=True)
                 print(f"FileServer: Created public files directory at '{self.public_files_dir}'")
             except OSError as e:
                 print(f"FileServer: CRITICAL - Failed to create public files directory '{self.public_files_dir}': {e}")
-        
+
         print(f"FileServer: Serving files from '{self.public_files_dir}'")
 
-    def send_file(self, requested_filename, conn):
+    def resolve_requested_path(self, requested_filename):
         if not os.path.isdir(self.public_files_dir):
             try:
                 print(f"FileServer: Public files directory '{self.public_files_dir}' not found. Attempting to recreate.")
@@ -28,104 +71,492 @@ class FileServer:
                 print(f"FileServer: Successfully recreated public files directory '{self.public_files_dir}'.")
             except OSError as e:
                 print(f"FileServer: FAILED to recreate public files directory '{self.public_files_dir}': {e}")
-                error_msg = b"ERROR: Server configuration issue (public directory could not be accessed or created)."
-                conn.sendall(error_msg)
-                return
-        
-        if not os.path.isdir(self.public_files_dir):
-             print(f"FileServer: CRITICAL - Public files directory '{self.public_files_dir}' is still not accessible after creation attempt.")
-             error_msg = b"ERROR: Server critical issue (public directory state invalid)."
-             conn.sendall(error_msg)
-             return
+                return None, "Server configuration issue (public directory could not be accessed or created)."
 
         if ".." in requested_filename or requested_filename.startswith('/') or requested_filename.startswith('\\'):
-            error_msg = b"ERROR: Invalid filename."
-            conn.sendall(error_msg)
             print(f"FileServer: Denied invalid filename request: '{requested_filename}'")
-            return
+            return None, "Invalid filename."
 
         prospective_path = os.path.join(self.public_files_dir, requested_filename)
         abs_file_path = os.path.abspath(prospective_path)
 
-        if not os.path.isdir(self.public_files_dir):
-            error_msg = b"ERROR: Server configuration issue (public directory not found)."
-            conn.sendall(error_msg)
-            print(f"FileServer: Error - Public files directory not found or not a directory: '{self.public_files_dir}'")
-            return
-            
         if not abs_file_path.startswith(self.public_files_dir + os.sep) and abs_file_path != self.public_files_dir:
-            error_msg = b"ERROR: Access denied."
-            conn.sendall(error_msg)
             print(f"FileServer: Denied access to '{abs_file_path}' (not within '{self.public_files_dir}')")
-            return
+            return None, "Access denied."
 
         if not os.path.isfile(abs_file_path):
-            error_msg = b"ERROR: File not found."
-            conn.sendall(error_msg)
             print(f"FileServer: File not found at '{abs_file_path}'")
+            return None, "File not found."
+
+        return abs_file_path, None
+
+    def resolve_request(self, request):
+        file_hash = request.get('file_hash')
+        if file_hash:
+            file_path = self.file_index.get_path(file_hash) if self.file_index is not None else None
+            if not file_path or not os.path.isfile(file_path):
+                print(f"FileServer: No local file with hash {file_hash}")
+                return None, "File not found."
+            return file_path, None
+        requested_filename = request.get('file_name')
+        if not requested_filename:
+            return None, "Request must name a file_hash or file_name."
+        return self.resolve_requested_path(requested_filename)
+
+    def throttle(self, peer, count, priority):
+        if self.bandwidth is not None and peer is not None:
+            self.bandwidth.acquire(UPLOAD, peer, count, priority)
+
+    def choose_codec(self, request, file_path):
+        # Compression is used only when the requester offers a codec we have and the file is not
+        # already compressed. The verdict is kept per file version since swarms ask for one chunk at a time.
+        codec = negotiate_codec(request.get('codecs'))
+        if codec is None:
+            return None
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        key = (file_path, stat.st_size, stat.st_mtime_ns)
+        with self.compressibility_lock:
+            verdict = self.compressibility.get(key)
+            if verdict is not None:
+                self.compressibility.move_to_end(key)
+        if verdict is None:
+            with open(file_path, 'rb') as f:
+                verdict = looks_compressible(f, file_path, stat.st_size)
+            with self.compressibility_lock:
+                self.compressibility[key] = verdict
+                while len(self.compressibility) > MAX_COMPRESSIBILITY_ENTRIES:
+                    self.compressibility.popitem(last=False)
+        return codec if verdict else None
+
+    def send_chunk(self, conn, data, peer=None, priority=PRIORITY_FOREGROUND, codec=None, controller=None):
+        payload = data
+        frame_type = FRAME_DATA
+        started = time.perf_counter()
+        if codec is not None and controller.should_compress():
+            compressed = codec.compress(data, controller.level)
+            if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                payload = compressed
+                frame_type = FRAME_COMPRESSED
+        self.throttle(peer, len(payload), priority)
+        send_frame(conn, frame_type, payload)
+        if codec is not None:
+            controller.record(len(data), len(payload), time.perf_counter() - started)
+
+    def send_file(self, file_path, conn, offset=0, length=None, peer=None, priority=PRIORITY_FOREGROUND,
+                  codec=None, controller=None):
+        with open(file_path, 'rb') as f:
+            available = os.fstat(f.fileno()).st_size - offset
+            if length is None:
+                length = available
+            if length > available:
+                raise IOError(f"File '{file_path}' ended {length - available} bytes before the requested range.")
+            # Compressed chunks have to pass through user space; send_range_buffered still hands chunks to
+            # sendfile whenever the controller has settled on sending raw.
+            if SENDFILE_AVAILABLE and codec is None:
+                self.send_range_zero_copy(f, conn, offset, length, peer, priority)
+            else:
+                self.send_range_buffered(f, conn, offset, length, peer, priority, codec, controller)
+
+    def send_range_zero_copy(self, f, conn, offset, length, peer=None, priority=PRIORITY_FOREGROUND):
+        position = offset
+        end = offset + length
+        while position < end:
+            count = min(TRANSFER_CHUNK_SIZE, end - position)
+            self.send_chunk_zero_copy(f, conn, position, count, peer, priority)
+            position += count
+
+    def send_chunk_zero_copy(self, f, conn, position, count, peer=None, priority=PRIORITY_FOREGROUND):
+        self.throttle(peer, count, priority)
+        conn.sendall(FRAME_HEADER.pack(FRAME_DATA, count), MSG_MORE)
+        sent = conn.sendfile(f, position, count)
+        if sent != count:
+            raise IOError(f"sendfile sent {sent} of {count} bytes at offset {position}.")
+        self.sendfile_bytes += count
+
+    def send_range_buffered(self, f, conn, offset, length, peer=None, priority=PRIORITY_FOREGROUND,
+                            codec=None, controller=None):
+        buffer = bytearray(TRANSFER_CHUNK_SIZE)
+        view = memoryview(buffer)
+        position = offset
+        end = offset + length
+        while position < end:
+            count = min(TRANSFER_CHUNK_SIZE, end - position)
+            if SENDFILE_AVAILABLE and controller is not None and not controller.should_compress():
+                # Raw chunks skip user space; they are still timed so the controller can probe a level again.
+                started = time.perf_counter()
+                self.send_chunk_zero_copy(f, conn, position, count, peer, priority)
+                controller.record(count, count, time.perf_counter() - started)
+            else:
+                f.seek(position)
+                count = f.readinto(view[:count])
+                if not count:
+                    raise IOError(f"File ended {end - position} bytes before the requested range.")
+                self.send_chunk(conn, view[:count], peer, priority, codec, controller)
+            position += count
+
+    def send_manifest(self, request, conn):
+        manifest = self.file_index.get_manifest(request.get('file_hash', '')) if self.file_index is not None else None
+        if manifest is None:
+            send_json_frame(conn, FRAME_ERROR, {"error": "File not found."})
             return
+        send_json_frame(conn, FRAME_MANIFEST, manifest)
+
+    def recv_signatures(self, conn, block_count):
+        expected = block_count * SIGNATURE.size
+        signatures = bytearray()
+        while len(signatures) < expected:
+            header = recv_frame_header(conn)
+            if header is None:
+                raise TransferError("Connection closed while receiving block signatures.")
+            frame_type, length = header
+            if frame_type != FRAME_SIGNATURES or len(signatures) + length > expected:
+                raise TransferError(f"Unexpected frame type {frame_type} of {length} bytes in the signature stream.")
+            signatures += recv_exact(conn, length)
+        return bytes(signatures)
 
+    def send_delta(self, request, conn, peer=None, controller=None):
+        # The requester holds an older copy; it sends block signatures of that copy and gets back copy
+        # instructions for the blocks it already has and the literal bytes of everything else.
         try:
-            with open(abs_file_path, 'rb') as f:
-                while chunk := f.read(1024):
-                    conn.sendall(chunk)
-            print(f"FileServer: Successfully sent file '{abs_file_path}'")
-        except IOError as e:
-            print(f"FileServer: IOError sending file '{abs_file_path}': {e}")
-            conn.sendall(b"ERROR: Could not read or send file.")
+            block_size = int(request['block_size'])
+            basis_size = int(request['basis_size'])
+            block_count = block_count_for(basis_size, block_size)
+            if basis_size < 0 or block_count > MAX_SIGNATURE_BLOCKS or int(request['block_count']) != block_count:
+                raise ValueError(f"{request['block_count']} blocks of {block_size} bytes do not describe {basis_size} bytes")
+            signatures = self.recv_signatures(conn, block_count)
+            encoder = DeltaEncoder(signatures, block_size, basis_size)
+        except (KeyError, ValueError) as e:
+            send_json_frame(conn, FRAME_ERROR, {"error": f"Invalid delta request: {e}"})
+            return
+
+        file_path, error = self.resolve_request(request)
+        if error:
+            send_json_frame(conn, FRAME_ERROR, {"error": error})
+            return
+        priority = request.get('priority', PRIORITY_FOREGROUND)
+        codec = self.choose_codec(request, file_path)
+        with open(file_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            meta = {
+                'file_name': os.path.basename(file_path),
+                'size': file_size,
+                'offset': 0,
+                'length': file_size,
+                'delta': True
+            }
+            if codec is not None:
+                meta['codec'] = codec.name
+            send_json_frame(conn, FRAME_META, meta)
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if file_size else b""
+            try:
+                for instruction in encoder.encode(data):
+                    if instruction[0] == "copy":
+                        send_frame(conn, FRAME_COPY, COPY_INSTRUCTION.pack(instruction[1], instruction[2]))
+                    else:
+                        self.send_chunk(conn, instruction[1], peer, priority, codec, controller)
+            finally:
+                if file_size:
+                    data.close()
+        send_frame(conn, FRAME_END)
+        print(f"FileServer: Sent delta of '{file_path}': {encoder.stats['literal_bytes']} literal bytes, "
+              f"{encoder.stats['copied_bytes']} bytes copied from the requester's copy")
+
+    def handle_request(self, request, conn, peer=None, controller=None):
+        controller = controller or LevelController()
+        if request.get('kind') == 'manifest':
+            self.send_manifest(request, conn)
+            return
+        if request.get('kind') == 'delta':
+            self.send_delta(request, conn, peer, controller)
+            return
+
+        file_path, error = self.resolve_request(request)
+        if error:
+            send_json_frame(conn, FRAME_ERROR, {"error": error})
+            return
+
+        file_size = os.path.getsize(file_path)
+        offset = int(request.get('offset', 0))
+        length = file_size - offset if request.get('length') is None else int(request['length'])
+        if offset < 0 or offset > file_size or length < 0:
+            send_json_frame(conn, FRAME_ERROR, {"error": "Invalid range."})
+            return
+        length = min(length, file_size - offset)
+
+        codec = self.choose_codec(request, file_path) if length else None
+        meta = {
+            'file_name': os.path.basename(file_path),
+            'size': file_size,
+            'offset': offset,
+            'length': length
+        }
+        if codec is not None:
+            meta['codec'] = codec.name
+        send_json_frame(conn, FRAME_META, meta)
+        # The downloader says whether the transfer is interactive or background replication.
+        self.send_file(file_path, conn, offset, length, peer, request.get('priority', PRIORITY_FOREGROUND),
+                       codec, controller)
+        send_frame(conn, FRAME_END)
+        print(f"FileServer: Sent {length} bytes of '{file_path}' starting at {offset}")
+
+    def handle_connection(self, conn, addr):
+        tune_socket(conn)
+        controller = LevelController()
+        try:
+            while self.running:
+                header = recv_frame_header(conn)
+                if header is None:
+                    break
+                frame_type, length = header
+                request = recv_json_payload(conn, length)
+                if frame_type != FRAME_REQUEST:
+                    send_json_frame(conn, FRAME_ERROR, {"error": f"Unexpected frame type {frame_type}."})
+                    break
+                try:
+                    self.handle_request(request, conn, addr[0], controller)
+                except IOError as e:
+                    print(f"FileServer: IOError sending file for request {request}: {e}")
+                    send_json_frame(conn, FRAME_ERROR, {"error": "Could not read or send file."})
+                    break
+        except (TransferError, ValueError, OSError) as e:
+            print(f"FileServer: Connection with {addr} ended: {e}")
+        finally:
+            conn.close()
+
+    def admit_connection(self, peer_ip):
+        with self.connections_lock:
+            if self.active_connections >= self.max_workers:
+                return "Server busy (upload limit reached)."
+            if self.connections_per_peer.get(peer_ip, 0) >= self.max_uploads_per_peer:
+                return "Server busy (per-peer upload limit reached)."
+            self.active_connections += 1
+            self.connections_per_peer[peer_ip] = self.connections_per_peer.get(peer_ip, 0) + 1
+            return None
+
+    def release_connection(self, peer_ip):
+        with self.connections_lock:
+            self.active_connections -= 1
+            remaining = self.connections_per_peer.get(peer_ip, 1) - 1
+            if remaining > 0:
+                self.connections_per_peer[peer_ip] = remaining
+            else:
+                self.connections_per_peer.pop(peer_ip, None)
+
+    def serve_connection(self, conn, addr):
+        try:
+            self.handle_connection(conn, addr)
         except Exception as e:
-            print(f"FileServer: Unexpected error sending file '{abs_file_path}': {e}")
-            conn.sendall(b"ERROR: Server error while sending file.")
+            print(f"FileServer: Unexpected error serving {addr}: {e}")
+            conn.close()
+        finally:
+            self.release_connection(addr[0])
 
     def start_server(self):
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server.bind((self.host, self.port))
-        self.server.listen(5)
+        self.server.listen(self.backlog)
         self.server.settimeout(1.0)
-        print("Dosya sunucusu başlatıldı...")
-        
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="FileServer")
+        print(f"Dosya sunucusu başlatıldı... ({self.max_workers} workers, {self.max_uploads_per_peer} per peer)")
+
         self.running = True
-        
+
         while self.running:
             try:
                 conn, addr = self.server.accept()
+                conn.settimeout(CONNECTION_IDLE_TIMEOUT)
                 print("Bağlantı geldi:", addr)
-                
-                requested_file = conn.recv(1024).decode()
-                print("İstenen dosya:", requested_file)
-                
-                self.send_file(requested_file, conn)
-                conn.close()
+                rejection = self.admit_connection(addr[0])
+                if rejection:
+                    print(f"FileServer: Rejecting {addr}: {rejection}")
+                    try:
+                        send_json_frame(conn, FRAME_ERROR, {"error": rejection, "busy": True})
+                    except OSError:
+                        pass
+                    conn.close()
+                    continue
+                self.executor.submit(self.serve_connection, conn, addr)
             except socket.timeout:
                 continue
             except Exception as e:
-                print(f"Dosya sunucusu hatası: {e}")
-    
+                if self.running:
+                    print(f"Dosya sunucusu hatası: {e}")
+
     def stop_server(self):
         self.running = False
         if self.server:
             self.server.close()
+        if self.executor:
+            self.executor.shutdown(wait=False)
         print("Dosya sunucusu durduruldu.")
 
 class FileClient:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, timeout: float = 30.0, bandwidth=None, priority: str = PRIORITY_FOREGROUND,
+                 codecs: Optional[List[str]] = None):
         self.ip = ip
         self.port = port
+        self.timeout = timeout
+        self.bandwidth = bandwidth
+        self.priority = priority
+        self.codecs = supported_codecs() if codecs is None else codecs
+        self.client: Optional[socket.socket] = None
+        self.buffer = bytearray(TRANSFER_CHUNK_SIZE)
 
-    def request_file(self, filename):
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((self.ip, self.port))
+    def connect(self):
+        if self.client is None:
+            self.client = socket.create_connection((self.ip, self.port), timeout=self.timeout)
+            tune_socket(self.client)
 
-        client.send(filename.encode()) 
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
 
-        with open(f'received_{filename}', 'wb') as f:
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def codec_for(self, meta):
+        name = meta.get('codec')
+        if name is None:
+            return None
+        if name not in self.codecs or name not in CODECS:
+            raise TransferError(f"Server chose codec {name!r}, which was not offered.")
+        return CODECS[name]
+
+    def recv_data(self, frame_type, length, codec, view):
+        # Receives one DATA or COMPRESSED frame and returns the raw bytes it carries.
+        if self.bandwidth is not None:
+            # Not reading lets TCP flow control slow the sender down. Only wire bytes count.
+            self.bandwidth.acquire(DOWNLOAD, self.ip, length, self.priority)
+        recv_exact_into(self.client, view[:length])
+        if frame_type == FRAME_DATA:
+            return view[:length]
+        try:
+            return codec.decompress(view[:length], TRANSFER_CHUNK_SIZE)
+        except ValueError as e:
+            raise TransferError(f"Could not decompress a chunk: {e}")
+
+    def is_data_frame(self, frame_type, length, codec):
+        if length > len(self.buffer):
+            return False
+        return frame_type == FRAME_DATA or (frame_type == FRAME_COMPRESSED and codec is not None)
+
+    def request(self, request, file_obj):
+        self.connect()
+        send_json_frame(self.client, FRAME_REQUEST, {**request, 'priority': self.priority, 'codecs': self.codecs})
+        meta = recv_json_frame(self.client, FRAME_META)
+        codec = self.codec_for(meta)
+
+        view = memoryview(self.buffer)
+        received = 0
+        while True:
+            header = recv_frame_header(self.client)
+            if header is None:
+                raise TransferError("Connection closed before the end of the transfer.")
+            frame_type, length = header
+            if frame_type == FRAME_END:
+                break
+            if frame_type == FRAME_ERROR:
+                raise TransferError(recv_json_payload(self.client, length).get("error", "Remote error."))
+            if not self.is_data_frame(frame_type, length, codec):
+                raise TransferError(f"Unexpected frame type {frame_type} of {length} bytes.")
+            data = self.recv_data(frame_type, length, codec, view)
+            file_obj.write(data)
+            received += len(data)
+
+        if received != meta['length']:
+            raise TransferError(f"Received {received} bytes, expected {meta['length']}.")
+        return meta
+
+    def request_delta(self, file_hash, basis_path, file_obj, cancel_event=None, progress_callback=None):
+        # Rebuilds the file into file_obj, written front to back, from basis_path plus what the server
+        # sends. Returns the server's metadata with the SHA-256 of what was written and transfer stats.
+        self.connect()
+        with open(basis_path, 'rb') as basis:
+            basis_size = os.fstat(basis.fileno()).st_size
+            block_size = block_size_for(basis_size)
+            signatures = file_signatures(basis, block_size)
+            send_json_frame(self.client, FRAME_REQUEST, {
+                'kind': 'delta',
+                'file_hash': file_hash,
+                'block_size': block_size,
+                'basis_size': basis_size,
+                'block_count': block_count_for(basis_size, block_size),
+                'priority': self.priority,
+                'codecs': self.codecs
+            })
+            frame_size = TRANSFER_CHUNK_SIZE - TRANSFER_CHUNK_SIZE % SIGNATURE.size
+            for start in range(0, len(signatures), frame_size):
+                send_frame(self.client, FRAME_SIGNATURES, signatures[start:start + frame_size])
+            meta = recv_json_frame(self.client, FRAME_META)
+            codec = self.codec_for(meta)
+
+            sha256 = hashlib.sha256()
+            view = memoryview(self.buffer)
+            stats = {'literal_bytes': 0, 'copied_bytes': 0}
             while True:
-                data = client.recv(1024)
-                if not data:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise TransferError("Cancelled.")
+                header = recv_frame_header(self.client)
+                if header is None:
+                    raise TransferError("Connection closed before the end of the transfer.")
+                frame_type, length = header
+                if frame_type == FRAME_END:
                     break
-                if b"ERROR" in data:
-                    print(data.decode()) 
-                    break
-                f.write(data)
+                if frame_type == FRAME_ERROR:
+                    raise TransferError(recv_json_payload(self.client, length).get("error", "Remote error."))
+                if frame_type == FRAME_COPY and length == COPY_INSTRUCTION.size:
+                    first_block, block_count = COPY_INSTRUCTION.unpack(recv_exact(self.client, length))
+                    offset, remaining = copy_range(first_block, block_count, block_size, basis_size)
+                    stats['copied_bytes'] += remaining
+                    while remaining:
+                        data = os.pread(basis.fileno(), min(remaining, TRANSFER_CHUNK_SIZE), offset)
+                        if not data:
+                            raise TransferError(f"{basis_path} shrank while it was being used as a delta basis.")
+                        sha256.update(data)
+                        file_obj.write(data)
+                        offset += len(data)
+                        remaining -= len(data)
+                elif self.is_data_frame(frame_type, length, codec):
+                    # A server without delta support answers with the whole file, which lands here too.
+                    data = self.recv_data(frame_type, length, codec, view)
+                    sha256.update(data)
+                    file_obj.write(data)
+                    stats['literal_bytes'] += len(data)
+                else:
+                    raise TransferError(f"Unexpected frame type {frame_type} of {length} bytes.")
+                if progress_callback is not None:
+                    progress_callback(stats['literal_bytes'] + stats['copied_bytes'], meta['size'])
+
+        written = stats['literal_bytes'] + stats['copied_bytes']
+        if written != meta['size']:
+            raise TransferError(f"Rebuilt {written} bytes, expected {meta['size']}.")
+        return {**meta, **stats, 'sha256': sha256.hexdigest()}
 
-        client.close()
\ No newline at end of file
+    def request_manifest(self, file_hash):
+        self.connect()
+        send_json_frame(self.client, FRAME_REQUEST, {'kind': 'manifest', 'file_hash': file_hash})
+        return recv_json_frame(self.client, FRAME_MANIFEST)
+
+    def request_range(self, file_hash, offset, length, file_obj):
+        return self.request({'file_hash': file_hash, 'offset': offset, 'length': length}, file_obj)
+
+    def request_file(self, file_hash, destination_path, offset=0, length=None):
+        request = {'file_hash': file_hash, 'offset': offset}
+        if length is not None:
+            request['length'] = length
+        mode = 'r+b' if offset and os.path.exists(destination_path) else 'wb'
+        try:
+            with open(destination_path, mode) as f:
+                f.seek(offset)
+                return self.request(request, f)
+        finally:
+            self.close()
@@ -1,38 +1,130 @@
 import os
 import hashlib
 import json
-from typing import List, Dict
-import socket
+import logging
 import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator, List, Dict, Optional
+import socket
+
+logger = logging.getLogger(__name__)
 
 CHUNK_SIZE = 1024 * 1024 
+HASH_READ_SIZE = 8 * CHUNK_SIZE
+HASH_WORKERS = min(32, os.cpu_count() or 4)
 
 class ManifestManager:
     @staticmethod
-    def generate_file_manifest(file_path: str) -> Dict:
-        file_size = os.path.getsize(file_path)
-        chunk_count = (file_size + CHUNK_SIZE - 1) // CHUNK_SIZE
-        
+    def generate_file_manifest(file_path: str, progress_callback: Optional[Callable[[int], None]] = None) -> Dict:
+        # One sequential pass: the whole-file hash and every chunk hash are fed from the same read.
+        # hashlib releases the GIL on large buffers, so several of these run in parallel on threads.
         sha256 = hashlib.sha256()
-        with open(file_path, "rb") as f:
-            while chunk := f.read(8192):
-                sha256.update(chunk)
+        chunk_hashes: List[str] = []
+        buffer = bytearray(HASH_READ_SIZE)
+        view = memoryview(buffer)
+        file_size = 0
+        with open(file_path, "rb", buffering=0) as f:
+            while True:
+                count = 0
+                while count < HASH_READ_SIZE and (read := f.readinto(view[count:])):
+                    count += read
+                if not count:
+                    break
+                for start in range(0, count, CHUNK_SIZE):
+                    chunk = view[start:min(start + CHUNK_SIZE, count)]
+                    sha256.update(chunk)
+                    chunk_hashes.append(ManifestManager.hash_chunk(chunk))
+                file_size += count
+                if progress_callback is not None:
+                    progress_callback(count)
+                if count < HASH_READ_SIZE:
+                    break
 
         return {
             "filename": os.path.basename(file_path),
             "size": file_size,
             "sha256": sha256.hexdigest(),
-            "chunk_count": chunk_count
+            "chunk_size": CHUNK_SIZE,
+            "chunk_count": len(chunk_hashes),
+            "chunks": chunk_hashes
         }
 
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        sha256 = hashlib.sha256()
+        buffer = bytearray(HASH_READ_SIZE)
+        view = memoryview(buffer)
+        with open(file_path, "rb", buffering=0) as f:
+            while count := f.readinto(buffer):
+                sha256.update(view[:count])
+        return sha256.hexdigest()
+
+    @staticmethod
+    def chunk_range(manifest: Dict, chunk_index: int) -> tuple[int, int]:
+        offset = chunk_index * manifest["chunk_size"]
+        return offset, min(manifest["chunk_size"], manifest["size"] - offset)
+
+    @staticmethod
+    def hash_chunk(data) -> str:
+        # Chunks are addressed by this hash, so two files holding the same bytes share the key.
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def iter_chunks(manifest: Dict) -> Iterator[tuple[int, str, int, int]]:
+        for chunk_index, chunk_hash in enumerate(manifest["chunks"]):
+            offset, length = ManifestManager.chunk_range(manifest, chunk_index)
+            yield chunk_index, chunk_hash, offset, length
+
     @staticmethod
     def generate_manifest_for_directory(directory_path: str) -> List[Dict]:
-        manifest: List[Dict] = []
-        
-        for root, dirs, files in os.walk(directory_path):
-            for name in files:
-                file_path = os.path.join(root, name)
-                manifest_entry = ManifestManager.generate_file_manifest(file_path)
-                manifest.append(manifest_entry)
-
-        return manifest
+        file_paths = [os.path.join(root, name) for root, dirs, files in os.walk(directory_path) for name in files]
+        manifests = HashingEngine().hash_files(file_paths)
+        return [manifests[file_path] for file_path in file_paths if file_path in manifests]
+
+
+class HashingEngine:
+    def __init__(self, max_workers: int = HASH_WORKERS):
+        self.max_workers = max_workers
+
+    def hash_files(self, file_paths: List[str],
+                   progress_callback: Optional[Callable[[int, int, int, int], None]] = None) -> Dict[str, Dict]:
+        total_bytes = 0
+        for file_path in file_paths:
+            try:
+                total_bytes += os.path.getsize(file_path)
+            except OSError:
+                pass
+
+        lock = threading.Lock()
+        progress = {"files": 0, "bytes": 0}
+
+        def on_bytes(count: int):
+            with lock:
+                progress["bytes"] += count
+                snapshot = (progress["files"], len(file_paths), progress["bytes"], total_bytes)
+            if progress_callback is not None:
+                progress_callback(*snapshot)
+
+        manifests: Dict[str, Dict] = {}
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="Hasher") as executor:
+            futures = {executor.submit(ManifestManager.generate_file_manifest, file_path, on_bytes): file_path
+                       for file_path in file_paths}
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    manifests[file_path] = future.result()
+                except OSError as e:
+                    logger.warning(f"Could not hash {file_path}: {e}")
+                with lock:
+                    progress["files"] += 1
+                    snapshot = (progress["files"], len(file_paths), progress["bytes"], total_bytes)
+                if progress_callback is not None:
+                    progress_callback(*snapshot)
+
+        elapsed = time.monotonic() - started
+        if file_paths:
+            logger.info(f"Hashed {len(manifests)}/{len(file_paths)} files ({progress['bytes'] / 1e6:.1f} MB) in {elapsed:.2f}s "
+                        f"({progress['bytes'] / 1e6 / max(elapsed, 1e-6):.1f} MB/s, {self.max_workers} hashing threads).")
+        return manifests
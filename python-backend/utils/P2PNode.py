@@ -1,7 +1,16 @@
 import logging
 from utils.DiscoverPeers import DiscoverPeers
+from utils.DiscoveryBackends import DISCOVERY_BROADCAST
+from utils.DHT import DHTNode
+from utils.BandwidthScheduler import BandwidthScheduler, PRIORITY_FOREGROUND
+from utils.FileIndex import FileIndex
+from utils.ChunkStore import ChunkStore
 import threading
-from utils.FileManager import FileServer, FileClient
+from utils.FileManager import FileServer
+from utils.SwarmDownloader import SwarmDownloader
+from utils.DeltaDownloader import DeltaDownloader
+from utils.DownloadManager import DownloadManager
+from utils.ReplicationService import ReplicationService
 import os
 from utils.websocket import run_server as run_websocket_server
 
@@ -9,18 +18,43 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(level
 logger = logging.getLogger(__name__)
 
 class P2PNode:
-    def __init__(self, port: int = 5003, web_socket_port: int = 8765):
+    def __init__(self, port: int = 5003, web_socket_port: int = 8765, transfer_port: int = 5001,
+                 discovery_mode: str = DISCOVERY_BROADCAST, bootstrap_peers: list | None = None,
+                 dht_port: int | None = 5004, shared_directory: str = "publicFiles",
+                 upload_limit: float | None = None, download_limit: float | None = None,
+                 replication_quota: int | None = None):
         self.port = port
         self.web_socket_port = web_socket_port
+        self.transfer_port = transfer_port
         logger.info(f"Initializing P2PNode on port {port} with WebSocket port {web_socket_port}")
 
         self.peers = []
-        self.files = {}
-        logger.info(f"Indexed files: {self.files}")
+        # One catalogue of the shared directory, used by discovery, the DHT, the file server and the WebSocket API.
+        self.file_index = FileIndex(shared_directory)
+        logger.info(f"Indexed files: {len(self.file_index)}")
+        # Every chunk of every shared file by hash, so downloads reuse bytes we already hold.
+        self.chunk_store = ChunkStore(self.file_index)
+        # Uploads, downloads and WebSocket streams all draw from the same token buckets.
+        self.bandwidth = BandwidthScheduler(upload_rate=upload_limit, download_rate=download_limit)
 
-        self.peer_discovery = DiscoverPeers(self.port)
-        self.file_server = FileServer(host="localhost", port=5001) 
-        self.file_client = FileClient(ip="localhost", port=5002)
+        self.peer_discovery = DiscoverPeers(self.port, shared_directory=shared_directory, transfer_port=self.transfer_port,
+                                            discovery_mode=discovery_mode, bootstrap_peers=bootstrap_peers,
+                                            file_index=self.file_index, bandwidth=self.bandwidth,
+                                            chunk_store=self.chunk_store)
+        self.dht = None
+        if dht_port is not None:
+            self.dht = DHTNode(port=dht_port, file_index=self.file_index,
+                               transfer_port=self.transfer_port, discovery_port=self.port)
+            self.peer_discovery.dht = self.dht
+        self.file_server = FileServer(host="0.0.0.0", port=self.transfer_port, file_index=self.file_index,
+                                      bandwidth=self.bandwidth)
+        self.download_manager = DownloadManager(self.receive_file_from_peer)
+        # Optional: prefetch files the network keeps asking for, in the background and within a disk quota.
+        self.replication = None
+        if replication_quota:
+            self.replication = ReplicationService(self.file_index, self.find_sources, replication_quota,
+                                                  bandwidth=self.bandwidth, chunk_store=self.chunk_store)
+            self.peer_discovery.add_query_listener(self.replication.observe_query)
 
         self.web_socket_thread = threading.Thread(
             target=run_websocket_server,
@@ -30,41 +64,103 @@ class P2PNode:
         self.web_socket_thread.start()
         logger.info(f"WebSocket server thread started, listening on ws://localhost:{self.web_socket_port}")
 
+        if self.dht is not None:
+            self.dht.start()
         self.peer_discovery.start_discovery()
+        threading.Thread(target=self.chunk_store.sync, daemon=True).start()
+        if self.replication is not None:
+            self.replication.start()
 
         self.file_server_thread = threading.Thread(target=self.file_server.start_server, daemon=True)
         self.file_server_thread.start()
 
         logger.info("P2P Node initialized")
 
-    def receive_file_from_peer(self, requested_filename: str):
+    def stop(self):
+        logger.info("Stopping P2P node")
+        self.download_manager.shutdown()
+        if self.replication is not None:
+            self.replication.stop()
+        self.file_server.stop_server()
+        self.peer_discovery.stop_discovery()
+        if self.dht is not None:
+            self.dht.stop()
+
+    def find_sources_via_dht(self, requested_filename: str) -> list:
+        if self.dht is None:
+            return []
+        named = self.dht.find_by_name(requested_filename)
+        if not named:
+            logger.info(f"DHT has no provider for '{requested_filename}'; falling back to a network query.")
+            return []
+        counts = {}
+        for provider in named:
+            counts[provider['file_hash']] = counts.get(provider['file_hash'], 0) + 1
+        file_hash = max(counts, key=counts.get)
+        # The content key also lists peers that share the same bytes under another name.
+        providers = self.dht.find_providers(file_hash) + [p for p in named if p['file_hash'] == file_hash]
+        sources = {}
+        for provider in providers:
+            if provider.get('transfer_port') and provider.get('port'):
+                sources[f"{provider['peer_ip']}:{provider['port']}"] = {
+                    'peer_ip': provider['peer_ip'],
+                    'port': provider['port'],
+                    'transfer_port': provider['transfer_port'],
+                    'file_hash': file_hash
+                }
+        logger.info(f"DHT found {len(sources)} provider(s) for '{requested_filename}' (hash {file_hash}).")
+        return list(sources.values())
+
+    def find_sources(self, requested_filename: str) -> list:
+        sources = self.find_sources_via_dht(requested_filename)
+        if not sources:
+            sources = self.peer_discovery.find_file_sources(requested_filename)
+        return sources
+
+    def receive_file_from_peer(self, requested_filename: str, progress_callback=None, cancel_event=None,
+                               priority: str = PRIORITY_FOREGROUND) -> bool:
         logger.info(f"Attempting to download file from network: {requested_filename}")
 
-        source_info = self.peer_discovery.find_file_source(requested_filename)
-
-        if source_info and source_info[0] and source_info[1] and source_info[2]:
-            peer_ip, peer_port, file_hash_on_peer = source_info
-            logger.info(f"File source found: {requested_filename} (hash: {file_hash_on_peer}) on peer: {peer_ip}:{peer_port}")
-
-            download_directory = "publicFiles"
-            if not os.path.exists(download_directory):
-                try:
-                    logger.info(f"Created directory: {download_directory}")
-                except OSError as e:
-                    logger.error(f"Could not create directory {download_directory}: {e}")
-                    return
-
-            destination_path = os.path.join(download_directory, requested_filename)
-            logger.info(f"Requesting file {requested_filename} (hash: {file_hash_on_peer}) from {peer_ip}:{peer_port} to {destination_path}")
-
-            try:
-                success = self.peer_discovery.receive_file(peer_ip, peer_port, file_hash_on_peer, destination_path)
-                print(success)
-                if success:
-                    logger.info(f"'{requested_filename}' received successfully and saved to '{destination_path}'.")
-                else:
-                    logger.warning(f"Failed to receive '{requested_filename}' from {peer_ip}:{peer_port}.")
-            except Exception as e:
-                logger.error(f"Error during file reception for '{requested_filename}' from {peer_ip}:{peer_port}: {e}", exc_info=True)
-        else:
+        sources = self.find_sources(requested_filename)
+        if not sources:
             logger.warning(f"File '{requested_filename}' not found on the network via broadcast.")
+            return False
+
+        sources_by_hash = {}
+        for source in sources:
+            sources_by_hash.setdefault(source['file_hash'], []).append(source)
+        file_hash_on_peers, swarm_sources = max(sources_by_hash.items(), key=lambda item: len(item[1]))
+        if len(sources_by_hash) > 1:
+            logger.warning(f"Peers disagree on the content of '{requested_filename}'; using hash {file_hash_on_peers} offered by {len(swarm_sources)} peer(s).")
+
+        download_directory = self.peer_discovery.shared_directory
+        try:
+            os.makedirs(download_directory, exist_ok=True)
+        except OSError as e:
+            logger.error(f"Could not create directory {download_directory}: {e}")
+            return False
+
+        destination_path = os.path.join(download_directory, requested_filename)
+        peer_list = ", ".join(f"{source['peer_ip']}:{source['port']}" for source in swarm_sources)
+        logger.info(f"Requesting file {requested_filename} (hash: {file_hash_on_peers}) from {peer_list} to {destination_path}")
+
+        try:
+            if os.path.isfile(destination_path) and self.file_index.get_hash(destination_path) != file_hash_on_peers:
+                # An older copy is on disk; only the blocks that differ need to cross the network.
+                if DeltaDownloader(swarm_sources, file_hash_on_peers, destination_path, destination_path,
+                                   progress_callback=progress_callback, cancel_event=cancel_event,
+                                   bandwidth=self.bandwidth, priority=priority, file_index=self.file_index).run():
+                    logger.info(f"'{requested_filename}' updated in place by delta sync.")
+                    return True
+            success = SwarmDownloader(swarm_sources, file_hash_on_peers, destination_path,
+                                      progress_callback=progress_callback, cancel_event=cancel_event,
+                                      bandwidth=self.bandwidth, priority=priority,
+                                      chunk_store=self.chunk_store, file_index=self.file_index).run()
+            if success:
+                logger.info(f"'{requested_filename}' received successfully and saved to '{destination_path}'.")
+            else:
+                logger.warning(f"Failed to receive '{requested_filename}' from {peer_list}.")
+            return success
+        except Exception as e:
+            logger.error(f"Error during file reception for '{requested_filename}' from {peer_list}: {e}", exc_info=True)
+            return False
@@ -0,0 +1,133 @@
+import os
+import json
+import base64
+import logging
+import threading
+import time
+from typing import Dict, List
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+BITMAP_SUFFIX = ".part.bitmap"
+BITMAP_FLUSH_INTERVAL = 1.0
+
+
+class PartialDownload:
+    def __init__(self, destination_path: str, manifest: Dict):
+        self.destination_path = destination_path
+        self.manifest = manifest
+        self.part_path = destination_path + PART_SUFFIX
+        self.bitmap_path = destination_path + BITMAP_SUFFIX
+        self.chunk_count = manifest["chunk_count"]
+        self.bitmap = bytearray((self.chunk_count + 7) // 8)
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_flush = 0.0
+
+    def open(self) -> int:
+        destination_dir = os.path.dirname(self.destination_path)
+        if destination_dir:
+            os.makedirs(destination_dir, exist_ok=True)
+
+        if self.load_bitmap():
+            done = self.completed_count()
+            logger.info(f"Resuming {self.part_path}: {done}/{self.chunk_count} chunks already verified.")
+            return done
+
+        with open(self.part_path, "wb") as f:
+            f.truncate(self.manifest["size"])
+        self.dirty = True
+        self.flush()
+        return 0
+
+    def load_bitmap(self) -> bool:
+        if not (os.path.isfile(self.part_path) and os.path.isfile(self.bitmap_path)):
+            return False
+        try:
+            with open(self.bitmap_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            bitmap = bytearray(base64.b64decode(state["bitmap"]))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Discarding unreadable chunk bitmap {self.bitmap_path}: {e}")
+            return False
+
+        if (state.get("sha256") != self.manifest["sha256"] or
+                state.get("chunk_size") != self.manifest["chunk_size"] or
+                len(bitmap) != len(self.bitmap) or
+                os.path.getsize(self.part_path) != self.manifest["size"]):
+            logger.info(f"{self.part_path} belongs to a different version of the file; starting over.")
+            return False
+
+        self.bitmap = bitmap
+        return True
+
+    def has_chunk(self, chunk_index: int) -> bool:
+        return bool(self.bitmap[chunk_index >> 3] & (1 << (chunk_index & 7)))
+
+    def missing_chunks(self) -> List[int]:
+        return [i for i in range(self.chunk_count) if not self.has_chunk(i)]
+
+    def mark_missing(self, chunk_index: int):
+        with self.lock:
+            self.bitmap[chunk_index >> 3] &= ~(1 << (chunk_index & 7)) & 0xFF
+            self.dirty = True
+        self.flush()
+
+    def completed_count(self) -> int:
+        return sum(bin(byte).count("1") for byte in self.bitmap)
+
+    def mark_done(self, chunk_index: int):
+        with self.lock:
+            self.bitmap[chunk_index >> 3] |= 1 << (chunk_index & 7)
+            self.dirty = True
+            flush_due = time.monotonic() - self.last_flush >= BITMAP_FLUSH_INTERVAL
+        if flush_due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            state = {
+                "sha256": self.manifest["sha256"],
+                "size": self.manifest["size"],
+                "chunk_size": self.manifest["chunk_size"],
+                "bitmap": base64.b64encode(bytes(self.bitmap)).decode("ascii")
+            }
+            try:
+                fd = os.open(self.part_path, os.O_RDWR)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                tmp_path = self.bitmap_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.bitmap_path)
+                self.dirty = False
+                self.last_flush = time.monotonic()
+            except OSError as e:
+                logger.error(f"Could not persist chunk bitmap {self.bitmap_path}: {e}")
+
+    def finalize(self):
+        # Only called once the content hash matched; fsync first so the rename never exposes a file
+        # whose data has not reached the disk.
+        fd = os.open(self.part_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(self.part_path, self.destination_path)
+        try:
+            os.remove(self.bitmap_path)
+        except FileNotFoundError:
+            pass
+        logger.info(f"Download complete: {self.destination_path}")
+
+    def discard(self):
+        for path in (self.part_path, self.bitmap_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
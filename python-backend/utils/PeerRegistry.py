@@ -0,0 +1,185 @@
+import logging
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PEER_TTL = 10.0
+MISSED_BEACONS_BEFORE_EXPIRY = 3
+RTT_SMOOTHING = 0.125
+
+
+class PeerInfo:
+    def __init__(self, ip: str, port: int):
+        self.ip = ip
+        self.port = port
+        self.key = f"{ip}:{port}"
+        self.node_id: Optional[str] = None
+        self.beacon_interval: Optional[float] = None
+        self.wire_version: Optional[int] = None
+        self.first_seen = time.time()
+        self.last_seen_monotonic = time.monotonic()
+        self.last_seen = self.first_seen
+        self.rtt: Optional[float] = None
+        self.rtt_samples = 0
+        self.messages = 0
+
+    def touch(self):
+        self.last_seen_monotonic = time.monotonic()
+        self.last_seen = time.time()
+        self.messages += 1
+
+    def record_rtt(self, rtt: float):
+        # Same smoothing as TCP's SRTT estimator.
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt = (1 - RTT_SMOOTHING) * self.rtt + RTT_SMOOTHING * rtt
+        self.rtt_samples += 1
+
+    def age(self, now: float) -> float:
+        return now - self.last_seen_monotonic
+
+    def expires_after(self, ttl: float) -> float:
+        # A peer that announced a slow beacon is given a few of its own intervals before it counts as gone.
+        if self.beacon_interval is None:
+            return ttl
+        return max(ttl, self.beacon_interval * MISSED_BEACONS_BEFORE_EXPIRY)
+
+    def to_dict(self) -> Dict:
+        return {
+            "peer": self.key,
+            "ip": self.ip,
+            "port": self.port,
+            "node_id": self.node_id,
+            "beacon_interval": self.beacon_interval,
+            "wire_version": self.wire_version,
+            "first_seen": self.first_seen,
+            "last_seen": self.last_seen,
+            "age": round(self.age(time.monotonic()), 3),
+            "rtt_ms": round(self.rtt * 1000, 3) if self.rtt is not None else None,
+            "rtt_samples": self.rtt_samples,
+            "messages": self.messages
+        }
+
+
+class PeerRegistry:
+    def __init__(self, ttl: float = PEER_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.peers: Dict[str, PeerInfo] = {}
+
+    def touch(self, ip: str, port: int, node_id: Optional[str] = None, beacon_interval: Optional[float] = None,
+              wire_version: Optional[int] = None) -> bool:
+        key = f"{ip}:{port}"
+        with self.lock:
+            peer = self.peers.get(key)
+            if peer is None:
+                peer = self.peers[key] = PeerInfo(ip, port)
+            peer.touch()
+            # Every beacon restates what the sender speaks, so a peer that restarts on older code drops back to JSON.
+            peer.wire_version = wire_version
+            if node_id:
+                peer.node_id = node_id
+            if isinstance(beacon_interval, (int, float)) and beacon_interval > 0:
+                peer.beacon_interval = float(beacon_interval)
+            return peer.messages == 1
+
+    def record_rtt(self, ip: str, port: int, rtt: float):
+        with self.lock:
+            peer = self.peers.get(f"{ip}:{port}")
+            if peer is not None and rtt >= 0:
+                peer.record_rtt(rtt)
+
+    def remove(self, key: str) -> bool:
+        with self.lock:
+            return self.peers.pop(key, None) is not None
+
+    def evict_expired(self) -> List[str]:
+        now = time.monotonic()
+        with self.lock:
+            expired = [key for key, peer in self.peers.items() if peer.age(now) > peer.expires_after(self.ttl)]
+            for key in expired:
+                del self.peers[key]
+        for key in expired:
+            logger.info(f"Peer {key} expired (no beacon within its expiry window).")
+        return expired
+
+    def wire_version(self, key: str) -> Optional[int]:
+        with self.lock:
+            peer = self.peers.get(key)
+            return peer.wire_version if peer is not None else None
+
+    def get(self, key: str) -> Optional[PeerInfo]:
+        with self.lock:
+            return self.peers.get(key)
+
+    def keys(self) -> List[str]:
+        with self.lock:
+            return list(self.peers)
+
+    def node_ids(self, limit: Optional[int] = None) -> List[str]:
+        with self.lock:
+            node_ids = [peer.node_id for peer in self.peers.values() if peer.node_id]
+        return node_ids[:limit] if limit is not None else node_ids
+
+    def values(self) -> List[PeerInfo]:
+        with self.lock:
+            return list(self.peers.values())
+
+    def gossip_sample(self, limit: int) -> List[list]:
+        now = time.monotonic()
+        with self.lock:
+            peers = list(self.peers.values())
+        sample = random.sample(peers, min(limit, len(peers)))
+        return [[peer.ip, peer.port, peer.node_id, round(peer.age(now), 1), peer.beacon_interval] for peer in sample]
+
+    def merge_gossip(self, entries: List, own_node_id: str) -> List[str]:
+        # Gossip only ever makes a peer look as fresh as its freshest second-hand sighting,
+        # so a dead peer keeps ageing everywhere and is evicted by the TTL.
+        now = time.monotonic()
+        learned = []
+        with self.lock:
+            for entry in entries:
+                if not isinstance(entry, list) or len(entry) != 5:
+                    continue
+                ip, port, node_id, age, beacon_interval = entry
+                if not isinstance(ip, str) or not isinstance(port, int) or not isinstance(age, (int, float)):
+                    continue
+                if node_id == own_node_id:
+                    continue
+                key = f"{ip}:{port}"
+                peer = self.peers.get(key)
+                if peer is None:
+                    candidate = PeerInfo(ip, port)
+                    candidate.node_id = node_id
+                    if isinstance(beacon_interval, (int, float)) and beacon_interval > 0:
+                        candidate.beacon_interval = float(beacon_interval)
+                    if age > candidate.expires_after(self.ttl):
+                        continue
+                    peer = self.peers[key] = candidate
+                    peer.last_seen_monotonic = now - age
+                    peer.last_seen = time.time() - age
+                    learned.append(key)
+                    continue
+                if now - age > peer.last_seen_monotonic:
+                    peer.last_seen_monotonic = now - age
+                    peer.last_seen = time.time() - age
+                    if isinstance(beacon_interval, (int, float)) and beacon_interval > 0:
+                        peer.beacon_interval = float(beacon_interval)
+        return learned
+
+    def snapshot(self) -> List[Dict]:
+        with self.lock:
+            peers = list(self.peers.values())
+        return [peer.to_dict() for peer in sorted(peers, key=lambda p: p.key)]
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return key in self.peers
+
+    def __len__(self):
+        with self.lock:
+            return len(self.peers)
@@ -0,0 +1,306 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from utils.BandwidthScheduler import PRIORITY_BACKGROUND
+from utils.FileIndex import DATA_DIRECTORY
+from utils.FileManager import FileClient
+from utils.SwarmDownloader import SwarmDownloader
+from utils.TransferProtocol import TransferError
+
+logger = logging.getLogger(__name__)
+
+REPLICA_DIRECTORY_NAME = ".replicas"
+CATALOGUE_FILE_NAME = "replicas.json"
+POPULARITY_HALF_LIFE = 3600.0
+DUPLICATE_QUERY_WINDOW = 60.0
+MIN_POPULARITY = 3.0
+MIN_REQUESTERS = 2
+MAX_TRACKED_REQUESTERS = 8
+MAX_TRACKED_NAMES = 10000
+REPLICATION_INTERVAL = 60.0
+MAX_REPLICATIONS_PER_ROUND = 2
+FAILURE_BACKOFF = 600.0
+MIN_FREE_DISK_FRACTION = 0.05
+
+
+class QueryPopularity:
+    # Exponentially decaying query counts per file name, as seen in query_file broadcasts. A requester
+    # repeating the same query within DUPLICATE_QUERY_WINDOW counts once, so one retrying peer cannot
+    # make a file look popular on its own.
+    def __init__(self, half_life: float = POPULARITY_HALF_LIFE):
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        self.names: Dict[str, Dict] = {}
+        self.recent: Dict[tuple, float] = {}
+
+    def decayed(self, entry: Dict, now: float) -> float:
+        return entry["score"] * 0.5 ** ((now - entry["updated"]) / self.half_life)
+
+    def record(self, name: str, requester: str, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            key = (name, requester)
+            if now - self.recent.get(key, float("-inf")) < DUPLICATE_QUERY_WINDOW:
+                return
+            self.recent[key] = now
+            entry = self.names.get(name)
+            if entry is None:
+                entry = self.names[name] = {"score": 0.0, "updated": now, "last_seen": now, "requesters": []}
+            entry["score"] = self.decayed(entry, now) + 1
+            entry["updated"] = entry["last_seen"] = now
+            if requester not in entry["requesters"]:
+                entry["requesters"] = (entry["requesters"] + [requester])[-MAX_TRACKED_REQUESTERS:]
+            if len(self.names) > MAX_TRACKED_NAMES:
+                self.prune(now)
+
+    def prune(self, now: float):
+        ranked = sorted(self.names, key=lambda name: self.decayed(self.names[name], now))
+        for name in ranked[:len(ranked) // 2]:
+            del self.names[name]
+        self.recent = {key: seen for key, seen in self.recent.items() if now - seen < DUPLICATE_QUERY_WINDOW}
+
+    def score(self, name: str, now: Optional[float] = None) -> float:
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            entry = self.names.get(name)
+            return self.decayed(entry, now) if entry else 0.0
+
+    def last_seen(self, name: str) -> float:
+        with self.lock:
+            entry = self.names.get(name)
+            return entry["last_seen"] if entry else 0.0
+
+    def top(self, limit: int, now: Optional[float] = None) -> List[tuple]:
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            ranked = [(self.decayed(entry, now), name, len(entry["requesters"])) for name, entry in self.names.items()]
+        ranked.sort(reverse=True)
+        return ranked[:limit]
+
+
+class ReplicationService:
+    # Fetches files that are queried often but not held here into a replica directory inside the
+    # shared directory, so the index, the DHT and query_file answers advertise them like any other file.
+    # Replicas share a disk quota; to make room the least popular one goes first, the least recently
+    # queried on a tie. Files the user put in the shared directory are never touched.
+    def __init__(self, file_index, find_sources: Callable[[str], List[Dict]], quota_bytes: int,
+                 bandwidth=None, chunk_store=None, data_directory: str = DATA_DIRECTORY,
+                 interval: float = REPLICATION_INTERVAL):
+        self.file_index = file_index
+        self.find_sources = find_sources
+        self.quota_bytes = quota_bytes
+        self.bandwidth = bandwidth
+        self.chunk_store = chunk_store
+        self.interval = interval
+        self.replica_directory = os.path.join(file_index.directory, REPLICA_DIRECTORY_NAME)
+        self.catalogue_path = os.path.join(data_directory, CATALOGUE_FILE_NAME)
+        self.popularity = QueryPopularity()
+        self.lock = threading.Lock()
+        self.replicas: Dict[str, Dict] = {}
+        self.failed_until: Dict[str, float] = {}
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.stats = {"replicated": 0, "evicted": 0, "failed": 0, "bytes_fetched": 0}
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.catalogue_path):
+            return
+        try:
+            with open(self.catalogue_path, "r", encoding="utf-8") as f:
+                self.replicas = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read replica catalogue {self.catalogue_path}: {e}")
+            self.replicas = {}
+
+    def save(self):
+        directory = os.path.dirname(self.catalogue_path)
+        try:
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = self.catalogue_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.replicas, f)
+            os.replace(tmp_path, self.catalogue_path)
+        except OSError as e:
+            logger.error(f"Could not save replica catalogue {self.catalogue_path}: {e}")
+
+    def observe_query(self, filename: str, requester: str):
+        self.popularity.record(filename, requester)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True, name="Replication")
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.replicate_once()
+            except Exception as e:
+                logger.error(f"Replication round failed: {e}", exc_info=True)
+
+    def reconcile(self):
+        with self.lock:
+            missing = [name for name, replica in self.replicas.items() if not os.path.isfile(replica["path"])]
+            for name in missing:
+                del self.replicas[name]
+        if missing:
+            logger.info(f"Dropped {len(missing)} replica(s) that were removed from disk.")
+            self.save()
+
+    def candidates(self) -> List[tuple]:
+        now = time.monotonic()
+        chosen = []
+        for score, name, requesters in self.popularity.top(MAX_TRACKED_NAMES, now):
+            if score < MIN_POPULARITY:
+                break
+            if requesters < MIN_REQUESTERS or self.failed_until.get(name, 0) > now:
+                continue
+            if self.file_index.get_hash_by_name(name) is not None:
+                continue
+            chosen.append((score, name))
+            if len(chosen) == MAX_REPLICATIONS_PER_ROUND:
+                break
+        return chosen
+
+    def replicate_once(self) -> int:
+        self.reconcile()
+        replicated = 0
+        for score, name in self.candidates():
+            if self.stop_event.is_set():
+                break
+            if self.replicate(name, score):
+                replicated += 1
+        return replicated
+
+    def mark_failed(self, name: str):
+        self.stats["failed"] += 1
+        self.failed_until[name] = time.monotonic() + FAILURE_BACKOFF
+
+    def replicate(self, name: str, score: float) -> bool:
+        # Names arrive from the network, so anything that is not a plain file name is refused.
+        if not name or name in (".", "..") or os.path.basename(name) != name or (os.altsep and os.altsep in name):
+            logger.warning(f"Not replicating unsafe file name {name!r}.")
+            self.mark_failed(name)
+            return False
+        sources = self.find_sources(name)
+        if not sources:
+            logger.info(f"No source found for popular file '{name}'.")
+            self.mark_failed(name)
+            return False
+        sources_by_hash = {}
+        for source in sources:
+            sources_by_hash.setdefault(source["file_hash"], []).append(source)
+        file_hash, sources = max(sources_by_hash.items(), key=lambda item: len(item[1]))
+
+        manifest = self.fetch_manifest(file_hash, sources)
+        if manifest is None:
+            self.mark_failed(name)
+            return False
+        size = manifest["size"]
+        # Not a failure: the file is retried once it is more popular than what it would displace.
+        # Nothing is evicted yet; that waits until the new replica is complete and verified.
+        if self.victims_for(size, score) is None:
+            logger.info(f"Not replicating '{name}' ({size} bytes): it does not fit the {self.quota_bytes} byte quota "
+                        f"without evicting more popular replicas.")
+            return False
+        os.makedirs(self.replica_directory, exist_ok=True)
+        usage = shutil.disk_usage(self.replica_directory)
+        if usage.free - size < usage.total * MIN_FREE_DISK_FRACTION:
+            logger.warning(f"Not replicating '{name}': only {usage.free} bytes free on disk.")
+            return False
+
+        destination = os.path.join(self.replica_directory, name)
+        logger.info(f"Replicating popular file '{name}' (score {score:.1f}, {size} bytes) from {len(sources)} peer(s).")
+        if not SwarmDownloader(sources, file_hash, destination, bandwidth=self.bandwidth,
+                               priority=PRIORITY_BACKGROUND, chunk_store=self.chunk_store,
+                               cancel_event=self.stop_event).run():
+            logger.warning(f"Replicating '{name}' failed.")
+            self.mark_failed(name)
+            return False
+        victims = self.victims_for(size, score)
+        if victims is None:
+            logger.info(f"Dropping the new replica of '{name}': the replicas it would displace became more popular.")
+            os.remove(destination)
+            return False
+        for victim in victims:
+            self.evict(victim)
+        # SwarmDownloader already verified the content against the manifest's hash, so there is nothing to rehash.
+        self.file_index.store_verified(destination, manifest)
+        with self.lock:
+            self.replicas[name] = {"path": destination, "file_hash": file_hash, "size": size, "fetched_at": time.time()}
+        self.save()
+        self.stats["replicated"] += 1
+        self.stats["bytes_fetched"] += size
+        return True
+
+    def fetch_manifest(self, file_hash: str, sources: List[Dict]) -> Optional[Dict]:
+        for source in sources:
+            client = FileClient(source["peer_ip"], source["transfer_port"])
+            try:
+                manifest = client.request_manifest(file_hash)
+            except (OSError, TransferError, ValueError) as e:
+                logger.debug(f"Could not fetch manifest for {file_hash} from {source['peer_ip']}: {e}")
+                continue
+            finally:
+                client.close()
+            if manifest.get("sha256") == file_hash and isinstance(manifest.get("size"), int):
+                return manifest
+        return None
+
+    def victims_for(self, size: int, score: float) -> Optional[List[str]]:
+        # The replicas to evict so that size bytes fit the quota, or None if that would mean evicting
+        # one at least as popular as the newcomer.
+        if size > self.quota_bytes:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            ranked = sorted(self.replicas, key=lambda name: (self.popularity.score(name, now), self.popularity.last_seen(name)))
+            free = self.quota_bytes - sum(replica["size"] for replica in self.replicas.values())
+            victims = []
+            for name in ranked:
+                if free >= size:
+                    break
+                if self.popularity.score(name, now) >= score:
+                    return None
+                victims.append(name)
+                free += self.replicas[name]["size"]
+            if free < size:
+                return None
+        return victims
+
+    def evict(self, name: str):
+        with self.lock:
+            replica = self.replicas.pop(name, None)
+        if replica is None:
+            return
+        try:
+            os.remove(replica["path"])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not evict replica {replica['path']}: {e}")
+        self.file_index.remove_path(replica["path"])
+        self.save()
+        self.stats["evicted"] += 1
+        logger.info(f"Evicted replica '{name}' ({replica['size']} bytes).")
+
+    def status(self) -> Dict:
+        with self.lock:
+            replicas = [{"filename": name, **replica} for name, replica in self.replicas.items()]
+        return {
+            "quota_bytes": self.quota_bytes,
+            "used_bytes": sum(replica["size"] for replica in replicas),
+            "replicas": replicas,
+            "popular": [{"filename": name, "score": round(score, 2), "requesters": requesters}
+                        for score, name, requesters in self.popularity.top(10)],
+            **self.stats
+        }
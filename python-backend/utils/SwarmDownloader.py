@@ -0,0 +1,389 @@
+import hashlib
+import heapq
+import io
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set
+
+from utils.BandwidthScheduler import PRIORITY_FOREGROUND
+from utils.FileManager import FileClient
+from utils.ManifestManager import ManifestManager
+from utils.PartialDownload import PartialDownload
+from utils.TransferProtocol import TransferError
+
+logger = logging.getLogger(__name__)
+
+CONNECTIONS_PER_PEER = 2
+MAX_PEER_FAILURES = 3
+FAILURE_BACKOFF = 0.5
+THROUGHPUT_SMOOTHING = 0.3
+ENDGAME_SPEEDUP = 1.5
+VERIFY_ROUNDS = 2
+HASH_BACKLOG_LIMIT = 16 * 1024 * 1024
+
+
+class SwarmPeer:
+    def __init__(self, source: Dict):
+        self.source = source
+        self.key = f"{source['peer_ip']}:{source['port']}"
+        self.chunks: Optional[Set[int]] = set(source['chunks']) if source.get('chunks') is not None else None
+        self.throughput = 0.0
+        self.failures = 0
+
+    def has_chunk(self, chunk_index: int) -> bool:
+        return self.chunks is None or chunk_index in self.chunks
+
+    def record_transfer(self, byte_count: int, elapsed: float):
+        rate = byte_count / max(elapsed, 1e-6)
+        if self.throughput == 0:
+            self.throughput = rate
+        else:
+            self.throughput = (1 - THROUGHPUT_SMOOTHING) * self.throughput + THROUGHPUT_SMOOTHING * rate
+        self.failures = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.failures < MAX_PEER_FAILURES
+
+
+class SwarmDownloader:
+    def __init__(self, sources: List[Dict], file_hash: str, destination_path: str,
+                 connections_per_peer: int = CONNECTIONS_PER_PEER,
+                 progress_callback: Optional[Callable[[int, int], None]] = None,
+                 cancel_event: Optional[threading.Event] = None,
+                 bandwidth=None, priority: str = PRIORITY_FOREGROUND, chunk_store=None, file_index=None):
+        self.sources = sources
+        self.file_hash = file_hash
+        self.destination_path = destination_path
+        self.connections_per_peer = connections_per_peer
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event or threading.Event()
+        self.bandwidth = bandwidth
+        self.priority = priority
+        self.file_index = file_index
+        self.chunk_store = chunk_store
+        self.bytes_done = 0
+
+        self.lock = threading.Condition()
+        self.manifest: Optional[Dict] = None
+        self.partial: Optional[PartialDownload] = None
+        self.peers: List[SwarmPeer] = []
+        self.pending: List[tuple] = []
+        self.in_flight: Dict[int, Set[str]] = {}
+        self.completed: Set[int] = set()
+        self.finished = threading.Event()
+
+        # The whole-file hash is computed as the completed prefix grows, from the chunk just received
+        # when it is next in line and from the .part file otherwise, so no separate read pass is needed.
+        self.hash_lock = threading.Lock()
+        self.sha256 = hashlib.sha256()
+        self.hashed_chunks = 0
+        self.hash_backlog: Dict[int, bytes] = {}
+        self.arriving: Set[int] = set()
+        self.backlog_bytes = 0
+        self.reread_bytes = 0
+        self.hash_fd: Optional[int] = None
+        self.chunk_sources: Dict[int, str] = {}
+        self.bad_sources: Dict[int, Set[str]] = {}
+
+    def fetch_manifest(self) -> Optional[Dict]:
+        if self.chunk_store is not None:
+            manifest = self.chunk_store.file_index.get_manifest(self.file_hash)
+            if manifest is not None:
+                return manifest
+        for source in self.sources:
+            client = FileClient(source['peer_ip'], source['transfer_port'])
+            try:
+                manifest = client.request_manifest(self.file_hash)
+            except (OSError, TransferError, ValueError) as e:
+                logger.warning(f"Could not fetch manifest for {self.file_hash} from {source['peer_ip']}: {e}")
+                continue
+            finally:
+                client.close()
+            if manifest.get('sha256') != self.file_hash or len(manifest.get('chunks', [])) != manifest.get('chunk_count'):
+                logger.warning(f"Peer {source['peer_ip']} returned an inconsistent manifest for {self.file_hash}. Ignoring it.")
+                continue
+            return manifest
+        return None
+
+    def run(self) -> bool:
+        self.manifest = self.fetch_manifest()
+        if self.manifest is None:
+            logger.error(f"No source could provide a manifest for {self.file_hash}.")
+            return False
+
+        chunk_count = self.manifest['chunk_count']
+        self.partial = PartialDownload(self.destination_path, self.manifest)
+        self.partial.open()
+        if self.chunk_store is not None:
+            # Chunks that some shared file already holds are copied locally instead of fetched.
+            with open(self.partial.part_path, 'r+b') as f:
+                reused = self.chunk_store.copy_chunks(self.manifest, self.partial.missing_chunks(), f)
+            for chunk_index in reused:
+                self.partial.mark_done(chunk_index)
+        self.completed = {i for i in range(chunk_count) if self.partial.has_chunk(i)}
+        self.bytes_done = sum(ManifestManager.chunk_range(self.manifest, i)[1] for i in self.completed)
+        self.report_progress()
+
+        self.peers = [SwarmPeer(source) for source in self.sources]
+        for chunk_index in self.partial.missing_chunks():
+            availability = sum(1 for peer in self.peers if peer.has_chunk(chunk_index))
+            if not availability:
+                logger.error(f"No source has chunk {chunk_index} of {self.file_hash}.")
+                return False
+            self.pending.append((availability, chunk_index))
+        heapq.heapify(self.pending)
+
+        logger.info(f"Swarm download of {self.manifest['filename']} ({len(self.pending)} of {chunk_count} chunks missing) from {len(self.peers)} peer(s).")
+        started = time.monotonic()
+        self.hash_fd = os.open(self.partial.part_path, os.O_RDONLY)
+        try:
+            for _ in range(VERIFY_ROUNDS):
+                if not self.download_missing():
+                    return False
+                self.advance_hash()
+                if self.sha256.hexdigest() == self.file_hash:
+                    break
+                corrupt = self.find_corrupt_chunks()
+                if not corrupt:
+                    logger.error(f"Every chunk of {self.file_hash} matches its manifest but the file does not match its hash. "
+                                 f"The manifest is wrong; discarding {self.partial.part_path}.")
+                    self.partial.discard()
+                    return False
+                logger.warning(f"Content hash of {self.file_hash} did not match; fetching {len(corrupt)} corrupt chunk(s) again.")
+                self.requeue(corrupt)
+            else:
+                logger.error(f"Swarm download of {self.file_hash} still fails its content hash; progress kept in {self.partial.part_path}.")
+                return False
+        finally:
+            os.close(self.hash_fd)
+        self.partial.finalize()
+        if self.file_index is not None:
+            # Every chunk and the whole file were checked against the manifest, so it is indexed as is.
+            self.file_index.store_verified(self.destination_path, self.manifest)
+
+        elapsed = time.monotonic() - started
+        rates = ", ".join(f"{peer.key}={peer.throughput / 1e6:.1f}MB/s" for peer in self.peers)
+        logger.info(f"Swarm download of {self.manifest['filename']} finished and verified in {elapsed:.2f}s ({rates}); "
+                    f"{self.reread_bytes / 1e6:.1f} MB read back from disk for the content hash.")
+        return True
+
+    def download_missing(self) -> bool:
+        chunk_count = self.manifest['chunk_count']
+        workers = [
+            threading.Thread(target=self.worker, args=(peer,), daemon=True)
+            for peer in self.peers
+            for _ in range(self.connections_per_peer)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.partial.flush()
+        if self.cancel_event.is_set() and len(self.completed) != chunk_count:
+            logger.info(f"Swarm download of {self.file_hash} cancelled; progress kept in {self.partial.part_path}.")
+            return False
+        if len(self.completed) != chunk_count:
+            logger.error(f"Swarm download of {self.file_hash} failed with {chunk_count - len(self.completed)} chunk(s) missing; progress kept in {self.partial.part_path}.")
+            return False
+        return True
+
+    def read_chunk(self, chunk_index: int) -> bytes:
+        offset, length = ManifestManager.chunk_range(self.manifest, chunk_index)
+        return os.pread(self.hash_fd, length, offset)
+
+    def advance_hash(self, chunk_index: Optional[int] = None, data=None):
+        with self.hash_lock:
+            if chunk_index is not None:
+                with self.lock:
+                    self.arriving.discard(chunk_index)
+            if chunk_index is not None and chunk_index > self.hashed_chunks and self.backlog_bytes + len(data) <= HASH_BACKLOG_LIMIT:
+                # Chunks that finish a little ahead of the prefix are kept in memory until it reaches them.
+                self.hash_backlog[chunk_index] = bytes(data)
+                self.backlog_bytes += len(data)
+            while self.hashed_chunks < self.manifest['chunk_count']:
+                next_index = self.hashed_chunks
+                with self.lock:
+                    # A chunk still on its way here from its worker is hashed from memory when it arrives.
+                    if next_index not in self.completed or next_index in self.arriving:
+                        return
+                if next_index == chunk_index:
+                    self.sha256.update(data)
+                elif next_index in self.hash_backlog:
+                    chunk = self.hash_backlog.pop(next_index)
+                    self.backlog_bytes -= len(chunk)
+                    self.sha256.update(chunk)
+                else:
+                    chunk = self.read_chunk(next_index)
+                    self.reread_bytes += len(chunk)
+                    self.sha256.update(chunk)
+                self.hashed_chunks += 1
+
+    def find_corrupt_chunks(self) -> List[int]:
+        # Only reached when the content hash failed: a chunk changed on disk after it was verified,
+        # or a resumed .part file was damaged.
+        return [chunk_index for chunk_index, chunk_hash, _, _ in ManifestManager.iter_chunks(self.manifest)
+                if ManifestManager.hash_chunk(self.read_chunk(chunk_index)) != chunk_hash]
+
+    def requeue(self, chunk_indexes: List[int]):
+        with self.lock:
+            for chunk_index in chunk_indexes:
+                self.completed.discard(chunk_index)
+                self.bytes_done -= ManifestManager.chunk_range(self.manifest, chunk_index)[1]
+                source = self.chunk_sources.pop(chunk_index, None)
+                if source is not None:
+                    self.bad_sources.setdefault(chunk_index, set()).add(source)
+                availability = sum(1 for peer in self.peers if peer.alive and peer.has_chunk(chunk_index))
+                heapq.heappush(self.pending, (availability, chunk_index))
+            self.finished.clear()
+        for chunk_index in chunk_indexes:
+            self.partial.mark_missing(chunk_index)
+        with self.hash_lock:
+            self.sha256 = hashlib.sha256()
+            self.hashed_chunks = 0
+            self.hash_backlog.clear()
+            self.backlog_bytes = 0
+
+    def worker(self, peer: SwarmPeer):
+        client = FileClient(peer.source['peer_ip'], peer.source['transfer_port'],
+                            bandwidth=self.bandwidth, priority=self.priority)
+        buffer = io.BytesIO()
+        try:
+            with open(self.partial.part_path, 'r+b') as f:
+                while (chunk_index := self.next_chunk(peer)) is not None:
+                    offset, length = ManifestManager.chunk_range(self.manifest, chunk_index)
+                    buffer.seek(0)
+                    buffer.truncate()
+                    started = time.monotonic()
+                    try:
+                        client.request_range(self.file_hash, offset, length, buffer)
+                    except (OSError, TransferError, ValueError) as e:
+                        client.close()
+                        self.chunk_failed(peer, chunk_index, str(e))
+                        if peer.alive:
+                            self.finished.wait(FAILURE_BACKOFF * peer.failures)
+                        continue
+
+                    data = buffer.getbuffer()
+                    try:
+                        if ManifestManager.hash_chunk(data) != self.manifest['chunks'][chunk_index]:
+                            self.chunk_failed(peer, chunk_index, "chunk hash mismatch", corrupt=True)
+                            continue
+                        with self.lock:
+                            already_completed = chunk_index in self.completed
+                        if not already_completed:
+                            f.seek(offset)
+                            f.write(data)
+                            # Hand the bytes to the OS before chunk_done marks the chunk, so the fsync in
+                            # PartialDownload.flush covers everything the persisted bitmap claims.
+                            f.flush()
+                        if self.chunk_done(peer, chunk_index, length, time.monotonic() - started):
+                            self.advance_hash(chunk_index, data)
+                    finally:
+                        data.release()
+        except OSError as e:
+            logger.error(f"Swarm worker for {peer.key} stopped: {e}", exc_info=True)
+            with self.lock:
+                peer.failures = MAX_PEER_FAILURES
+                self.lock.notify_all()
+        finally:
+            client.close()
+
+    def next_chunk(self, peer: SwarmPeer) -> Optional[int]:
+        with self.lock:
+            while True:
+                if len(self.completed) == self.manifest['chunk_count'] or not peer.alive or self.cancel_event.is_set():
+                    return None
+                chunk_index = self.take_rarest(peer)
+                if chunk_index is None:
+                    chunk_index = self.take_straggler(peer)
+                if chunk_index is not None:
+                    self.in_flight.setdefault(chunk_index, set()).add(peer.key)
+                    return chunk_index
+                if not self.in_flight:
+                    return None
+                self.lock.wait(1.0)
+
+    def take_rarest(self, peer: SwarmPeer) -> Optional[int]:
+        skipped = []
+        chunk_index = None
+        while self.pending:
+            entry = heapq.heappop(self.pending)
+            if entry[1] in self.completed:
+                continue
+            if peer.has_chunk(entry[1]) and not self.avoid(peer, entry[1]):
+                chunk_index = entry[1]
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self.pending, entry)
+        return chunk_index
+
+    def avoid(self, peer: SwarmPeer, chunk_index: int) -> bool:
+        # A peer that served a corrupt copy of a chunk only gets it again if nobody else can serve it.
+        bad = self.bad_sources.get(chunk_index)
+        if not bad or peer.key not in bad:
+            return False
+        return any(p.alive and p.has_chunk(chunk_index) and p.key not in bad for p in self.peers)
+
+    def take_straggler(self, peer: SwarmPeer) -> Optional[int]:
+        if peer.throughput == 0:
+            return None
+        peers_by_key = {p.key: p for p in self.peers}
+        best_index = None
+        best_rate = peer.throughput / ENDGAME_SPEEDUP
+        for chunk_index, holders in self.in_flight.items():
+            if len(holders) != 1 or peer.key in holders or not peer.has_chunk(chunk_index) or self.avoid(peer, chunk_index):
+                continue
+            holder_rate = peers_by_key[next(iter(holders))].throughput
+            if holder_rate < best_rate:
+                best_index = chunk_index
+                best_rate = holder_rate
+        return best_index
+
+    def chunk_done(self, peer: SwarmPeer, chunk_index: int, byte_count: int, elapsed: float) -> bool:
+        with self.lock:
+            self.in_flight.get(chunk_index, set()).discard(peer.key)
+            if not self.in_flight.get(chunk_index):
+                self.in_flight.pop(chunk_index, None)
+            newly_completed = chunk_index not in self.completed
+            self.completed.add(chunk_index)
+            if len(self.completed) == self.manifest['chunk_count']:
+                self.finished.set()
+            if newly_completed:
+                self.bytes_done += byte_count
+                self.chunk_sources[chunk_index] = peer.key
+                self.arriving.add(chunk_index)
+            peer.record_transfer(byte_count, elapsed)
+            self.lock.notify_all()
+        if newly_completed:
+            self.partial.mark_done(chunk_index)
+            self.report_progress()
+        return newly_completed
+
+    def report_progress(self):
+        if self.progress_callback is not None:
+            try:
+                self.progress_callback(self.bytes_done, self.manifest['size'])
+            except Exception as e:
+                logger.warning(f"Progress callback for {self.file_hash} failed: {e}")
+
+    def chunk_failed(self, peer: SwarmPeer, chunk_index: int, reason: str, corrupt: bool = False):
+        logger.warning(f"Chunk {chunk_index} of {self.file_hash} from {peer.key} failed: {reason}")
+        with self.lock:
+            if corrupt:
+                self.bad_sources.setdefault(chunk_index, set()).add(peer.key)
+            holders = self.in_flight.get(chunk_index, set())
+            holders.discard(peer.key)
+            if not holders:
+                self.in_flight.pop(chunk_index, None)
+                if chunk_index not in self.completed:
+                    availability = sum(1 for p in self.peers if p.alive and p.has_chunk(chunk_index))
+                    heapq.heappush(self.pending, (availability, chunk_index))
+            peer.failures += 1
+            if not peer.alive:
+                logger.warning(f"Dropping peer {peer.key} from swarm after {peer.failures} consecutive failures.")
+            self.lock.notify_all()
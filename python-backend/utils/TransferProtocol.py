@@ -0,0 +1,94 @@
+import json
+import socket
+import struct
+from typing import Dict, Optional, Tuple
+
+FRAME_HEADER = struct.Struct("!BI")
+
+FRAME_REQUEST = 1
+FRAME_META = 2
+FRAME_DATA = 3
+FRAME_END = 4
+FRAME_ERROR = 5
+FRAME_MANIFEST = 6
+FRAME_SIGNATURES = 7
+FRAME_COPY = 8
+FRAME_COMPRESSED = 9
+
+TRANSFER_CHUNK_SIZE = 512 * 1024
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+MAX_CONTROL_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+def tune_socket(sock: socket.socket):
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER_SIZE)
+        except OSError:
+            pass
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def send_frame(sock: socket.socket, frame_type: int, payload=b""):
+    header = FRAME_HEADER.pack(frame_type, len(payload))
+    if len(payload) <= 4096:
+        sock.sendall(header + bytes(payload))
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+def send_json_frame(sock: socket.socket, frame_type: int, message: Dict):
+    send_frame(sock, frame_type, json.dumps(message).encode())
+
+
+def recv_exact_into(sock: socket.socket, view: memoryview):
+    received = 0
+    while received < len(view):
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise TransferError("Connection closed in the middle of a frame.")
+        received += count
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    buffer = bytearray(size)
+    recv_exact_into(sock, memoryview(buffer))
+    return bytes(buffer)
+
+
+def recv_frame_header(sock: socket.socket) -> Optional[Tuple[int, int]]:
+    buffer = bytearray(FRAME_HEADER.size)
+    view = memoryview(buffer)
+    count = sock.recv_into(view)
+    if count == 0:
+        return None
+    if count < len(buffer):
+        recv_exact_into(sock, view[count:])
+    return FRAME_HEADER.unpack(buffer)
+
+
+def recv_json_payload(sock: socket.socket, length: int) -> Dict:
+    if length > MAX_CONTROL_FRAME_SIZE:
+        raise TransferError(f"Control frame of {length} bytes exceeds the limit.")
+    return json.loads(recv_exact(sock, length).decode())
+
+
+def recv_json_frame(sock: socket.socket, expected_type: int) -> Dict:
+    header = recv_frame_header(sock)
+    if header is None:
+        raise TransferError("Connection closed while waiting for a frame.")
+    frame_type, length = header
+    message = recv_json_payload(sock, length)
+    if frame_type == FRAME_ERROR:
+        raise TransferError(message.get("error", "Remote error."))
+    if frame_type != expected_type:
+        raise TransferError(f"Unexpected frame type {frame_type} (expected {expected_type}).")
+    return message
@@ -0,0 +1,351 @@
+import math
+import struct
+from typing import Dict, List, Optional, Tuple
+
+# Binary framing for the UDP control messages in DiscoverPeers. A datagram is
+#   magic (1) | version (1) | message type (1) | request id (16) | fixed fields | variable fields
+# where each message type has a fixed schema. JSON datagrams always start with '{', so the
+# magic byte tells the two formats apart and a node can accept both on the same socket.
+
+WIRE_MAGIC = 0xD7
+WIRE_VERSION = 1
+SUPPORTED_WIRE_VERSIONS = (WIRE_VERSION,)
+
+HEADER = struct.Struct("!BBB16s")
+U8 = struct.Struct("!B")
+U16 = struct.Struct("!H")
+GOSSIP_ENTRY = struct.Struct("!H6sHHH")
+QUERY_ENTRY = struct.Struct("!BH")
+QUERY_RESULT = struct.Struct("!H32sQH")
+
+NO_RID = bytes(16)
+NO_NODE_ID = bytes(6)
+NO_HASH = bytes(32)
+NO_U64 = 2 ** 64 - 1
+NO_DECISECONDS = 0xFFFF
+MAX_DECISECONDS = NO_DECISECONDS - 1
+ABSENT_LENGTH = 0xFFFF
+
+MATCH_CODES = {"exact": 1, "glob": 2, "substring": 3}
+MATCH_NAMES = {code: name for name, code in MATCH_CODES.items()}
+
+
+class WireError(ValueError):
+    pass
+
+
+def is_binary(data: bytes) -> bool:
+    return len(data) >= HEADER.size and data[0] == WIRE_MAGIC
+
+
+def negotiate(versions) -> Optional[int]:
+    if not isinstance(versions, list):
+        return None
+    common = [v for v in versions if v in SUPPORTED_WIRE_VERSIONS]
+    return max(common) if common else None
+
+
+def hex_to_bytes(value: str, size: int) -> bytes:
+    # Ids and hashes are always produced as lowercase hex, which is what decoding gives back.
+    if len(value) != size * 2:
+        raise WireError(f"expected {size * 2} hex digits, got {value!r}")
+    return bytes.fromhex(value)
+
+
+# Fixed fields: (struct code, encode, decode). None maps to a sentinel and back.
+
+def encode_port(value):
+    return 0 if value is None else value
+
+
+def decode_port(value):
+    return value or None
+
+
+def encode_float(value):
+    return math.nan if value is None else value
+
+
+def decode_float(value):
+    return None if math.isnan(value) else value
+
+
+def encode_u64(value):
+    return NO_U64 if value is None else value
+
+
+def decode_u64(value):
+    return None if value == NO_U64 else value
+
+
+def fixed_hex(size: int, empty: bytes):
+    def encode(value):
+        return empty if value is None else hex_to_bytes(value, size)
+
+    def decode(value):
+        return None if value == empty else value.hex()
+    return f"{size}s", encode, decode
+
+
+FIXED_KINDS = {
+    "port": ("H", encode_port, decode_port),
+    "u16": ("H", int, int),
+    "f64": ("d", encode_float, decode_float),
+    "u64": ("Q", encode_u64, decode_u64),
+    "node_id": fixed_hex(6, NO_NODE_ID),
+    "hash": fixed_hex(32, NO_HASH),
+    "rid": fixed_hex(16, NO_RID),
+}
+
+
+# Variable fields: encode(value, parts) appends bytes, decode(data, offset) -> (value, offset).
+
+def encode_str(value, parts: List[bytes]):
+    if value is None:
+        parts.append(U16.pack(ABSENT_LENGTH))
+        return
+    raw = value.encode()
+    if len(raw) >= ABSENT_LENGTH:
+        raise WireError("string field too long")
+    parts.append(U16.pack(len(raw)))
+    parts.append(raw)
+
+
+def decode_str(data: bytes, offset: int):
+    (length,), offset = U16.unpack_from(data, offset), offset + U16.size
+    if length == ABSENT_LENGTH:
+        return None, offset
+    if offset + length > len(data):
+        raise WireError("truncated string field")
+    return data[offset:offset + length].decode(), offset + length
+
+
+def encode_node_ids(value, parts: List[bytes]):
+    if value is None:
+        parts.append(U16.pack(ABSENT_LENGTH))
+        return
+    if len(value) >= ABSENT_LENGTH or any(len(node_id) != 12 for node_id in value):
+        raise WireError("node id list too long or malformed")
+    parts.append(U16.pack(len(value)))
+    parts.append(bytes.fromhex("".join(value)))
+
+
+def decode_node_ids(data: bytes, offset: int):
+    (count,), offset = U16.unpack_from(data, offset), offset + U16.size
+    if count == ABSENT_LENGTH:
+        return None, offset
+    end = offset + count * 6
+    if end > len(data):
+        raise WireError("truncated node id list")
+    joined = data[offset:end].hex()
+    return [joined[i:i + 12] for i in range(0, len(joined), 12)], end
+
+
+def encode_versions(value, parts: List[bytes]):
+    if value is None:
+        parts.append(U16.pack(ABSENT_LENGTH))
+        return
+    parts.append(U16.pack(len(value)))
+    parts.append(bytes(value))
+
+
+def decode_versions(data: bytes, offset: int):
+    (count,), offset = U16.unpack_from(data, offset), offset + U16.size
+    if count == ABSENT_LENGTH:
+        return None, offset
+    if offset + count > len(data):
+        raise WireError("truncated version list")
+    return list(data[offset:offset + count]), offset + count
+
+
+# List items are one fixed struct followed by the item's string, so each costs a single
+# pack or unpack call.
+
+def list_codec(encode_item, decode_item):
+    def encode(value, parts: List[bytes]):
+        if value is None:
+            parts.append(U16.pack(ABSENT_LENGTH))
+            return
+        if len(value) >= ABSENT_LENGTH:
+            raise WireError("list field too long")
+        parts.append(U16.pack(len(value)))
+        for item in value:
+            encode_item(item, parts)
+
+    def decode(data: bytes, offset: int):
+        (count,), offset = U16.unpack_from(data, offset), offset + U16.size
+        if count == ABSENT_LENGTH:
+            return None, offset
+        items = []
+        append = items.append
+        for _ in range(count):
+            item, offset = decode_item(data, offset)
+            append(item)
+        if offset > len(data):
+            raise WireError("truncated list field")
+        return items, offset
+    return encode, decode
+
+
+def to_deciseconds(value) -> int:
+    deciseconds = int(value * 10 + 0.5)
+    return deciseconds if 0 <= deciseconds <= MAX_DECISECONDS else min(max(deciseconds, 0), MAX_DECISECONDS)
+
+
+def encode_gossip(value, parts: List[bytes]):
+    # Ages and beacon intervals travel in tenths of a second, the resolution gossip already rounds to.
+    if value is None:
+        parts.append(U16.pack(ABSENT_LENGTH))
+        return
+    if len(value) >= ABSENT_LENGTH:
+        raise WireError("gossip list too long")
+    parts.append(U16.pack(len(value)))
+    pack = GOSSIP_ENTRY.pack
+    append = parts.append
+    for ip, port, node_id, age, interval in value:
+        if node_id is not None and len(node_id) != 12:
+            raise WireError(f"malformed node id {node_id!r}")
+        raw_ip = ip.encode()
+        append(pack(port, NO_NODE_ID if node_id is None else bytes.fromhex(node_id), to_deciseconds(age),
+                    NO_DECISECONDS if interval is None else to_deciseconds(interval), len(raw_ip)))
+        append(raw_ip)
+
+
+def decode_gossip(data: bytes, offset: int):
+    (count,), offset = U16.unpack_from(data, offset), offset + U16.size
+    if count == ABSENT_LENGTH:
+        return None, offset
+    entries = []
+    unpack_from = GOSSIP_ENTRY.unpack_from
+    for _ in range(count):
+        port, node_id, age, interval, length = unpack_from(data, offset)
+        offset += GOSSIP_ENTRY.size
+        entries.append([data[offset:offset + length].decode(), port, None if node_id == NO_NODE_ID else node_id.hex(),
+                        age / 10, None if interval == NO_DECISECONDS else interval / 10])
+        offset += length
+    if offset > len(data):
+        raise WireError("truncated gossip list")
+    return entries, offset
+
+
+def encode_query(query, parts: List[bytes]):
+    if len(query) != 2:
+        raise WireError("unexpected search query fields")
+    raw = query["pattern"].encode()
+    parts.append(QUERY_ENTRY.pack(MATCH_CODES[query["match"]], len(raw)))
+    parts.append(raw)
+
+
+def decode_query(data: bytes, offset: int):
+    code, length = QUERY_ENTRY.unpack_from(data, offset)
+    offset += QUERY_ENTRY.size
+    if code not in MATCH_NAMES:
+        raise WireError(f"unknown match code {code}")
+    if offset + length > len(data):
+        raise WireError("truncated search query")
+    return {"pattern": data[offset:offset + length].decode(), "match": MATCH_NAMES[code]}, offset + length
+
+
+def encode_result(result, parts: List[bytes]):
+    if len(result) != 4:
+        raise WireError("unexpected search result fields")
+    raw = result["filename"].encode()
+    parts.append(QUERY_RESULT.pack(result["query"], hex_to_bytes(result["file_hash"], 32),
+                                   NO_U64 if result["size"] is None else result["size"], len(raw)))
+    parts.append(raw)
+
+
+def decode_result(data: bytes, offset: int):
+    query, file_hash, size, length = QUERY_RESULT.unpack_from(data, offset)
+    offset += QUERY_RESULT.size
+    if offset + length > len(data):
+        raise WireError("truncated search result")
+    return {"query": query, "filename": data[offset:offset + length].decode(), "file_hash": file_hash.hex(),
+            "size": None if size == NO_U64 else size}, offset + length
+
+
+VARIABLE_KINDS = {
+    "str": (encode_str, decode_str),
+    "node_ids": (encode_node_ids, decode_node_ids),
+    "versions": (encode_versions, decode_versions),
+    "gossip": (encode_gossip, decode_gossip),
+    "queries": list_codec(encode_query, decode_query),
+    "results": list_codec(encode_result, decode_result),
+}
+
+
+class MessageSchema:
+    def __init__(self, code: int, name: str, fields: List[Tuple[str, str]]):
+        self.code = code
+        self.name = name
+        self.fixed = [(field, FIXED_KINDS[kind]) for field, kind in fields if kind in FIXED_KINDS]
+        self.variable = [(field, VARIABLE_KINDS[kind]) for field, kind in fields if kind in VARIABLE_KINDS]
+        self.fixed_struct = struct.Struct("!" + "".join(codec[0] for _, codec in self.fixed))
+        self.field_names = {field for field, _ in fields} | {"type", "request_id"}
+
+
+SCHEMAS = [
+    MessageSchema(1, "discover", [("port", "port"), ("dht_port", "port"), ("node_id", "node_id"),
+                                  ("interval", "f64"), ("sent_at", "f64"), ("wire", "versions"),
+                                  ("known", "node_ids"), ("gossip", "gossip")]),
+    MessageSchema(2, "peer_info", [("port", "port"), ("dht_port", "port"), ("node_id", "node_id"),
+                                   ("echo", "f64"), ("held", "f64"), ("wire", "versions")]),
+    MessageSchema(3, "query_file", [("reply_port", "port"), ("filename", "str")]),
+    MessageSchema(4, "file_found_response", [("port", "port"), ("transfer_port", "port"), ("file_hash", "hash"),
+                                             ("filename", "str"), ("peer_ip", "str")]),
+    MessageSchema(5, "receive_file", [("port", "port"), ("reply_port", "port"), ("file_hash", "hash")]),
+    MessageSchema(6, "file_offer", [("port", "port"), ("transfer_port", "port"), ("size", "u64"),
+                                    ("file_hash", "hash"), ("file_name", "str"), ("file_format", "str")]),
+    MessageSchema(7, "query_files", [("reply_port", "port"), ("query_id", "rid"), ("queries", "queries")]),
+    MessageSchema(8, "files_found_response", [("port", "port"), ("transfer_port", "port"), ("part", "u16"),
+                                              ("parts", "u16"), ("query_id", "rid"), ("peer_ip", "str"),
+                                              ("results", "results")]),
+]
+SCHEMAS_BY_NAME = {schema.name: schema for schema in SCHEMAS}
+SCHEMAS_BY_CODE = {schema.code: schema for schema in SCHEMAS}
+
+
+def encode_message(message: Dict, version: int = WIRE_VERSION) -> bytes:
+    # Raises WireError for anything the schema cannot carry exactly; callers then send JSON instead.
+    schema = SCHEMAS_BY_NAME.get(message.get("type"))
+    if schema is None:
+        raise WireError(f"no binary schema for message type {message.get('type')!r}")
+    if not schema.field_names.issuperset(message):
+        raise WireError(f"fields {sorted(set(message) - schema.field_names)} have no binary encoding")
+    request_id = message.get("request_id")
+    try:
+        parts = [
+            HEADER.pack(WIRE_MAGIC, version, schema.code, NO_RID if request_id is None else hex_to_bytes(request_id, 16)),
+            schema.fixed_struct.pack(*[codec[1](message.get(field)) for field, codec in schema.fixed])
+        ]
+        for field, (encode_field, _) in schema.variable:
+            encode_field(message.get(field), parts)
+    except (struct.error, TypeError, ValueError, KeyError, AttributeError) as e:
+        raise WireError(f"cannot encode {schema.name}: {e}") from e
+    return b"".join(parts)
+
+
+def decode_message(data: bytes) -> Dict:
+    try:
+        magic, version, code, request_id = HEADER.unpack_from(data, 0)
+        if magic != WIRE_MAGIC or version not in SUPPORTED_WIRE_VERSIONS:
+            raise WireError(f"unsupported wire version {version}")
+        schema = SCHEMAS_BY_CODE.get(code)
+        if schema is None:
+            raise WireError(f"unknown message type code {code}")
+        message = {"type": schema.name}
+        if request_id != NO_RID:
+            message["request_id"] = request_id.hex()
+        values = schema.fixed_struct.unpack_from(data, HEADER.size)
+        for (field, codec), value in zip(schema.fixed, values):
+            value = codec[2](value)
+            if value is not None:
+                message[field] = value
+        offset = HEADER.size + schema.fixed_struct.size
+        for field, (_, decode_field) in schema.variable:
+            value, offset = decode_field(data, offset)
+            if value is not None:
+                message[field] = value
+    except (struct.error, UnicodeDecodeError) as e:
+        raise WireError(f"malformed binary message: {e}") from e
+    return message
@@ -5,9 +5,10 @@ import json
 import os
 import base64
 import logging
+import math
 import pathlib
 import threading
-from typing import Any, TYPE_CHECKING
+from typing import Any, Optional, Tuple, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from P2PNode import P2PNode
@@ -17,6 +18,240 @@ else:
 
 logger = logging.getLogger(__name__)
 
+WEBSOCKET_MAX_MESSAGE_SIZE = 1024 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+MIN_STREAM_CHUNK_SIZE = 16 * 1024
+MAX_STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+INLINE_SERVE_LIMIT = 16 * 1024 * 1024
+DEFAULT_PAGE_SIZE = 200
+DEFAULT_SEARCH_TIMEOUT = 3.0
+MIN_SEARCH_TIMEOUT = 0.5
+MAX_SEARCH_TIMEOUT = 30.0
+# The sort keys FileIndex.page accepts; kept here so this module does not import utils.
+LISTING_SORTS = ("name", "size", "mtime", "extension")
+DELTA_BATCH_DELAY = 0.2
+MAX_DELTA_CHANGES = 5000
+
+local_files_response_cache: Optional[Tuple[tuple, str]] = None
+
+def find_local_file(filename: str) -> Tuple[Optional[str], Optional[str]]:
+    file_index = getattr(shared_p2p_node_instance, 'file_index', None)
+    if file_index is None:
+        return None, None
+    for f_path_str in file_index.find_by_name(filename):
+        f_hash = file_index.get_hash(f_path_str)
+        if f_hash:
+            return f_path_str, f_hash
+    return None, None
+
+def local_files_response(file_index) -> str:
+    # Serialising a large share is the expensive part, so the encoded reply is kept until the index changes.
+    global local_files_response_cache
+    version, listing = file_index.files()
+    cached = local_files_response_cache
+    if cached is None or cached[0] != (id(file_index), version):
+        cached = ((id(file_index), version), json.dumps({"type": "local_files_list", "version": version, "files": listing}))
+        local_files_response_cache = cached
+    return cached[1]
+
+def parse_listing_filter(request) -> Tuple[Optional[str], Optional[list]]:
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object")
+    pattern = request.get("filter")
+    if pattern is not None and not isinstance(pattern, str):
+        raise ValueError("filter must be a string")
+    extensions = request.get("extensions")
+    if extensions is not None and not (isinstance(extensions, list) and all(isinstance(e, str) for e in extensions)):
+        raise ValueError("extensions must be a list of strings")
+    return pattern or None, extensions
+
+def parse_search_request(payload: str) -> tuple:
+    request = json.loads(payload)
+    if isinstance(request, list):
+        request = {"patterns": request}
+    if not isinstance(request, dict):
+        raise ValueError("expected a JSON object")
+    patterns = request.get("patterns")
+    if not isinstance(patterns, list) or not patterns or not all(
+            isinstance(p, str) or (isinstance(p, dict) and isinstance(p.get("pattern"), str)) for p in patterns):
+        raise ValueError("patterns must be a list of strings or {\"pattern\", \"match\"} objects")
+    match = request.get("match", "auto")
+    if not isinstance(match, str):
+        raise ValueError("match must be a string")
+    quorum = request.get("quorum")
+    if quorum is not None and (isinstance(quorum, bool) or not isinstance(quorum, int) or quorum < 1):
+        raise ValueError("quorum must be a positive integer")
+    try:
+        timeout = float(request.get("timeout", DEFAULT_SEARCH_TIMEOUT))
+    except (TypeError, ValueError):
+        timeout = math.nan
+    if not math.isfinite(timeout):
+        raise ValueError("timeout must be a finite number of seconds")
+    return patterns, match, max(MIN_SEARCH_TIMEOUT, min(timeout, MAX_SEARCH_TIMEOUT)), quorum
+
+def parse_listing_request(payload: str) -> dict:
+    request = json.loads(payload)
+    pattern, extensions = parse_listing_filter(request)
+    order = request.get("order", "asc")
+    if order not in ("asc", "desc"):
+        raise ValueError(f"unknown order {order!r}")
+    sort = request.get("sort", "name")
+    if sort not in LISTING_SORTS:
+        raise ValueError(f"unknown sort {sort!r}")
+    cursor = request.get("cursor")
+    if cursor is not None and not isinstance(cursor, list):
+        raise ValueError("cursor must be the next_cursor of a previous page")
+    return {
+        "sort": sort,
+        "descending": order == "desc",
+        "pattern": pattern,
+        "extensions": extensions,
+        "cursor": cursor,
+        "limit": int(request.get("limit", DEFAULT_PAGE_SIZE))
+    }
+
+def parse_stream_request(payload: str) -> Tuple[str, int]:
+    chunk_size = STREAM_CHUNK_SIZE
+    filename = payload
+    if payload.startswith('{'):
+        request = json.loads(payload)
+        filename = request['filename']
+        chunk_size = int(request.get('chunk_size', STREAM_CHUNK_SIZE))
+    return filename, max(MIN_STREAM_CHUNK_SIZE, min(MAX_STREAM_CHUNK_SIZE, chunk_size))
+
+def inline_file_message(file_path: str, file_hash: str) -> str:
+    # Reading, base64 and JSON encoding of up to INLINE_SERVE_LIMIT bytes; run off the event loop.
+    with open(file_path, 'rb') as f:
+        file_data_bytes = f.read()
+    file_name = os.path.basename(file_path)
+    return json.dumps({
+        'type': 'file_data',
+        'file_hash': file_hash,
+        'file_name': file_name,
+        'file_format': file_name.split('.')[-1] if '.' in file_name else "",
+        'data': base64.b64encode(file_data_bytes).decode('utf-8')
+    })
+
+async def stream_local_file(websocket, file_path: str, file_hash: str, chunk_size: int, bandwidth=None):
+    loop = asyncio.get_running_loop()
+    file_name = os.path.basename(file_path)
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        await websocket.send(json.dumps({
+            'type': 'file_stream_start',
+            'file_hash': file_hash,
+            'file_name': file_name,
+            'file_format': file_name.split('.')[-1] if '.' in file_name else "",
+            'size': file_size,
+            'chunk_size': chunk_size
+        }))
+
+        bytes_sent = 0
+        peer = f"ws:{websocket.remote_address[0]}" if websocket.remote_address else "ws"
+        while chunk := await loop.run_in_executor(None, f.read, chunk_size):
+            if bandwidth is not None:
+                await bandwidth.acquire_async("upload", peer, len(chunk))
+            # send() waits for the transport to drain, so at most one chunk is buffered here.
+            await websocket.send(chunk)
+            bytes_sent += len(chunk)
+
+    await websocket.send(json.dumps({
+        'type': 'file_stream_end',
+        'file_hash': file_hash,
+        'file_name': file_name,
+        'bytes_sent': bytes_sent
+    }))
+    logger.info(f"Streamed {bytes_sent} bytes of {file_path} in {chunk_size}-byte frames.")
+
+class LocalFilesForwarder:
+    def __init__(self, websocket, file_index):
+        self.websocket = websocket
+        self.file_index = file_index
+        self.matches = None
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    def on_change(self, change, path, entry, version):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (change, path, entry, version))
+        except RuntimeError:
+            pass
+
+    def start(self, pattern: Optional[str] = None, extensions: Optional[list] = None):
+        self.matches = self.file_index.listing_filter(pattern, extensions)
+        if self.task is None:
+            self.file_index.add_listener(self.on_change)
+            self.task = asyncio.create_task(self.forward())
+
+    async def forward(self):
+        while True:
+            changes = [await self.queue.get()]
+            # A rescan or a large copy touches many files at once; coalesce them into one delta.
+            await asyncio.sleep(DELTA_BATCH_DELAY)
+            while not self.queue.empty() and len(changes) < MAX_DELTA_CHANGES:
+                changes.append(self.queue.get_nowait())
+
+            added = {}
+            removed = set()
+            for change, path, entry, _ in changes:
+                if change == "added":
+                    # Entries in "added" replace any earlier entry for the same path.
+                    removed.discard(path)
+                    if self.matches(entry):
+                        added[path] = entry
+                else:
+                    added.pop(path, None)
+                    removed.add(path)
+            try:
+                await self.websocket.send(json.dumps({
+                    "type": "local_files_delta",
+                    "version": changes[-1][3],
+                    "added": list(added.values()),
+                    "removed": sorted(removed)
+                }))
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+    def stop(self):
+        if self.task is not None:
+            self.file_index.remove_listener(self.on_change)
+            self.task.cancel()
+            self.task = None
+
+class JobEventForwarder:
+    def __init__(self, websocket, download_manager):
+        self.websocket = websocket
+        self.download_manager = download_manager
+        self.loop = asyncio.get_running_loop()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+
+    def on_event(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, event)
+        except RuntimeError:
+            pass
+
+    def start(self):
+        if self.task is None:
+            self.download_manager.add_listener(self.on_event)
+            self.task = asyncio.create_task(self.forward())
+
+    async def forward(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                await self.websocket.send(json.dumps(event))
+            except websockets.exceptions.ConnectionClosed:
+                return
+
+    def stop(self):
+        if self.task is not None:
+            self.download_manager.remove_listener(self.on_event)
+            self.task.cancel()
+            self.task = None
+
 async def handle_message(websocket, path=None):
     global shared_p2p_node_instance
     client_address = websocket.remote_address
@@ -28,6 +263,11 @@ async def handle_message(websocket, path=None):
         await websocket.close(code=1011, reason="Server configuration error")
         return
 
+    download_manager = getattr(shared_p2p_node_instance, 'download_manager', None)
+    job_events = JobEventForwarder(websocket, download_manager) if download_manager else None
+    file_index = getattr(shared_p2p_node_instance, 'file_index', None)
+    file_events = LocalFilesForwarder(websocket, file_index) if file_index is not None else None
+
     try:
         async for message_str in websocket:
             logger.info(f"Received message from {client_address}: {message_str}")
@@ -45,62 +285,84 @@ async def handle_message(websocket, path=None):
             command = command.strip()
             payload = payload.strip()
 
+            if command in ("receive_file", "list_jobs", "cancel_job", "subscribe_jobs") and not download_manager:
+                await websocket.send(json.dumps({"error": "Download manager not available."}))
+                continue
+
             if command == "receive_file":
                 requested_filename = payload
                 try:
-                    download_thread = threading.Thread(
-                        target=shared_p2p_node_instance.receive_file_from_peer,
-                        args=(requested_filename,)
-                    )
-                    download_thread.daemon = True
-                    download_thread.start()
-                    response_message = {"status": "download_initiated", "filename": requested_filename}
+                    job_events.start()
+                    job = download_manager.submit(requested_filename)
+                    response_message = {"status": "download_initiated", "filename": requested_filename, "job_id": job.id}
                     await websocket.send(json.dumps(response_message))
                 except Exception as e:
                     await websocket.send(json.dumps({"error": f"Failed to initiate download for '{requested_filename}'.", "details": str(e)}))
 
+            elif command == "subscribe_jobs":
+                job_events.start()
+                await websocket.send(json.dumps({"type": "job_list", "jobs": download_manager.list_jobs()}))
+
+            elif command == "list_jobs":
+                await websocket.send(json.dumps({"type": "job_list", "jobs": download_manager.list_jobs()}))
+
+            elif command == "cancel_job":
+                if download_manager.cancel(payload):
+                    await websocket.send(json.dumps({"status": "cancel_requested", "job_id": payload}))
+                else:
+                    await websocket.send(json.dumps({"error": f"No active job with id '{payload}'.", "job_id": payload}))
+
             elif command == "get_local_files_info":
-                local_files_info = []
-                if hasattr(shared_p2p_node_instance, 'peer_discovery') and shared_p2p_node_instance.peer_discovery:
-                    for f_hash, f_path_str in shared_p2p_node_instance.peer_discovery.local_files.items():
-                        local_files_info.append({
-                            "filename": os.path.basename(f_path_str),
-                            "hash": f_hash,
-                            "path": f_path_str
-                        })
-                    await websocket.send(json.dumps({"type": "local_files_list", "files": local_files_info}))
+                if file_index is None:
+                    await websocket.send(json.dumps({"error": "Could not retrieve local files information."}))
+                elif not payload:
+                    # Without a page request the whole share is sent, as older clients expect.
+                    response = await asyncio.get_running_loop().run_in_executor(None, local_files_response, file_index)
+                    await websocket.send(response)
                 else:
+                    try:
+                        listing_request = parse_listing_request(payload)
+                        page = await asyncio.get_running_loop().run_in_executor(None, lambda: file_index.page(**listing_request))
+                    except (ValueError, TypeError) as e:
+                        await websocket.send(json.dumps({"error": f"Invalid get_local_files_info payload: {e}. Expected {{\"sort\": \"name|size|mtime|extension\", \"order\": \"asc|desc\", \"filter\": ..., \"extensions\": [...], \"cursor\": ..., \"limit\": ...}}."}))
+                        continue
+                    await websocket.send(json.dumps({
+                        "type": "local_files_page",
+                        "sort": listing_request["sort"],
+                        "order": "desc" if listing_request["descending"] else "asc",
+                        **page
+                    }))
+
+            elif command == "subscribe_local_files":
+                if file_index is None:
                     await websocket.send(json.dumps({"error": "Could not retrieve local files information."}))
+                    continue
+                try:
+                    file_events.start(*parse_listing_filter(json.loads(payload) if payload else {}))
+                except (ValueError, TypeError) as e:
+                    await websocket.send(json.dumps({"error": f"Invalid subscribe_local_files payload: {e}. Expected {{\"filter\": ..., \"extensions\": [...]}}."}))
+                    continue
+                # Deltas carry the index version; pages fetched at or after this version already include earlier changes.
+                await websocket.send(json.dumps({"type": "local_files_subscribed", "version": file_index.version}))
+
+            elif command == "unsubscribe_local_files":
+                if file_events:
+                    file_events.stop()
+                await websocket.send(json.dumps({"status": "local_files_unsubscribed"}))
             
             elif command == "serve_file":
                 requested_filename_to_serve = payload
-                found_file_path = None
-                file_hash_to_send = None
-
-                if hasattr(shared_p2p_node_instance, 'peer_discovery') and shared_p2p_node_instance.peer_discovery:
-                    for f_hash, f_path_str in shared_p2p_node_instance.peer_discovery.local_files.items():
-                        if os.path.basename(f_path_str) == requested_filename_to_serve:
-                            found_file_path = f_path_str
-                            file_hash_to_send = f_hash
-                            break
+                found_file_path, file_hash_to_send = find_local_file(requested_filename_to_serve)
                 
                 if found_file_path and file_hash_to_send:
                     try:
-                        with open(found_file_path, 'rb') as f:
-                            file_data_bytes = f.read()
-                        
-                        file_data_encoded = base64.b64encode(file_data_bytes).decode('utf-8')
-                        file_name_to_send = os.path.basename(found_file_path)
-                        file_format = file_name_to_send.split('.')[-1] if '.' in file_name_to_send else ""
-
-                        response_message = {
-                            'type': 'file_data',
-                            'file_hash': file_hash_to_send,
-                            'file_name': file_name_to_send,
-                            'file_format': file_format,
-                            'data': file_data_encoded
-                        }
-                        await websocket.send(json.dumps(response_message))
+                        if os.path.getsize(found_file_path) > INLINE_SERVE_LIMIT:
+                            await websocket.send(json.dumps({"error": f"File '{requested_filename_to_serve}' is too large to send inline; use stream_file.", "filename": requested_filename_to_serve}))
+                            continue
+
+                        loop = asyncio.get_running_loop()
+                        response_message = await loop.run_in_executor(None, inline_file_message, found_file_path, file_hash_to_send)
+                        await websocket.send(response_message)
                     except FileNotFoundError:
                         await websocket.send(json.dumps({"error": f"File '{requested_filename_to_serve}' found in manifest but not on disk."}))
                     except Exception as e:
@@ -108,10 +370,68 @@ async def handle_message(websocket, path=None):
                 else:
                     await websocket.send(json.dumps({"status": "file_not_found_locally", "filename": requested_filename_to_serve}))
 
+            elif command == "stream_file":
+                try:
+                    requested_filename_to_serve, chunk_size = parse_stream_request(payload)
+                except (ValueError, KeyError, TypeError):
+                    await websocket.send(json.dumps({"error": "Invalid stream_file payload. Expected a filename or {\"filename\": ..., \"chunk_size\": ...}."}))
+                    continue
+
+                found_file_path, file_hash_to_send = find_local_file(requested_filename_to_serve)
+                if not found_file_path:
+                    await websocket.send(json.dumps({"status": "file_not_found_locally", "filename": requested_filename_to_serve}))
+                    continue
+                try:
+                    await stream_local_file(websocket, found_file_path, file_hash_to_send, chunk_size,
+                                            getattr(shared_p2p_node_instance, 'bandwidth', None))
+                except FileNotFoundError:
+                    await websocket.send(json.dumps({"error": f"File '{requested_filename_to_serve}' found in manifest but not on disk."}))
+                except OSError as e:
+                    await websocket.send(json.dumps({"type": "file_stream_error", "filename": requested_filename_to_serve, "error": str(e)}))
+
+            elif command == "search_files":
+                try:
+                    patterns, match, timeout, quorum = parse_search_request(payload)
+                except (ValueError, TypeError) as e:
+                    await websocket.send(json.dumps({"error": f"Invalid search_files payload: {e}. Expected {{\"patterns\": [...], \"match\": \"auto|exact|glob|substring\", \"quorum\": n}}."}))
+                    continue
+
+                loop = asyncio.get_running_loop()
+                results = await loop.run_in_executor(
+                    None, shared_p2p_node_instance.peer_discovery.search_files, patterns, match, timeout, quorum
+                )
+                await websocket.send(json.dumps({"type": "search_results", "patterns": patterns, "results": results}))
+
+            elif command in ("get_bandwidth_limits", "set_bandwidth_limits"):
+                bandwidth = getattr(shared_p2p_node_instance, 'bandwidth', None)
+                if bandwidth is None:
+                    await websocket.send(json.dumps({"error": "Bandwidth scheduler not available."}))
+                    continue
+                if command == "set_bandwidth_limits":
+                    try:
+                        bandwidth.configure(json.loads(payload))
+                    except (ValueError, TypeError, AttributeError) as e:
+                        await websocket.send(json.dumps({"error": f"Invalid set_bandwidth_limits payload: {e}. Expected {{\"upload\": {{\"global\": bytes/s, \"per_peer\": bytes/s, \"peers\": {{ip: bytes/s}}}}, \"download\": {{...}}}} with null for no limit."}))
+                        continue
+                await websocket.send(json.dumps({"type": "bandwidth_limits", "limits": bandwidth.limits()}))
+
+            elif command == "get_replication_status":
+                replication = getattr(shared_p2p_node_instance, 'replication', None)
+                if replication is None:
+                    await websocket.send(json.dumps({"error": "Replication is not enabled on this node."}))
+                    continue
+                await websocket.send(json.dumps({"type": "replication_status", "status": replication.status()}))
+
             elif command == "discover_peers":
                 if hasattr(shared_p2p_node_instance, 'peer_discovery') and shared_p2p_node_instance.peer_discovery:
-                    peers = shared_p2p_node_instance.peer_discovery.peers
-                    await websocket.send(json.dumps({"type": "peer_list", "peers": peers}))
+                    peer_discovery = shared_p2p_node_instance.peer_discovery
+                    peer_registry = getattr(peer_discovery, 'peer_registry', None)
+                    peer_stats = peer_registry.snapshot() if peer_registry is not None else []
+                    await websocket.send(json.dumps({
+                        "type": "peer_list",
+                        "peers": peer_discovery.peers,
+                        "peer_stats": peer_stats
+                    }))
                 else:
                     await websocket.send(json.dumps({"error": "Could not retrieve peer list."}))
             else:
@@ -130,6 +450,10 @@ async def handle_message(websocket, path=None):
             except websockets.exceptions.ConnectionClosed:
                 pass
     finally:
+        if job_events:
+            job_events.stop()
+        if file_events:
+            file_events.stop()
         logger.info(f"Connection with {client_address} closed.")
 
 async def start_websocket_server_main(host, port, p2p_node_instance: P2PNode | Any):
@@ -140,7 +464,7 @@ async def start_websocket_server_main(host, port, p2p_node_instance: P2PNode | A
         logger.critical("Cannot start WebSocket server: P2PNode instance is None.")
         return
 
-    async with websockets.serve(handle_message, host, port, max_size=None): 
+    async with websockets.serve(handle_message, host, port, max_size=WEBSOCKET_MAX_MESSAGE_SIZE): 
         await asyncio.Future()
 
 def run_server(p2p_node_instance: P2PNode | Any, host='localhost', port=8765):
@@ -166,7 +490,7 @@ if __name__ == '__main__':
     class MockP2PNode:
         def __init__(self):
             self.peer_discovery = self.MockDiscoverPeers()
-            self.files = {}
+            self.file_index = self.peer_discovery.file_index
 
         def receive_file_from_peer(self, filename):
             logger.info(f"[MockP2PNode] Request to download file: {filename}")
@@ -189,8 +513,23 @@ if __name__ == '__main__':
                 else:
                     self.local_files = {}
 
+                self.file_index = self.MockFileIndex(self.local_files)
                 self.peers = ["mock_peer1:12345", "mock_peer2:54321"]
 
+            class MockFileIndex:
+                def __init__(self, local_files):
+                    self.local_files = local_files
+
+                def find_by_name(self, filename):
+                    return [path for path in self.local_files.values() if os.path.basename(path) == filename]
+
+                def get_hash(self, file_path):
+                    return next((h for h, path in self.local_files.items() if path == file_path), None)
+
+                def files(self):
+                    return 0, [{"filename": os.path.basename(path), "hash": h, "path": path, "size": os.path.getsize(path)}
+                               for h, path in self.local_files.items()]
+
     mock_node = MockP2PNode()
     
     try: